@@ -1,5 +1,28 @@
-import raspy_cal.main as main
-import raspy_cal.lowlevel as lowlevel
-import raspy_cal.default as default
-from raspy_cal.settings import Settings
-from raspy_cal.frontend.input import run, configSpecify
\ No newline at end of file
+"""
+raspy-cal: automatic calibration of HEC-RAS models.  The names below are loaded on first access (PEP 562), so
+that importing the package, or running one of its commands, doesn't load every dependency up front.
+"""
+
+import importlib
+
+# Submodules, and attributes with the module they come from
+submodules = ["main", "lowlevel", "default"]
+attributes = {
+    "Settings": "raspy_cal.settings",
+    "run": "raspy_cal.frontend.input",
+    "configSpecify": "raspy_cal.frontend.input"
+}
+
+
+def __getattr__(name):
+    if name in submodules:
+        return importlib.import_module("raspy_cal." + name)
+    if name in attributes:
+        value = getattr(importlib.import_module(attributes[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module 'raspy_cal' has no attribute %r" % name)
+
+
+def __dir__():
+    return sorted(set(globals()) | set(submodules) | set(attributes))
@@ -0,0 +1,217 @@
+"""
+Headless batch runner: calibrate many gages, one config file each, in a pool of worker processes.  Run with
+`python -m raspy_cal.batch <directory or manifest> [options]` or `raspy-cal BATCH <directory or manifest> [options]`
+(see main).
+
+Each job writes to its own output directory, with a done.json marker once it is complete, so that completed jobs
+are skipped when the batch is run again.  Single-gage automatic calibration jobs also keep a checkpoint, so that
+an interrupted job resumes; refinement and multi-gage jobs restart.  A
+combined summary.csv has the best n and metrics for each gage.
+
+Jobs never wait for console input: any setting that would otherwise be asked for must be in the config file
+(prompts with a default get the default), and results are not plotted on screen.  Jobs that are neither
+automatic (auto: True) nor multi-gage are run with unattended range refinement (see refineIterate).
+
+Copyright (C) 2020 Daniel Philippus
+Full copyright notice located in main.py.
+"""
+
+import argparse
+import builtins
+import csv
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+DONE = "done.json"
+
+
+class MissingSetting(Exception):
+    # A job needed a setting that isn't in its config file
+    pass
+
+
+def headlessInput(prompt=""):
+    """
+    Replacement for input() in batch jobs: accept the default where the prompt offers one, otherwise fail.
+    """
+    text = prompt.lower()
+    if "default" in text or "blank" in text or "enter y" in text:
+        return ""
+    raise MissingSetting("Setting required but not in the config file: %s" % prompt.strip())
+
+
+def isConfig(path):
+    # Whether a file looks like a raspy-cal config file (it has a project line)
+    try:
+        with open(path, errors="replace") as f:
+            return any(line.lower().startswith("project:") for line in f)
+    except OSError:
+        return False
+
+
+def findJobs(source):
+    """
+    :param source: a directory of config files, or a manifest: a text file listing config file paths (one per line,
+        relative to the manifest's directory; lines starting with # are ignored)
+    :return: list of (job name, config path), named after the config files (made unique if needed)
+    """
+    if os.path.isdir(source):
+        paths = sorted(os.path.join(source, f) for f in os.listdir(source)
+                       if not f.startswith(".") and os.path.isfile(os.path.join(source, f)))
+        paths = [path for path in paths if isConfig(path)]
+    else:
+        folder = os.path.dirname(os.path.abspath(source))
+        with open(source) as f:
+            paths = [os.path.join(folder, line.strip()) for line in f
+                     if line.strip() != "" and not line.startswith("#")]
+    jobs = []
+    names = set()
+    for path in paths:
+        base = os.path.splitext(os.path.basename(path))[0]
+        name = base
+        ix = 2
+        while name in names:
+            name = "%s-%d" % (base, ix)
+            ix += 1
+        names.add(name)
+        jobs.append((name, path))
+    return jobs
+
+
+def bestResult(results, keys):
+    """
+    :param results: [(n, metrics, sim)] as returned by the calibrators
+    :param keys: metric names, best by the first
+    :return: (best result, number of results)
+    """
+    from raspy_cal.midlevel.eval import minimized
+    return (min(results, key=lambda res: minimized(res[1])[keys[0]]), len(results))
+
+
+def runJob(name, confPath, jobDir):
+    """
+    Run one job in this process.
+    :return: summary {"job", "status", "seconds", "error", "gages": [{"gage", "n", "front", metrics...}]}
+    """
+    # Imported here so that only the worker processes load the calibration modules
+    from raspy_cal.settings import Settings
+    from raspy_cal.frontend.input import configSpecify, autoIterate, multiAutoIterate, refineIterate
+    from raspy_cal.midlevel.eval import tests
+    start = time.time()
+    builtins.input = headlessInput
+    summary = {"job": name, "config": os.path.abspath(confPath), "status": "failed", "error": "", "gages": []}
+    try:
+        os.makedirs(jobDir, exist_ok=True)
+        # Default output file, so that it isn't prompted for; the output file is always written in the job directory
+        settings = Settings()
+        settings.specify(outf="results.csv")
+        settings = configSpecify(confPath, settings)
+        settings.outf = os.path.join(jobDir, os.path.basename(settings.outf))
+        (settings.plot, settings.resume) = (False, True)
+        settings.checkpoint = os.path.join(jobDir, "checkpoint.pkl")
+        if settings.store:
+            settings.store = os.path.join(jobDir, os.path.basename(os.path.normpath(settings.store)))
+        keys = settings.metrics if settings.metrics is not None else list(tests.keys())
+        if settings.gages is not None:
+            results = multiAutoIterate(settings)
+            for (ix, gage) in enumerate(settings.gages):
+                ((n, metrics, sim), front) = bestResult([(res[0][ix], res[1][ix], res[2][ix]) for res in results],
+                                                        keys)
+                summary["gages"].append(dict(metrics, gage=gage["name"], n=n, front=front))
+        else:
+            results = autoIterate(settings) if settings.auto else refineIterate(settings)
+            ((n, metrics, sim), front) = bestResult(results, keys)
+            summary["gages"].append(dict(metrics, gage=name, n=n, front=front))
+        summary["status"] = "done"
+    except Exception as e:
+        summary["error"] = "%s: %s" % (type(e).__name__, e)
+        with open(os.path.join(jobDir, "error.txt"), "w") as f:
+            f.write(traceback.format_exc())
+    summary["seconds"] = time.time() - start
+    if summary["status"] == "done":
+        with open(os.path.join(jobDir, DONE), "w") as f:
+            json.dump(summary, f, indent=1)
+        if os.path.exists(os.path.join(jobDir, "error.txt")):
+            os.remove(os.path.join(jobDir, "error.txt"))  # from an earlier failed attempt
+    return summary
+
+
+def writeSummary(path, summaries):
+    """
+    Write the combined summary CSV: one row per gage, or per failed job.
+    """
+    rows = []
+    for summary in summaries:
+        gages = summary["gages"] if summary["gages"] else [{}]
+        for gage in gages:
+            rows.append(dict(gage, job=summary["job"], status=summary["status"], seconds=summary["seconds"],
+                             error=summary["error"]))
+    fixed = ["job", "gage", "status", "n", "front"]
+    metrics = sorted(set(key for row in rows for key in row) - set(fixed) - {"seconds", "error"})
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fixed + metrics + ["seconds", "error"])
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def runBatch(source, outDir, workers=1, force=False, log=True):
+    """
+    Run all the jobs from a directory or manifest of config files (see findJobs).
+    :param outDir: output directory; each job writes to outDir/<job name>
+    :param workers: number of jobs to run at once, each in its own process
+    :param force: rerun jobs that are already complete
+    :return: list of job summaries (see runJob), in job order
+    """
+    jobs = findJobs(source)
+    os.makedirs(outDir, exist_ok=True)
+    summaries = {}
+    pending = []
+    for (name, path) in jobs:
+        done = os.path.join(outDir, name, DONE)
+        if force:
+            for stale in [done, os.path.join(outDir, name, "checkpoint.pkl")]:
+                if os.path.exists(stale):
+                    os.remove(stale)
+        if os.path.exists(done):
+            with open(done) as f:
+                summaries[name] = json.load(f)
+            if log:
+                print("Skipping %s: already complete" % name)
+        else:
+            pending.append((name, path))
+    if pending:
+        with ProcessPoolExecutor(max_workers=max(workers, 1)) as pool:
+            futures = {pool.submit(runJob, name, path, os.path.join(outDir, name)): name for (name, path) in pending}
+            for future in as_completed(futures):
+                summary = future.result()
+                summaries[futures[future]] = summary
+                if log:
+                    print("Job %s %s in %.0f s%s" % (summary["job"], summary["status"], summary["seconds"],
+                                                     "" if summary["error"] == "" else ": " + summary["error"]))
+    ordered = [summaries[name] for (name, path) in jobs]
+    writeSummary(os.path.join(outDir, "summary.csv"), ordered)
+    return ordered
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="python -m raspy_cal.batch",
+                                     description="Calibrate many gages from config files without console input.")
+    parser.add_argument("source", help="directory of config files, or manifest listing config file paths")
+    parser.add_argument("--out", default="batch", help="output directory (default: batch)")
+    parser.add_argument("--workers", type=int, default=1, help="number of jobs to run at once (default: 1)")
+    parser.add_argument("--force", action="store_true", help="rerun jobs that are already complete")
+    opts = parser.parse_args(args)
+    summaries = runBatch(opts.source, opts.out, opts.workers, opts.force)
+    failed = [summary["job"] for summary in summaries if summary["status"] != "done"]
+    print("%d of %d jobs complete; summary written to %s" % (len(summaries) - len(failed), len(summaries),
+                                                             os.path.join(opts.out, "summary.csv")))
+    if failed:
+        print("Failed: %s (see error.txt in each job's directory)" % ", ".join(failed))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,382 @@
+"""
+Benchmarks for performance-sensitive parts of raspy-cal, runnable without HEC-RAS: simulations use the synthetic
+model (see synthetic.py) with an artificial compute delay.  Run with `python -m raspy_cal.benchmark [options]`
+(see main); results are appended to a JSON file keyed by version, so that regressions show up as a comparison
+against the previous version's results.
+
+Copyright (C) 2020 Daniel Philippus
+Full copyright notice located in main.py.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from raspy_cal.midlevel.eval import nonDominated, nonDominatedNaive, ParetoArchive, BatchEvaluator, evaluate
+from raspy_cal.midlevel.params import paramSpec, genParams
+from raspy_cal.midlevel.data import prepareUSGSData
+from raspy_cal.synthetic import SyntheticModel
+
+RIVER = "River"
+REACH = "Reach"
+RS = "200"
+
+
+def timed(func, *args):
+    """
+    :return: (seconds, result) for func(*args)
+    """
+    start = time.perf_counter()
+    result = func(*args)
+    return (time.perf_counter() - start, result)
+
+
+def measure(func, items=1, repeat=3):
+    """
+    Time repeated calls of func().
+    :param items: number of items (simulations, points...) each call processes
+    :return: {"seconds" (best call), "median" (median call), "latency" (best seconds per item),
+        "throughput" (items per second in the best call)}
+    """
+    times = [timed(func)[0] for _ in range(repeat)]
+    best = min(times)
+    return {"seconds": best, "median": statistics.median(times), "latency": best / items,
+            "throughput": items / best if best > 0 else float("inf")}
+
+
+def quietly(func):
+    # Run func() without its console output (progress messages)
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return func()
+    return run
+
+
+def randomPoints(count, metrics, seed=0):
+    # Random (value, metrics) points, as would come from evaluate or an evaluation history
+    rand = random.Random(seed)
+    return [(ix, [rand.random() for _ in range(metrics)]) for ix in range(count)]
+
+
+def observed(nprofs, n=0.04, delay=0.0):
+    """
+    :return: (synthetic model, flows, observed stage at RS for Manning's n of n, with some noise)
+    """
+    model = SyntheticModel(flows=[10.0 * 1.5 ** ix for ix in range(nprofs)], delay=delay)
+    model.params.modifyN(n, RIVER, REACH)
+    model.ops.compute()
+    rand = random.Random(0)
+    stage = model.data.stage(RIVER, REACH, RS, nprofs)
+    obs = [stage[prof] * (1 + rand.gauss(0, 0.02)) for prof in range(1, nprofs + 1)] if nprofs > 1 else [stage]
+    return (model, model.flows, obs)
+
+
+def benchRunSims(counts=(10, 100), delays=(0.0, 0.002), nprofs=20):
+    """
+    runSims throughput and per-simulation latency, serial and pipelined.
+    """
+    from raspy_cal.lowlevel import runSims
+    out = []
+    for delay in delays:
+        (model, flows, obs) = observed(nprofs, delay=delay)
+        for count in counts:
+            ns = [0.01 + 0.1 * ix / count for ix in range(count)]
+            for pipeline in (False, True):
+                res = measure(lambda: runSims(model, ns, RIVER, REACH, nprofs, range=[RS], log=False,
+                                              pipeline=pipeline), count, 1 if delay > 0 else 3)
+                out.append(dict(res, delay=delay, simulations=count, pipeline=pipeline))
+    return out
+
+
+def benchIteration(counts=(10, 50), delay=0.002, nprofs=20):
+    """
+    nstageIteration (semi-manual mode: simulate, evaluate, filter) for numbers of ns.
+    """
+    from raspy_cal.midlevel.calibrators import nstageIteration
+    (model, flows, obs) = observed(nprofs, delay=delay)
+    out = []
+    for count in counts:
+        res = measure(quietly(lambda: nstageIteration(model, RIVER, REACH, RS, obs, count, False, 0.01, 0.1,
+                                                      ["rmse", "pbias"], False)), count, 1)
+        out.append(dict(res, simulations=count))
+    return out
+
+
+def benchAutoIterate(evals=(50, 200), engines=("nsga2", "brent", "surrogate"), delay=0.002, nprofs=20):
+    """
+    autoIterate end to end (including writing results, without plotting) for each engine and evaluation budget.
+    """
+    import raspy_cal.frontend.input as inp
+    from raspy_cal.settings import Settings
+    (model, flows, obs) = observed(nprofs, delay=delay)
+    folder = tempfile.mkdtemp(prefix="raspy_cal_bench_")
+    out = []
+    for engine in engines:
+        for count in evals:
+            settings = Settings()
+            settings.specify(river=RIVER, reach=REACH, rs=RS, outf=os.path.join(folder, "out.txt"), plot=False,
+                             auto=True, evals=count, nct=10, engine=engine,
+                             metrics=["rmse"] if engine == "brent" else ["rmse", "pbias"])
+            (settings.flow, settings.stage, settings.datum) = (flows, obs, False)
+            res = measure(quietly(lambda: inp.autoIterate(settings, model=model)), count, 1)
+            out.append(dict(res, engine=engine, evals=count))
+    return out
+
+
+def benchEvaluate(counts=(100, 1000, 10000), nprofs=100):
+    """
+    Metric evaluation: BatchEvaluator for all metrics, and evaluate (metrics plus non-dominated filtering).
+    """
+    rand = random.Random(0)
+    obs = [1 + ix / 10 for ix in range(nprofs)]
+    out = []
+    for count in counts:
+        sims = [[o * (1 + rand.gauss(0, 0.05)) for o in obs] for _ in range(count)]
+        batch = BatchEvaluator(obs, False)
+        res = measure(lambda: batch.rows(sims), count)
+        out.append(dict(res, function="BatchEvaluator", simulations=count))
+        pairs = list(enumerate(sims))
+        res = measure(lambda: evaluate(obs, pairs, False, metrics=["rmse", "pbias", "nse"]), count)
+        out.append(dict(res, function="evaluate", simulations=count))
+    return out
+
+
+def benchNonDominated(sizes=(1000, 10000, 100000), metrics=(2, 3), naiveLimit=10000):
+    """
+    Compare nonDominated, nonDominatedNaive and ParetoArchive (adding points one at a time).
+    :param sizes: numbers of points
+    :param metrics: numbers of metrics
+    :param naiveLimit: largest size to run nonDominatedNaive on (it is O(n^2))
+    :return: list of {"metrics", "points", "fast", "naive", "archive"} timings in seconds (naive None if skipped)
+    """
+    out = []
+    for m in metrics:
+        for size in sizes:
+            points = randomPoints(size, m)
+            (fast, front) = timed(nonDominated, points)
+            naive = timed(nonDominatedNaive, points)[0] if size <= naiveLimit else None
+            archive = ParetoArchive()
+            (incremental, _) = timed(lambda: [archive.add(pt) for pt in points])
+            out.append({"metrics": m, "points": size, "front": len(front), "fast": fast, "naive": naive,
+                        "archive": incremental})
+    return out
+
+
+def benchGenParams(counts=(1000, 100000), rand=(False, True, "lhs", "sobol")):
+    """
+    genParams for a single parameter.
+    """
+    out = []
+    for count in counts:
+        for r in rand:
+            res = measure(lambda: genParams([paramSpec("n", 0.01, 0.1, count, r)], dicts=False), count)
+            out.append(dict(res, params=count, random=r))
+    return out
+
+
+def benchPrepareUSGSData(sizes=(10000, 100000, 1000000), stats=("first", "median")):
+    """
+    prepareUSGSData on synthetic gage records (flow, stage) with flows spanning three orders of magnitude.
+    """
+    rand = random.Random(0)
+    out = []
+    for size in sizes:
+        data = []
+        for _ in range(size):
+            flow = 10 ** rand.uniform(0, 3)
+            data.append((flow, 0.5 * flow ** 0.4 + rand.gauss(0, 0.05)))
+        for stat in stats:
+            res = measure(lambda: prepareUSGSData(data, 100, stat=stat), size)
+            out.append(dict(res, records=size, stat=stat))
+    return out
+
+
+# Dependencies that importing the package, or starting the command line, should not load (they are imported when
+# first used)
+HEAVY = ["matplotlib", "platypus", "scipy", "HydroErr", "raspy_auto", "tkinter"]
+# python -m raspy_cal --help
+HELP = "import runpy, sys; sys.argv = ['raspy_cal', '--help']; runpy.run_module('raspy_cal', run_name='__main__')"
+# Import-time budgets in seconds, by statement run in a fresh interpreter
+importBudgets = {
+    "import raspy_cal": 0.25,
+    "import raspy_cal.main": 0.25,
+    HELP: 0.25,
+    "import raspy_cal.batch": 0.5,
+    "import raspy_cal.frontend.input": 1.0
+}
+
+
+def importTime(statement):
+    """
+    Run a statement (imports) in a fresh interpreter.
+    :return: (seconds it took, list of HEAVY modules loaded)
+    """
+    code = ("import contextlib, io, sys, time\nstart = time.perf_counter()\n"
+            "with contextlib.redirect_stdout(io.StringIO()):\n    exec(%r)\n"
+            "print(time.perf_counter() - start)\nprint(','.join(m for m in %r if m in sys.modules))") % (statement, HEAVY)
+    env = dict(os.environ)
+    source = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join([source] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else []))
+    lines = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                           env=env).stdout.split("\n")
+    return (float(lines[0]), [m for m in lines[1].split(",") if m != ""])
+
+
+def benchImport(statements=tuple(importBudgets), repeat=3):
+    """
+    Import time of the package and command line in fresh interpreters, with the budget for each (see importBudgets)
+    and any heavy dependencies loaded.
+    """
+    out = []
+    for statement in statements:
+        runs = [importTime(statement) for _ in range(repeat)]
+        out.append({"statement": statement, "seconds": min(run[0] for run in runs),
+                    "budget": importBudgets.get(statement), "heavy": runs[0][1]})
+    return out
+
+
+def checkImports(rows):
+    """
+    :param rows: results of benchImport
+    :return: list of problems: statements over budget, or loading heavy dependencies other than those the
+        statement imports itself
+    """
+    problems = []
+    for row in rows:
+        if row["budget"] is not None and row["seconds"] > row["budget"]:
+            problems.append("%s took %.3f s (budget %.3f s)" % (row["statement"], row["seconds"], row["budget"]))
+        if row["heavy"]:
+            problems.append("%s loaded %s" % (row["statement"], ", ".join(row["heavy"])))
+    return problems
+
+
+# Benchmarks by name: (function, keyword arguments for the quick variant)
+benchmarks = {
+    "runSims": (benchRunSims, {"counts": (10,), "delays": (0.0, 0.002)}),
+    "nstageIteration": (benchIteration, {"counts": (10,)}),
+    "autoIterate": (benchAutoIterate, {"evals": (30,), "engines": ("nsga2", "brent")}),
+    "evaluate": (benchEvaluate, {"counts": (100, 1000)}),
+    "nonDominated": (benchNonDominated, {"sizes": (1000, 10000), "naiveLimit": 1000}),
+    "genParams": (benchGenParams, {"counts": (1000,)}),
+    "prepareUSGSData": (benchPrepareUSGSData, {"sizes": (10000,)}),
+    "import": (benchImport, {"repeat": 1})
+}
+
+
+def version():
+    # Installed package version, or "dev" if running from a source tree
+    try:
+        from importlib.metadata import version as installed
+        return installed("raspy-cal")
+    except Exception:
+        return "dev"
+
+
+def runBenchmarks(names=None, quick=False):
+    """
+    :param names: benchmark names (see benchmarks), or None for all
+    :param quick: use the smaller quick scales
+    :return: {name: list of result rows}
+    """
+    out = {}
+    for name in (names if names is not None else benchmarks.keys()):
+        (func, quickArgs) = benchmarks[name]
+        out[name] = func(**quickArgs) if quick else func()
+    return out
+
+
+def rowKey(row):
+    # Identify a result row by its non-timing entries
+    timings = ["seconds", "median", "latency", "throughput", "fast", "naive", "archive", "front", "heavy"]
+    return json.dumps({k: v for (k, v) in row.items() if k not in timings}, sort_keys=True)
+
+
+def rowTime(row):
+    return row["seconds"] if "seconds" in row else row["fast"]
+
+
+def compare(results, previous):
+    """
+    :return: list of (benchmark, row, ratio of time to the previous results) for rows in both
+    """
+    out = []
+    for (name, rows) in results.items():
+        old = {rowKey(row): row for row in previous.get(name, [])}
+        for row in rows:
+            if rowKey(row) in old and rowTime(old[rowKey(row)]) > 0:
+                out.append((name, row, rowTime(row) / rowTime(old[rowKey(row)])))
+    return out
+
+
+def store(path, label, results):
+    """
+    Add results to the JSON file at path ({label: {"time": ..., "results": results}}), replacing any previous
+    results with the same label.
+    :return: previous results (the most recent other label), or {} if none
+    """
+    history = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            history = json.load(f)
+    others = sorted((entry["time"], entry["results"]) for (key, entry) in history.items() if key != label)
+    history[label] = {"time": time.time(), "results": results}
+    with open(path, "w") as f:
+        json.dump(history, f, indent=1)
+    return others[-1][1] if others else {}
+
+
+def describe(row):
+    return ", ".join("%s=%s" % (k, v) for (k, v) in row.items()
+                     if k not in ["seconds", "median", "latency", "throughput", "fast", "naive", "archive"])
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="python -m raspy_cal.benchmark",
+                                     description="Benchmark raspy-cal with a synthetic model (no HEC-RAS needed).")
+    parser.add_argument("names", nargs="*", help="benchmarks to run (default all): %s" % ", ".join(benchmarks))
+    parser.add_argument("--quick", action="store_true", help="run at smaller scales")
+    parser.add_argument("--out", default="benchmarks.json", help="JSON file to store results in")
+    parser.add_argument("--label", default=None, help="label for these results (default: package version)")
+    parser.add_argument("--check-imports", action="store_true",
+                        help="only check import times against their budgets and exit with status 1 if any is over")
+    opts = parser.parse_args(args)
+    if opts.check_imports:
+        problems = checkImports(benchImport())
+        for problem in problems:
+            print(problem)
+        print("Import check %s" % ("failed" if problems else "passed"))
+        return 1 if problems else 0
+    unknown = [name for name in opts.names if name not in benchmarks]
+    if unknown:
+        parser.error("unknown benchmarks %s" % unknown)
+    label = opts.label if opts.label is not None else version() + ("-quick" if opts.quick else "")
+    results = runBenchmarks(opts.names if opts.names else None, opts.quick)
+    for (name, rows) in results.items():
+        print(name)
+        for row in rows:
+            if "throughput" in row:
+                print("    %-60s %10.4f s %12.1f /s" % (describe(row), row["seconds"], row["throughput"]))
+            elif "fast" not in row:
+                print("    %-60s %10.4f s" % (describe(row), row["seconds"]))
+            else:
+                print("    %-60s %10.4f s (naive %s, archive %.4f s)" % (
+                    describe(row), row["fast"], "-" if row["naive"] is None else "%.4f s" % row["naive"],
+                    row["archive"]))
+    previous = store(opts.out, label, results)
+    changes = compare(results, previous)
+    if changes:
+        print("Compared with previous results (time ratio; above 1 is slower):")
+        for (name, row, ratio) in changes:
+            print("    %-16s %-60s %6.2f%s" % (name, describe(row), ratio, "  <-- slower" if ratio > 1.2 else ""))
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
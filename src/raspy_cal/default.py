@@ -7,7 +7,7 @@ Copyright (C) 2020 Daniel Philippus
 Full copyright notice located in main.py.
 """
 
-from raspy_auto import Ras, API
-
 def Model(projectPath, version):
-    return API(Ras(projectPath, version))
\ No newline at end of file
+    # raspy_auto (Windows only) is imported here, so that the rest of raspy-cal can be used without it
+    from raspy_auto import Ras, API
+    return API(Ras(projectPath, version))
@@ -5,13 +5,80 @@ Copyright (C) 2020 Daniel Philippus
 Full copyright notice located in main.py.
 """
 
-import matplotlib.pyplot as plt
-from matplotlib.ticker import FormatStrFormatter
+import multiprocessing
+import os
+import threading
+from csv import writer as csvWriter
+
+import numpy as np
+
+# matplotlib is imported by the plotting functions, so that it is only loaded when something is plotted
+
+# Above this many simulated curves, plots are drawn as one collection colored by parameter (see manyRatingCurves)
+MANY = 20
+# Plots being rendered in background processes (see plotInBackground)
+background = []
 
 
 def csv(list):
     return "\n".join([",".join(row) for row in list])
 
+def writeRows(path, rows):
+    # Write rows (an iterable, consumed as it is written) to a CSV file
+    with open(path, "w", newline="") as f:
+        csvWriter(f, lineterminator="\n").writerows(rows)
+
+def fmt(value):
+    # Compact numeric formatting for streamed output
+    return "%.6g" % value
+
+class EvaluationWriter(object):
+    """
+    Appends one CSV row per evaluation as it completes: the parameters, the metrics and the simulated stage for each
+    profile.  Each row is flushed when written, so the file is complete up to the last finished evaluation even if
+    the run is interrupted.  Safe to write to from several threads.
+    """
+    def __init__(self, path, flows, keys, paramNames=("n",), gages=None, si=False, append=False):
+        """
+        :param path: CSV path
+        :param flows: flow profiles
+        :param keys: metric names, in column order
+        :param paramNames: name of each parameter
+        :param gages: gage names for multi-gage calibration (metrics and stages are written for each), or None
+        :param si: SI units (for the column names)
+        :param append: add to an existing file (e.g. when resuming) rather than starting over
+        """
+        self.keys = list(keys)
+        self.gages = gages
+        prefixes = [""] if gages is None else [gage + "." for gage in gages]
+        simlab = "SimStage.m.Q=" if si else "SimStage.ft.Q="
+        header = list(paramNames) + [pre + key for pre in prefixes for key in self.keys] +\
+            [pre + simlab + fmt(q) for pre in prefixes for q in flows]
+        exists = append and os.path.exists(path) and os.path.getsize(path) > 0
+        self.file = open(path, "a" if exists else "w", newline="")
+        self.writer = csvWriter(self.file, lineterminator="\n")
+        self.lock = threading.Lock()
+        if not exists:
+            self.writer.writerow(header)
+            self.file.flush()
+
+    def write(self, params, metrics, sim):
+        """
+        :param params: n, or list of ns
+        :param metrics: metrics dictionary, or list of them for each gage
+        :param sim: simulated stages, or list of them for each gage
+        """
+        (metrics, sim) = ([metrics], [sim]) if self.gages is None else (metrics, sim)
+        params = params if isinstance(params, (list, tuple)) else [params]
+        row = [fmt(p) for p in params] + [fmt(m[key]) for m in metrics for key in self.keys] +\
+            [fmt(st) for stages in sim for st in stages]
+        with self.lock:
+            self.writer.writerow(row)
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
 def space(entry, width = 9, after = False):
     """
     Add spaces to the entry so that it is the appropriate width.  Add spaces before unless after is true.
@@ -47,7 +114,8 @@ def evalTable(params, metricSets, paramName = "n", string = True):
     else:
         return rows
 
-def nDisplay(results, flow, obs, plotpath=None, csvpath=None, plot=True, correctDatum = False, si = False):
+def nDisplay(results, flow, obs, plotpath=None, csvpath=None, plot=True, correctDatum = False, si = False,
+             background = False):
     """
     Wrapper for displayOutputs using 1-D/Manning's n defaults.
     :param results: [(parameter, metrics, stage)]
@@ -56,14 +124,16 @@ def nDisplay(results, flow, obs, plotpath=None, csvpath=None, plot=True, correct
     :param plotpath: path to save plot
     :param csvpath: path to save CSV
     :param plot: whether to plot
+    :param background: save plots of many curves in a background process (see displayOutputs)
     :return: list version of result table
     """
     return displayOutputs("n", results, flow, obs, "Rating Curves Comparison", "Flow (cfs)" if not si else "Flow (cms)",
-                          "Stage (ft)" if not si else "Stage (m)", True, True, plotpath, plot, csvpath, correctDatum, si)
+                          "Stage (ft)" if not si else "Stage (m)", True, True, plotpath, plot, csvpath, correctDatum,
+                          si, background)
 
 
 def displayOutputs(paramName, results, obsX, obsY, title="", xlab="", ylab="", xlog=True, ylog=True, plotpath=None,
-                   plot=True, csvpath=None, correctDatum = False, si = False):
+                   plot=True, csvpath=None, correctDatum = False, si = False, background = False):
     """
     Print metric table, show plot (if specified), and save plot (if specified).
     :param paramName: name of calibration parameter
@@ -80,6 +150,8 @@ def displayOutputs(paramName, results, obsX, obsY, title="", xlab="", ylab="", x
     :param csvpath: where to save CSV version of metrics table or None not to
     :param plot: whether to plot
     :param si: SI units
+    :param background: if there are more than MANY results and the plot is only saved, not shown, render it in a
+        background process (see plotInBackground)
     :return: list version of result table
     """
     (params, metrics, timeseries) = ([res[0] for res in results], [res[1] for res in results],
@@ -91,21 +163,26 @@ def displayOutputs(paramName, results, obsX, obsY, title="", xlab="", ylab="", x
     stlab = "ObsStage.m" if si else "ObsStage.ft"
     simlab = "SimStage.m.n=" if si else "SimStage.ft.n="
     if csvpath is not None:
-        with open(csvpath, "w") as f:
-            f.write(csv(listTable))
+        writeRows(csvpath, listTable)
         parts = csvpath.split(".")
         datapath = ".".join(parts[:-1]) + "-data.csv"
-        datatable = [[qlab, stlab] + [simlab + str(p) for p in params]] + \
-                     [[str(obsX[i]), str(obsY[i])] + [str(r[2][i]) for r in results] for i in range(len(obsX))]
-        with open(datapath, "w") as f:
-            f.write(csv(datatable))
-    if (plotpath is not None) or plot:
+        # Rows are generated as they are written rather than built up as one table
+        datatable = ([qlab, stlab] + [simlab + str(p) for p in params] if i < 0 else
+                     [obsX[i], obsY[i]] + [r[2][i] for r in results] for i in range(-1, len(obsX)))
+        writeRows(datapath, datatable)
+    if len(timeseries) > MANY and background and plotpath is not None and not plot:
+        plotInBackground(obsX, obsY, timeseries, plotpath, paramName, title, xlab, ylab, xlog, ylog, correctDatum)
+    elif len(timeseries) > MANY and ((plotpath is not None) or plot):
+        manyRatingCurves(obsX, obsY, timeseries, plot, plotpath, paramName, title, xlab, ylab, xlog, ylog,
+                         correctDatum)
+    elif (plotpath is not None) or plot:
         compareAllRatingCurves(obsX, obsY, timeseries, plot, plotpath, paramName, title, xlab, ylab, xlog, ylog,
                                correctDatum)
     return listTable
 
 
 def compareRatingCurve(flows, obs, sim, si=False):
+    import matplotlib.pyplot as plt
     plt.plot(flows, obs, label = "Observed")
     plt.plot(flows, sim, label = "Simulated")
     plt.xlabel("Flow (cfs)" if not si else "Flow (cms)")
@@ -128,6 +205,9 @@ def compareAllRatingCurves(x, obs, sims, display=True, path=None, paramName="n",
     :param path: where to save the plot, or None not to
     :param paramName: name of parameter (for legend)
     """
+    import matplotlib.pyplot as plt
+    from matplotlib.ticker import FormatStrFormatter
+
     def adjustDatum(sim):
         if not correctDatum:
             return sim
@@ -157,3 +237,96 @@ def compareAllRatingCurves(x, obs, sims, display=True, path=None, paramName="n",
     if display:
         plt.show()
 
+
+
+def decimate(count, maxPoints):
+    # Indices of at most maxPoints of count points, evenly spaced and including the first and last
+    if count <= maxPoints:
+        return np.arange(count)
+    return np.unique(np.linspace(0, count - 1, maxPoints).round().astype(int))
+
+def adjustDatums(obs, sims):
+    # Adjust the datum of each row of sims to obs, as in compareAllRatingCurves
+    count = len(obs) // 20 + 1  # Bottom 5%, +1 in case len(obs) < 20
+    low = np.sort(sims, axis=1)[:, :count].mean(axis=1)
+    return sims + (np.sort(obs)[:count].mean() - low)[:, None]
+
+def manyRatingCurves(x, obs, sims, display=False, path=None, paramName="n",
+                     title="Rating Curves Comparison", xlab="Flow (cfs)",
+                     ylab="Depth (ft)", xlog=True, ylog=True, correctDatum = False, maxPoints = 500, cmap = "viridis"):
+    """
+    Compare many rating curves: the simulated curves are drawn as a single line collection colored by parameter
+    value, with a colorbar instead of a legend, on their own figure.  Unless the plot is shown, it is rendered with
+    the Agg backend and nothing touches pyplot.  Arguments are as for compareAllRatingCurves, plus:
+    :param maxPoints: draw at most this many points of each curve (evenly spaced in order of x)
+    :param cmap: matplotlib colormap name
+    :return: the Figure
+    """
+    from matplotlib.collections import LineCollection
+    from matplotlib.colors import LogNorm, Normalize
+    from matplotlib.figure import Figure
+    order = np.argsort(np.asarray(x, dtype=float), kind="stable")
+    order = order[decimate(len(order), maxPoints)]
+    x = np.asarray(x, dtype=float)[order]
+    obs = np.asarray(obs, dtype=float)
+    params = np.array([sim[0] for sim in sims], dtype=float)
+    ys = np.array([sim[1] for sim in sims], dtype=float)
+    if correctDatum:
+        ys = adjustDatums(obs, ys)
+    ys = ys[:, order]
+    if display:
+        import matplotlib.pyplot as plt
+        fig = plt.figure()
+    else:
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        fig = Figure()
+        FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    # Log colors if the parameter spans more than an order of magnitude
+    norm = LogNorm(params.min(), params.max()) if params.min() > 0 and params.max() > 10 * params.min() else\
+        Normalize(params.min(), params.max())
+    lines = LineCollection(np.stack([np.broadcast_to(x, ys.shape), ys], axis=2), cmap=cmap, norm=norm,
+                           linewidths=0.8, alpha=0.7)
+    lines.set_array(params)
+    ax.add_collection(lines)
+    ax.plot(x, obs[order], color="black", linewidth=2, label="Observed")
+    ax.autoscale_view()
+    fig.colorbar(lines, ax=ax, label="Simulated (%s)" % paramName)
+    if xlog:
+        ax.set_xscale("log")
+    if ylog:
+        ax.set_yscale("log")
+    ax.set_xlabel(xlab)
+    ax.set_ylabel(ylab)
+    ax.set_title(("%s (%d simulations)" % (title, len(sims))).strip())
+    ax.legend()
+    if path is not None:
+        fig.savefig(path)
+    if display:
+        plt.show()
+        plt.close(fig)
+    return fig
+
+def renderPlot(*args):
+    # Target for plotInBackground, so that the figure isn't sent back to the parent process
+    manyRatingCurves(*args)
+
+def plotInBackground(x, obs, sims, path, paramName="n", title="Rating Curves Comparison", xlab="Flow (cfs)",
+                     ylab="Depth (ft)", xlog=True, ylog=True, correctDatum = False):
+    """
+    Save a plot of many rating curves (see manyRatingCurves) in a separate process, so that the caller doesn't
+    wait for it.  Call waitForPlots to wait for all of them to be written.  In a frozen executable, this relies on
+    main calling multiprocessing.freeze_support, without which the new process starts the application again.
+    :return: the multiprocessing.Process
+    """
+    sims = [(float(par), [float(y) for y in sim]) for (par, sim) in sims]
+    proc = multiprocessing.Process(target=renderPlot, args=(list(x), list(obs), sims, False, path, paramName, title,
+                                                             xlab, ylab, xlog, ylog, correctDatum))
+    proc.start()
+    background.append(proc)
+    return proc
+
+def waitForPlots():
+    # Wait for plots being rendered in the background (see plotInBackground)
+    while background:
+        background.pop().join()
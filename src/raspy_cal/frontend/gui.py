@@ -5,12 +5,11 @@ Copyright (C) 2020 Daniel Philippus
 Full copyright notice located in main.py.
 """
 
-from raspy_cal.frontend.input import autoIterate, singleStageFile, configSpecify
+from raspy_cal.frontend.input import autoIterate, singleStageFile, configSpecify, mkModel, closeModel
 from raspy_cal.midlevel.data import getUSGSData, prepareUSGSData
-from raspy_cal.midlevel.calibrators import nstageIteration
+from raspy_cal.midlevel.calibrators import nstageIteration, nstageRefine
 from raspy_cal.frontend.display import evalTable, csv, nDisplay
 from raspy_cal.midlevel.eval import tests
-from raspy_cal.default import Model
 from raspy_cal.settings import Settings
 import tkinter as tk
 from tkinter import filedialog
@@ -29,6 +28,7 @@ class GUI(tk.Frame):
         self.displayed = False
         self.master = master
         self.settings = settings
+        self.model = None
         self.pack()
         self.createWidgets()
 
@@ -41,11 +41,13 @@ class GUI(tk.Frame):
         self.usgs = self.usgsField.get()
         self.stagef = self.stageField.get()
         (self.flow, self.stage) = singleStageFile(self.stagef) if self.usgs == "" else\
-            prepareUSGSData(getUSGSData(self.usgs, period = 365 * 2))
+            prepareUSGSData(getUSGSData(self.usgs, period = 365 * 2, si = self.siInt.get() == 1,
+                                        cache = self.settings.usgscache))
         self.normalSlope = (lambda s: 0.001 if s == "" else float(s))(self.slopeField.get())
         self.fileN = (lambda n: "01" if n == "" else n)(self.fileNField.get())
 
         self.nct = int(self.nField.get())
+        self.workers = (lambda w: 1 if w == "" else int(w))(self.workersField.get())
         self.outf = self.outField.get()
         self.metrics = [key for key in self.keyChecks if self.keyChecks[key].get() == 1]
         self.plot = self.plotInt.get() == 1
@@ -70,7 +72,8 @@ class GUI(tk.Frame):
                 period=365*2,
                 correctDatum=self.datum,
                 si=self.si,
-                version=self.version)
+                version=self.version,
+                workers=self.workers)
 
         print("Parameters: %s" % [self.project, self.river, self.reach, self.rs, self.stagef,
                                   self.nct, self.outf, self.metrics, self.plot, self.datum])
@@ -83,9 +86,12 @@ class GUI(tk.Frame):
     def selectRunType(self, runType):
         # runType: "auto" or "manual"
         self.saveParameters()
-        self.model = Model(self.project, self.version)
-        self.model.params.setSteadyFlows(self.river, self.reach, rs=None, flows=self.flow, slope=self.normalSlope,
-                                         fileN=self.fileN)
+        if self.model is not None:
+            closeModel(self.model)
+        self.model = mkModel(self.settings,
+                             lambda model: model.params.setSteadyFlows(self.river, self.reach, rs=None,
+                                                                       flows=self.flow, slope=self.normalSlope,
+                                                                       fileN=self.fileN))
 
         self.entryFrame.pack_forget()
         self.buttonFrame.pack_forget()
@@ -110,11 +116,15 @@ class GUI(tk.Frame):
         self.nmaxEntry = tk.Entry(self.inputFrame)
         self.randVar = tk.IntVar()
         self.randCheck = tk.Checkbutton(self.inputFrame, text="Random n distribution?", variable=self.randVar)
+        self.refineVar = tk.IntVar()
+        self.refineCheck = tk.Checkbutton(self.inputFrame, text="Narrow the range automatically?",
+                                          variable=self.refineVar)
 
         fields = [
             ("Minimum n", self.nminEntry),
             ("Maximum n", self.nmaxEntry),
-            ("Randomize n", self.randCheck)
+            ("Randomize n", self.randCheck),
+            ("Refine n", self.refineCheck)
         ]
 
         for (ix, (name, field)) in enumerate(fields):
@@ -137,9 +147,17 @@ class GUI(tk.Frame):
         self.nmin = float(self.nminEntry.get())
         self.nmax = float(self.nmaxEntry.get())
         self.rand = self.randVar.get() == 1
-        self.result = nstageIteration(self.model, self.river, self.reach, self.rs, self.stage,
-                                      self.nct, self.rand, self.nmin, self.nmax, self.metrics,
-                                      self.datum)
+        if self.refineVar.get() == 1:
+            # Unattended sweeps narrowing the range (see nstageRefine), limited to the configured number of
+            # evaluations or ten sweeps' worth of simulations
+            budget = self.settings.evals if self.settings.evals is not None else 10 * self.nct
+            self.result = nstageRefine(self.model, self.river, self.reach, self.rs, self.stage,
+                                       self.nct, self.rand, self.nmin, self.nmax, self.metrics,
+                                       self.datum, budget=budget)
+        else:
+            self.result = nstageIteration(self.model, self.river, self.reach, self.rs, self.stage,
+                                          self.nct, self.rand, self.nmin, self.nmax, self.metrics,
+                                          self.datum)
         self.displayResult()
 
     def displayResult(self):
@@ -215,6 +233,7 @@ class GUI(tk.Frame):
         self.slopeField = tk.Entry(self.entryFrame, width=100)
         self.fileNField = tk.Entry(self.entryFrame, width=100)
         self.nField = tk.Entry(self.entryFrame, width=100)
+        self.workersField = tk.Entry(self.entryFrame, width=100)
         self.outField = tk.Entry(self.entryFrame, width=100)
         self.metricField = tk.Frame(self.entryFrame)
         self.plotField = tk.Checkbutton(self.entryFrame, text="Plot?", variable=self.plotInt)
@@ -229,6 +248,7 @@ class GUI(tk.Frame):
             "reach": self.reachField,
             "rs": self.rsField,
             "nct": self.nField,
+            "workers": self.workersField,
             "outf": self.outField,
             "filen": self.fileNField,
             "slope": self.slopeField,
@@ -271,6 +291,7 @@ class GUI(tk.Frame):
             ("Flow file number to write (e.g. 01, to overwrite <project>.f01)",
              self.fileNField),
             ("# Roughness coefficients to test per iteration", self.nField),
+            ("# Parallel HEC-RAS instances (default 1)", self.workersField),
             ("Output File Path", self.outField,
              browseButton(self.entryFrame, self.setVal(self.outField))),
             ("Metrics", self.metricField),
@@ -312,7 +333,11 @@ def main(settings):
     gui = GUI(mainframe, settings)
     mainframe.master.title("Raspy-Cal Calibrator")
     mainframe.pack()
-    gui.mainloop()
+    try:
+        gui.mainloop()
+    finally:
+        if gui.model is not None:
+            closeModel(gui.model)
 
 if __name__ == "__main__":
     main()
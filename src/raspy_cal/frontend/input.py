@@ -6,16 +6,27 @@ Full copyright notice located in main.py.
 """
 
 from raspy_cal.default import Model
-from raspy_cal.lowlevel import runSims
-from raspy_cal.midlevel.eval import evaluate, minimized, fullEval, tests, evaluator
+from raspy_cal.lowlevel import runSims, ModelPool, copyProject
+from raspy_cal.midlevel.eval import evaluate, minimized, combined, fullEval, tests, evaluator
 from raspy_cal.midlevel.params import paramSpec, genParams
-from raspy_cal.frontend.display import evalTable, compareAllRatingCurves, nDisplay
+from raspy_cal.frontend.display import evalTable, compareAllRatingCurves, nDisplay, EvaluationWriter, waitForPlots
 from raspy_cal.midlevel.data import getUSGSData, prepareUSGSData, singleStageFile
-from raspy_cal.midlevel.calibrators import nstageIteration, nstageSingleRun
+from raspy_cal.midlevel.calibrators import (nstageIteration, nstageRefine, nstageSingleRun, nstageSingleRunspec,
+                                            multiStageRunspec, multiStageEvaluator)
+from raspy_cal.midlevel.cache import SimCache
+from raspy_cal.midlevel.steadystate import steadyStateOptimize
+from raspy_cal.midlevel.checkpoint import Checkpoint
+from raspy_cal.midlevel.normal import loadNormalDepth, prescreen
+from raspy_cal.midlevel.store import SimulationStream, mkMeta
 from raspy_cal.settings import Settings
+from raspy_cal import timing
 
-from platypus import NSGAII, Problem, Real, nondominated # https://platypus.readthedocs.io/en/latest/getting-started.html#defining-constrained-problems
+# platypus, and the scipy-based engines, are imported by the engines that use them, so that the package loads quickly
 from urllib.request import urlopen
+import os
+import random
+import threading
+import tempfile
 
 
 def parseConfigText(text, parsers):
@@ -38,10 +49,20 @@ def parseConfigText(text, parsers):
             result[v] = parsers[v](stringvals[v])
     return result
 
-def configSpecify(confPath, settings = Settings(), run = True):
+def parseGages(text):
+    """
+    Parse the gages config value for multi-gage calibration.  Format: gages separated by ;, each one
+    name,river,reach,rs,stage file path.
+    :return: list of {"name", "river", "reach", "rs", "stagef"}
+    """
+    keys = ["name", "river", "reach", "rs", "stagef"]
+    return [dict(zip(keys, [i.strip() for i in gage.split(",")])) for gage in text.split(";") if gage.strip() != ""]
+
+def configSpecify(confPath, settings = Settings(), run = True, resume = None):
     """
     Parse all of the arguments for specify and run it.
     :param confPath: path to the config file, or None to return example config file format
+    :param resume: if specified, overrides the resume setting in the config file
     :return: config values or example file format
     """
     id = lambda x: x
@@ -67,7 +88,32 @@ def configSpecify(confPath, settings = Settings(), run = True):
         "startdate": id,
         "period": int,
         "si": toBool,
-        "datum": toBool
+        "datum": toBool,
+        "workers": int,
+        "cache": id,
+        "cachesize": float,
+        "engine": id,
+        "tol": float,
+        "starts": int,
+        "usgscache": id,
+        "usgsstat": id,
+        "checkpoint": id,
+        "checkpointevery": int,
+        "resume": toBool,
+        "timing": id,
+        "prescreen": toBool,
+        "nmin": float,
+        "nmax": float,
+        "sampling": id,
+        "logn": toBool,
+        "chunk": int,
+        "refine": toBool,
+        "refinefactor": float,
+        "refinetol": float,
+        "store": id,
+        "streamcsv": toBool,
+        "backgroundplot": toBool,
+        "gages": parseGages  # format: name,river,reach,rs,stage file;name,river,...
     }
     if confPath is not None:
         with open(confPath) as f:
@@ -80,7 +126,16 @@ def configSpecify(confPath, settings = Settings(), run = True):
                 evals=vals["evals"], metrics=vals["metrics"], fileN=vals["filen"], slope=vals["slope"],
                 usgs=vals["usgs"], flowcount=vals["flowcount"], enddate=vals["enddate"], startdate=vals["startdate"],
                 period=vals["period"], si=vals["si"], correctDatum=vals["datum"],
-                version=vals["version"]
+                version=vals["version"], workers=vals["workers"], cache=vals["cache"],
+                cachesize=vals["cachesize"], engine=vals["engine"],
+                tol=vals["tol"], starts=vals["starts"], gages=vals["gages"],
+                usgscache=vals["usgscache"], usgsstat=vals["usgsstat"],
+                checkpoint=vals["checkpoint"], checkpointevery=vals["checkpointevery"],
+                resume=vals["resume"] if resume is None else resume, timing=vals["timing"],
+                prescreen=vals["prescreen"], nmin=vals["nmin"], nmax=vals["nmax"],
+                sampling=vals["sampling"], logn=vals["logn"], chunk=vals["chunk"],
+                refine=vals["refine"], refinefactor=vals["refinefactor"], refinetol=vals["refinetol"],
+                store=vals["store"], streamcsv=vals["streamcsv"], backgroundplot=vals["backgroundplot"]
             )
             settings.interactive()
             return settings
@@ -110,33 +165,187 @@ flowcount: 100
 enddate: 2020-02-26
 startdate: 2019-02-28
 period: 500
+usgscache: C:\\PathToGageDataCache
+usgsstat: median
 si: False
+workers: 1
+cache: C:\\PathToCacheFile\\simcache.sqlite
+cachesize: 100
+engine: nsga2
+tol: 0.001
+starts: 1
+checkpoint: C:\\PathToOutputFile\\outfile.ckpt
+checkpointevery: 10
+resume: False
+timing: C:\\PathToOutputFile\\timing.jsonl
+prescreen: True
+# Range of n; either one overrides the prescreening proposal for that end of the range
+#nmin: 0.001
+#nmax: 1
+# Semi-manual ns: grid, random, lhs, sobol or halton; evenly in log n or not; simulate this many at a time
+sampling: grid
+logn: False
+chunk: 100
+# Unattended semi-manual mode: shrink the range by refinefactor each sweep, down to refinetol or evals simulations
+refine: False
+refinefactor: 0.5
+refinetol: 0.002
+# Directory to store every simulation in, for re-scoring later without HEC-RAS (see README)
+store: C:\\PathToOutputFile\\outfile-sims
+# Write each evaluation (n, metrics and simulated stages) to <output file>-evals.csv as it completes
+streamcsv: False
+# Save plots of many rating curves in a background process instead of waiting for them (when not plotting on screen)
+backgroundplot: False
+# For multi-gage calibration (replaces river, reach, rs and stagef): name,river,reach,rs,stage file;...
+# gages: F37B,Compton Creek,CC,23350.,C:\\Data\\F37B.csv;F45B,Rio Hondo Chnl,RHC,7000,C:\\Data\\F45B.csv
 """
 
 
+def mkModel(settings, setup=None):
+    """
+    Initialize the model for the settings: a single model, or a ModelPool of settings.workers instances each
+    running its own temporary copy of the project.
+    :param setup: optional function taking a new model to finish setting it up (e.g. set steady flows)
+    :return: model or ModelPool
+    """
+    def init(project):
+        model = Model(project, settings.version)
+        if setup is not None:
+            setup(model)
+        return model
+
+    if settings.workers is None or settings.workers <= 1:
+        return init(settings.project)
+    base = tempfile.mkdtemp(prefix="raspy_cal_")
+    return ModelPool(lambda ix: init(copyProject(settings.project, os.path.join(base, "worker%d" % ix))),
+                     settings.workers, base)
+
+
+def closeModel(model):
+    # Shut down a ModelPool from mkModel, removing its copies of the project; a single model needs nothing
+    if isinstance(model, ModelPool):
+        model.close()
+
+
+def mkCache(settings):
+    """
+    Open the simulation cache specified in the settings, if any, bound to the current project state.
+    Call after the model has been set up.
+    :return: SimCache or None
+    """
+    if settings.cache is None or settings.cache == "":
+        return None
+    maxBytes = (100 if settings.cachesize is None else settings.cachesize) * 2 ** 20
+    return SimCache(settings.cache, settings.project, maxBytes,
+                    extra=[settings.river, settings.reach, settings.flow, settings.slope])
+
+
+def mkStore(settings):
+    """
+    Open the simulation store specified in the settings, if any, recording the observations and settings needed
+    to re-score the simulations later (see midlevel.store).  Simulations already in the store are kept when
+    resuming.
+    :return: SimulationStream or None
+    """
+    if settings.store is None or settings.store == "":
+        return None
+    if settings.gages is not None:
+        (observed, locations) = ([gage["stage"] for gage in settings.gages],
+                                 [(gage["river"], gage["reach"], gage["rs"]) for gage in settings.gages])
+        names = [gage["name"] for gage in settings.gages]
+    else:
+        (observed, locations, names) = ([settings.stage], [(settings.river, settings.reach, settings.rs)], ["n"])
+    meta = mkMeta(settings.flow, observed, locations, names, correctDatum=bool(settings.datum),
+                  metrics=settings.metrics, si=bool(settings.si), project=settings.project)
+    return SimulationStream(settings.store, meta, append=bool(settings.resume))
+
+
+class RunOutputs(object):
+    """
+    Outputs written as each simulation completes, so that large runs produce results incrementally: the
+    simulation store (settings.store, see mkStore) and the evaluation CSV (settings.streamcsv, see
+    display.EvaluationWriter).
+    """
+    def __init__(self, settings, keys):
+        self.store = mkStore(settings)
+        self.evals = None
+        self.evalf = None
+        if settings.streamcsv and settings.outf:
+            gages = None if settings.gages is None else [gage["name"] for gage in settings.gages]
+            self.evals = EvaluationWriter(os.path.splitext(settings.outf)[0] + "-evals.csv", settings.flow, keys,
+                                          ["n"] if gages is None else ["n." + gage for gage in gages], gages,
+                                          settings.si, append=bool(settings.resume))
+            if gages is None:
+                self.evalf = evaluator(settings.stage, settings.datum, keys)
+
+    def record(self, params, sim, metrics=None):
+        """
+        :param params: n, or list of ns for multi-gage calibration
+        :param sim: simulated stages, or list of them for each gage
+        :param metrics: metrics of the simulation (as for EvaluationWriter.write), or None to evaluate it here
+        """
+        if self.store is not None:
+            self.store.append(params, sim)
+        if self.evals is not None:
+            self.evals.write(params, self.evalf(sim) if metrics is None else metrics, sim)
+
+    def close(self):
+        for out in [self.store, self.evals]:
+            if out is not None:
+                out.close()
+
+
 def run(settings):
     auto = settings.auto
-    if auto:
-        autoIterate(settings)
-    else:
-        iterate(settings)
+    if settings.timing is not None and settings.timing != "":
+        timing.enable()
+    try:
+        if settings.gages is not None:
+            multiAutoIterate(settings)
+        elif auto:
+            autoIterate(settings)
+        elif settings.refine:
+            refineIterate(settings)
+        else:
+            iterate(settings)
+    finally:
+        if timing.enabled:
+            # Report even if the run failed part way
+            print(timing.summary())
+            timing.dump(settings.timing)
+            timing.enable(False)
+        waitForPlots()
 
 
-def iterate(settings, model=None, rand=None):
+def iterate(settings, model=None, rand=None, cache=None):
     """
     Iterate over n options until the user narrows it down to a good choice.
     Note that providing an n of 0 will
     cause HEC-RAS to crash.
     :return: final ns
     """
-    model = Model(settings.project, settings.version) if model is None else model
+    if model is None:
+        model = mkModel(settings)
+        try:
+            return iterate(settings, model, rand, cache)
+        finally:
+            closeModel(model)
+    cache = mkCache(settings) if cache is None else cache
+    rand = settings.sampling if rand is None and settings.sampling is not None and settings.sampling != "" else rand
     rand = input("Enter Y to use random parameter generation: ") in ["y", "Y"]\
         if rand is None else rand
     plotpath = ".".join(settings.outf.split(".")[:-1]) + ".png"
+    proposed = prescreenRange(settings) if settings.prescreen else None
+    outputs = RunOutputs(settings, settings.metrics if settings.metrics is not None else list(tests.keys()))
     cont = True
     while cont:
-        nmin = float(input("Enter minimum n: "))
-        nmax = float(input("Enter maximum n: "))
+        if proposed is None:
+            nmin = float(input("Enter minimum n: "))
+            nmax = float(input("Enter maximum n: "))
+        else:
+            # Blank to use the prescreening proposal
+            nmin = float(input("Enter minimum n (blank for %.4f): " % proposed[0]) or proposed[0])
+            nmax = float(input("Enter maximum n (blank for %.4f): " % proposed[1]) or proposed[1])
         best = nstageIteration(model,
                                settings.river,
                                settings.reach,
@@ -147,67 +356,331 @@ def iterate(settings, model=None, rand=None):
                                nmin,
                                nmax,
                                settings.metrics,
-                               settings.datum)
+                               settings.datum,
+                               cache,
+                               log=bool(settings.logn),
+                               chunk=settings.chunk,
+                               record=outputs.record)
         # Show plot (if specified) but don't save anything
-        nDisplay(best, settings.flow, settings.stage, None, None,
-                 settings.plot, settings.datum, settings.si)
+        with timing.span("display"):
+            nDisplay(best, settings.flow, settings.stage, None, None,
+                     settings.plot, settings.datum, settings.si)
         cont = input("Continue?  Q or q to quit and write results: ")\
             not in ["q", "Q"]
         if not cont:
             # Save the plot and CSV
             nDisplay(best, settings.flow, settings.stage,
                      plotpath, settings.outf, False, settings.datum,
-                     settings.si)
+                     settings.si, bool(settings.backgroundplot))
+    outputs.close()
 
 
-def autoIterate(settings, model=None):
+def refineIterate(settings, model=None, cache=None):
     """
-    Automatically iterate with NSGA-II
+    Unattended version of iterate: sweeps of settings.nct ns, with the range shrinking by settings.refinefactor
+    around the best results after each sweep, until it is narrower than settings.refinetol or settings.evals
+    simulations have been run (see calibrators.nstageRefine).  The starting range is settings.nmin/nmax, the
+    prescreening proposal or NMIN to NMAX.  Results are written as for iterate.
+    :return: final results [(n, metrics, sim)]
     """
-    keys = settings.metrics  # ensure same order
-    evalf = evaluator(settings.stage,
-                      useTests=keys,
-                      correctDatum=settings.datum)
+    if model is None:
+        model = mkModel(settings)
+        try:
+            return refineIterate(settings, model, cache)
+        finally:
+            closeModel(model)
+    cache = mkCache(settings) if cache is None else cache
+    rand = settings.sampling if settings.sampling is not None and settings.sampling != "" else False
     plotpath = ".".join(settings.outf.split(".")[:-1]) + ".png"
-    count = 1
-    print("Running automatic calibration")
+    applyPrescreen(settings)
+    (nmin, nmax) = nRange(settings)
+
+    def report(sweep, lo, hi, results):
+        print("Sweep %d: %d results kept, next range %.4f to %.4f" % (sweep, len(results), lo, hi))
+        print(evalTable([r[0] for r in results], [r[1] for r in results]))
+
+    outputs = RunOutputs(settings, settings.metrics if settings.metrics is not None else list(tests.keys()))
+    best = nstageRefine(model, settings.river, settings.reach, settings.rs, settings.stage, settings.nct, rand,
+                        nmin, nmax, settings.metrics, settings.datum, cache,
+                        0.5 if settings.refinefactor is None else settings.refinefactor,
+                        0.002 if settings.refinetol is None else settings.refinetol,
+                        settings.evals, bool(settings.logn), report=report,
+                        record=outputs.record)
+    outputs.close()
+    with timing.span("display"):
+        nDisplay(best, settings.flow, settings.stage, plotpath, settings.outf, settings.plot, settings.datum,
+                 settings.si, bool(settings.backgroundplot))
+    return best
+
+
+# Range of n for automatic calibration
+NMIN = 0.001
+NMAX = 1
+
+
+def nRange(settings):
+    """
+    :return: (minimum n, maximum n) for automatic calibration: settings.nmin and settings.nmax where specified,
+        otherwise NMIN and NMAX
+    """
+    return (NMIN if settings.nmin is None else settings.nmin, NMAX if settings.nmax is None else settings.nmax)
+
+
+def prescreenRange(settings):
+    """
+    Propose a range of n by fitting the normal-depth approximation of the calibration cross-section to the
+    observations (see midlevel.normal).
+    :return: (minimum n, maximum n), or None if the cross-section could not be read
+    """
+    try:
+        normal = loadNormalDepth(settings.project, settings.river, settings.reach, settings.rs, settings.slope,
+                                 settings.si)
+    except (OSError, ValueError) as e:
+        print("Skipping normal-depth prescreening: %s" % e)
+        return None
+    (nmin, nmax, best) = prescreen(normal, settings.flow, settings.stage, settings.metrics, settings.datum,
+                                   NMIN, NMAX)
+    print("Normal-depth prescreening: best n %s, proposed range %.4f to %.4f" %
+          (", ".join("%.4f" % n for n in best[:5]), nmin, nmax))
+    return (nmin, nmax)
+
+
+def applyPrescreen(settings):
+    # If prescreening is on, fill in whichever of settings.nmin and settings.nmax aren't specified
+    if settings.prescreen and (settings.nmin is None or settings.nmax is None):
+        proposed = prescreenRange(settings)
+        if proposed is not None:
+            settings.nmin = proposed[0] if settings.nmin is None else settings.nmin
+            settings.nmax = proposed[1] if settings.nmax is None else settings.nmax
+
+
+def nsgaEngine(settings, objective, nobj, checkpoint):
+    """
+    Optimize with NSGA-II.  The population, evaluation count and random state are checkpointed after each
+    generation, and restored if checkpoint.state has them.
+    :param objective: function taking n and returning a list of nobj minimized metrics
+    :param checkpoint: midlevel.checkpoint.Checkpoint for the run
+    :return: list of non-dominated ns
+    """
+    # https://platypus.readthedocs.io/en/latest/getting-started.html#defining-constrained-problems
+    from platypus import NSGAII, Problem, Real, Solution, PlatypusConfig, nondominated
 
     def manningEval(vars):
         n = vars[0]
-        metrics = minimized(
-            nstageSingleRun(model,
-                            settings.river,
-                            settings.reach,
-                            settings.rs,
-                            settings.stage,
-                            n,
-                            keys,
-                            settings.datum)
-        )
-        values = [metrics[key] for key in keys]
         constraints = [-n, n - 1]
-        nonlocal count
-        print("Completed %d evaluations" % count)
-        count += 1
-        return values, constraints
+        return objective(n), constraints
     c_type = "<0"
-    # 1 decision variable, len(keys) objectives, and 2 constraints
-    problem = Problem(1, len(keys), 2)
-    problem.types[:] = Real(0.001, 1)  # range of decision variable
+    # 1 decision variable, nobj objectives, and 2 constraints
+    problem = Problem(1, nobj, 2)
+    problem.types[:] = Real(*nRange(settings))  # range of decision variable
     problem.constraints[:] = c_type
     problem.function = manningEval
 
     algorithm = NSGAII(problem, population_size=settings.nct)
-    algorithm.run(settings.evals)
+    resume = checkpoint.state.get("engineState")
+    if resume is not None:
+        algorithm.population = []
+        for (variables, objectives, constraints, violation) in resume["population"]:
+            sol = Solution(problem)
+            (sol.variables[:], sol.objectives[:], sol.constraints[:]) = (variables, objectives, constraints)
+            (sol.constraint_violation, sol.feasible, sol.evaluated) = (violation, violation == 0.0, True)
+            algorithm.population.append(sol)
+        algorithm.result = algorithm.population
+        algorithm.nfe = resume["nfe"]
+        algorithm.variator = PlatypusConfig.default_variator(problem)
+        random.setstate(resume["rng"])
+
+    def save(algorithm):
+        checkpoint.update(engineState={
+            "population": [(list(sol.variables), list(sol.objectives), list(sol.constraints),
+                            sol.constraint_violation) for sol in algorithm.population],
+            "nfe": algorithm.nfe,
+            "rng": random.getstate()
+        })
+        checkpoint.save()
+
+    algorithm.run(max(settings.evals - algorithm.nfe, 0), callback=save)
     # nondom: list of Solutions - wanted value is variables[0]
     nondom = nondominated(algorithm.result)
-    nondomNs = [sol.variables[0] for sol in nondom]
-    results = runSims(model, nondomNs, settings.river,
-                      settings.reach, len(settings.stage),
-                      range=[settings.rs])
-    resultPts = [(nondomNs[ix], [results[ix][settings.rs][jx] for jx in range(
-        1, len(settings.stage) + 1)]) for ix in range(len(nondomNs))]
-    metrics = [(res[0], evalf(res[1]), res[1]) for res in resultPts]
-    nDisplay(metrics, settings.flow, settings.stage, plotpath,
-             settings.outf, settings.plot, settings.datum, settings.si)
+    return [sol.variables[0] for sol in nondom]
+
+
+def surrogateEngine(settings, objective, nobj, checkpoint):
+    """
+    Optimize with a Gaussian process surrogate (see midlevel.surrogate), using at most settings.evals evaluations.
+    :return: list of non-dominated ns
+    """
+    from raspy_cal.midlevel.surrogate import surrogateOptimize
+    (evaluated, front) = surrogateOptimize(objective, *nRange(settings), settings.evals)
+    return [pt[0] for pt in front]
+
+
+def brentEngine(settings, objective, nobj, checkpoint):
+    """
+    Minimize a single metric with bounded Brent search in log n (see midlevel.scalar), using at most
+    settings.evals evaluations, tolerance settings.tol (log10 n) and settings.starts starting intervals.
+    :return: list of the best n
+    """
+    if nobj != 1:
+        raise ValueError("The brent engine requires exactly one metric")
+    from raspy_cal.midlevel.scalar import brentOptimize
+    (evaluated, best) = brentOptimize(lambda n: objective(n)[0], *nRange(settings), settings.evals,
+                                      1e-3 if settings.tol is None else settings.tol,
+                                      1 if settings.starts is None else settings.starts)
+    print("Best n %.4f found at evaluation %d of %d" % (best[0], evaluated.index(best) + 1, len(evaluated)))
+    return [best[0]]
+
+
+def asyncEngine(settings, objective, nobj, checkpoint):
+    """
+    Optimize with the asynchronous steady-state evolutionary algorithm (see midlevel.steadystate), with one
+    evaluation in flight per model instance (settings.workers), settings.evals evaluations and population size
+    settings.nct.
+    :return: list of non-dominated ns
+    """
+    workers = 1 if settings.workers is None or settings.workers < 1 else settings.workers
+    (evaluated, front, utilization) = steadyStateOptimize(objective, *nRange(settings), settings.evals, settings.nct,
+                                                          workers)
+    return [pt[0] for pt in front]
+
+
+# Automatic calibration engines by name: functions (settings, objective, number of objectives, checkpoint) -> list
+# of ns.  Engines other than NSGA-II resume by replaying from the start with the same random state, with completed
+# evaluations taken from the archive.
+engines = {
+    "nsga2": nsgaEngine,
+    "surrogate": surrogateEngine,
+    "brent": brentEngine,
+    "async": asyncEngine
+}
+
+
+def autoIterate(settings, model=None, cache=None):
+    """
+    Automatically iterate with the selected engine (settings.engine, default brent for one metric and NSGA-II
+    otherwise)
+    """
+    if model is None:
+        model = mkModel(settings)
+        try:
+            return autoIterate(settings, model, cache)
+        finally:
+            closeModel(model)
+    cache = mkCache(settings) if cache is None else cache
+    keys = settings.metrics if settings.metrics is not None else list(tests.keys())  # ensure same order
+    engine = settings.engine if settings.engine is not None and settings.engine != "" else\
+        "brent" if len(keys) == 1 else "nsga2"
+    if engine not in engines:
+        raise ValueError("Unknown calibration engine %s; options are %s" % (engine, list(engines.keys())))
+    applyPrescreen(settings)
+    runspec = nstageSingleRunspec(settings.river, settings.reach, settings.rs, len(settings.stage), cache)
+    evalf = evaluator(settings.stage,
+                      useTests=keys,
+                      correctDatum=settings.datum)
+    plotpath = ".".join(settings.outf.split(".")[:-1]) + ".png"
+    count = 1
+    lock = threading.Lock()  # some engines evaluate from several threads
+    # Evaluation archive: {n: (simulated stage, metrics)}, so results don't need to be re-simulated
+    archive = {}
+    checkpoint = Checkpoint(settings.checkpoint, 10 if settings.checkpointevery is None else settings.checkpointevery)
+    resumed = checkpoint.load() if settings.resume else None
+    if resumed is not None:
+        if resumed["engine"] != engine or resumed["keys"] != keys:
+            raise ValueError("Checkpoint %s is for engine %s with metrics %s" % (settings.checkpoint,
+                                                                                resumed["engine"], resumed["keys"]))
+        (archive, count) = (resumed["archive"], resumed["count"])
+        random.setstate(resumed["rng0"])
+        print("Resuming from %d completed evaluations" % (count - 1))
+    else:
+        checkpoint.update(engine=engine, keys=keys, archive=archive, count=count, rng0=random.getstate(),
+                          engineState=None)
+    outputs = RunOutputs(settings, keys)
+    print("Running automatic calibration (%s)" % engine)
+
+    def objective(n):
+        if n in archive:  # already evaluated before resuming
+            metrics = minimized(archive[n][1])
+            return [metrics[key] for key in keys]
+        with timing.span("evaluation"):
+            sim = runspec(model, {"n": n})
+            result = (sim, evalf(sim))
+            metrics = minimized(result[1])
+        nonlocal count
+        outputs.record(n, sim, result[1])
+        with lock:
+            archive[n] = result
+            print("Completed %d evaluations" % count)
+            count += 1
+            checkpoint.update(count=count)
+            checkpoint.evaluated()
+        return [metrics[key] for key in keys]
+
+    with timing.span("engine"):
+        nondomNs = engines[engine](settings, objective, len(keys), checkpoint)
+    checkpoint.save()
+    outputs.close()
+    if cache is not None:
+        print(cache.stats())
+    metrics = [(n, archive[n][1], archive[n][0]) for n in nondomNs]
+    with timing.span("display"):
+        nDisplay(metrics, settings.flow, settings.stage, plotpath,
+                 settings.outf, settings.plot, settings.datum, settings.si, bool(settings.backgroundplot))
     return metrics
+
+
+def multiAutoIterate(settings, model=None):
+    """
+    Automatically calibrate separate ns for several gages (settings.gages) with NSGA-II, running HEC-RAS
+    once per candidate set of ns.  There is one objective per gage, its metrics combined into a single score
+    (see eval.combined), so that the number of objectives doesn't grow with the number of metrics.  Results are written per gage, to
+    the output path with the gage name appended.
+    :return: list of (ns, [metrics dictionary for each gage], [simulated stage for each gage]) on the Pareto front
+    """
+    from platypus import NSGAII, Problem, Real, nondominated
+    if model is None:
+        model = mkModel(settings)
+        try:
+            return multiAutoIterate(settings, model)
+        finally:
+            closeModel(model)
+    keys = settings.metrics if settings.metrics is not None else list(tests.keys())  # ensure same order
+    gages = settings.gages
+    locations = [(gage["river"], gage["reach"], gage["rs"]) for gage in gages]
+    runspec = multiStageRunspec(locations, len(gages[0]["stage"]))
+    evalf = multiStageEvaluator([gage["stage"] for gage in gages], keys, settings.datum)
+    count = 1
+    # Evaluation archive: {ns: (simulated stages, metrics)}
+    archive = {}
+    outputs = RunOutputs(settings, keys)
+    print("Running multi-gage automatic calibration for %s" % [gage["name"] for gage in gages])
+
+    def manningEval(vars):
+        ns = tuple(vars)
+        with timing.span("evaluation"):
+            sims = runspec(model, {"n": ns})
+            archive[ns] = (sims, evalf(sims))
+        outputs.record(ns, sims, archive[ns][1])
+        nonlocal count
+        print("Completed %d evaluations" % count)
+        count += 1
+        return [combined(m, gage["stage"]) for (m, gage) in zip(archive[ns][1], gages)]
+
+    # One decision variable and one objective per gage
+    problem = Problem(len(gages), len(gages))
+    problem.types[:] = Real(*nRange(settings))
+    problem.function = manningEval
+    algorithm = NSGAII(problem, population_size=settings.nct)
+    with timing.span("engine"):
+        algorithm.run(settings.evals)
+    outputs.close()
+    nondomNs = [tuple(sol.variables) for sol in nondominated(algorithm.result)]
+    results = [(ns, archive[ns][1], archive[ns][0]) for ns in nondomNs]
+    (stem, ext) = os.path.splitext(settings.outf)
+    for (ix, gage) in enumerate(gages):
+        print("Gage %s:" % gage["name"])
+        path = "%s-%s%s" % (stem, gage["name"], ext)
+        with timing.span("display"):
+            nDisplay([(res[0][ix], res[1][ix], res[2][ix]) for res in results], gage["flow"], gage["stage"],
+                     os.path.splitext(path)[0] + ".png", path, settings.plot, settings.datum, settings.si,
+                     bool(settings.backgroundplot))
+    return results
@@ -6,81 +6,446 @@ Copyright (C) 2020 Daniel Philippus
 Full copyright notice located in main.py.
 """
 
+import os
+import queue
+import shutil
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+from raspy_cal import timing
+
 STAGE = 0
 VELOCITY = 1
 ALL = -1
 
-def runSims(model, mannings, river, reach, nprofs, range = None, retrieve = STAGE, log = True):
+# Ranges of at least this many stations are retrieved with one call for the whole reach (see bulkData)
+BULK = 2
+
+class StationTable(object):
+    """
+    Columnar results for one simulation: a (stations x profiles) array, with index maps from river station and
+    profile number (from 1) to row and column.  For retrieve = ALL, the array holds the flow data objects.
+    """
+    def __init__(self, values, stations, profiles):
+        self.values = values
+        self.stations = list(stations)
+        self.profiles = list(profiles)
+        self.index = {rs: ix for (ix, rs) in enumerate(self.stations)}
+        self.profileIndex = {prof: ix for (ix, prof) in enumerate(self.profiles)}
+
+    def row(self, rs):
+        # Results by profile at a river station
+        return self.values[self.index[rs]]
+
+    def at(self, rs, profile):
+        return self.values[self.index[rs], self.profileIndex[profile]]
+
+    def toDict(self):
+        """
+        :return: results in the nested format of the model API, {rs: {profile: value}}, or {rs: value} for a single
+            profile
+        """
+        values = self.values.tolist()
+        if len(self.profiles) == 1:
+            return {rs: values[ix][0] for (ix, rs) in enumerate(self.stations)}
+        return {rs: dict(zip(self.profiles, values[ix])) for (ix, rs) in enumerate(self.stations)}
+
+    @classmethod
+    def fromDict(cls, data, nprofs, dtype=float):
+        # Build from the nested format (see toDict)
+        stations = list(data.keys())
+        profiles = list(range(1, nprofs + 1))
+        values = np.array([[data[rs][prof] for prof in profiles] if nprofs > 1 else [data[rs]] for rs in stations],
+                          dtype=dtype)
+        return cls(values, stations, profiles)
+
+def matchStations(available, wanted):
+    """
+    Map requested river stations to the station names returned by the model, which may be formatted differently
+    (e.g. "23350" and "23350.").
+    :return: list of names from available, one per wanted
+    """
+    out = []
+    numeric = {}
+    for name in available:
+        try:
+            numeric.setdefault(float(str(name).strip().rstrip("*")), name)
+        except ValueError:
+            pass
+    for rs in wanted:
+        if rs in available:
+            out.append(rs)
+            continue
+        try:
+            out.append(numeric[float(str(rs).strip().rstrip("*"))])
+        except (ValueError, KeyError):
+            raise KeyError("River station %s not in the model results" % rs)
+    return out
+
+def bulkData(model, river, reach, nprofs, stations = None, retrieve = STAGE):
+    """
+    Retrieve results for every requested station and profile with a single model API call for the whole reach,
+    instead of one call per station.
+    :param stations: list of river stations, or None for all stations in the reach
+    :return: StationTable with the stations in the order of stations (named as in stations)
+    """
+    func = model.data.stage if retrieve == STAGE else model.data.velocity if retrieve == VELOCITY else\
+        model.data.allFlow
+    data = func(river, reach, None, nprofs)
+    stations = list(data.keys()) if stations is None else list(stations)
+    names = matchStations(list(data.keys()), stations)
+    profiles = list(range(1, nprofs + 1))
+    values = np.array([[data[name][prof] for prof in profiles] if nprofs > 1 else [data[name]] for name in names],
+                      dtype=float if retrieve != ALL else object)
+    return StationTable(values, stations, profiles)
+
+def canPoll(model):
+    # Whether the model API can report compute progress (optional ops.computing(), see README.md)
+    return callable(getattr(model.ops, "computing", None))
+
+def compute(model, poll = 0.05):
+    """
+    Compute and wait for it to finish.  If the model can report progress, this starts the computation without
+    waiting and polls instead, so that other threads get to run in the meantime.  The polling interval is a tenth of
+    the time so far, up to poll seconds, so that waiting adds at most about 10% to quick computations.
+    """
+    if canPoll(model):
+        start = time.perf_counter()
+        model.ops.compute(wait = False)
+        while model.ops.computing():
+            time.sleep(min(max((time.perf_counter() - start) / 10, 0.0001), poll))
+    else:
+        model.ops.compute(wait = True)
+
+def extract(model, river, reach, nprofs, range = None, retrieve = STAGE, columnar = False):
+    # Retrieve the results of the latest simulation (see runSims)
+    if columnar or (range is not None and len(range) >= BULK):
+        table = bulkData(model, river, reach, nprofs, range, retrieve)
+        return table if columnar else table.toDict()
+    # Below is repetitive, but it would introduce a lot of extra complexity to make it work as a function, I think
+    if retrieve == STAGE:
+        if range is None:
+            return model.data.stage(river, reach, None, nprofs)
+        else:
+            return {rs: model.data.stage(river, reach, rs, nprofs) for rs in range}
+    elif retrieve == VELOCITY:
+        if range is None:
+            return model.data.velocity(river, reach, None, nprofs)
+        else:
+            return {rs: model.data.velocity(river, reach, rs, nprofs) for rs in range}
+    else:
+        if range is None:
+            return model.data.allFlow(river, reach, None, nprofs)
+        else:
+            return {rs: model.data.allFlow(river, reach, rs, nprofs) for rs in range}
+
+def runSingle(model, n, river, reach, nprofs, range = None, retrieve = STAGE, columnar = False):
+    """
+    Run one simulation and return the data.  Arguments are as in runSims, but for a single n.
+    """
+    with timing.span("modifyN"):
+        model.params.modifyN(n, river, reach)
+    with timing.span("compute"):
+        model.ops.compute(wait = True)
+    with timing.span("extract"):
+        return extract(model, river, reach, nprofs, range, retrieve, columnar)
+
+def runSims(model, mannings, river, reach, nprofs, range = None, retrieve = STAGE, log = True, cache = None,
+            post = None, pipeline = False, columnar = False):
     """
     Run simulations and return the data.
-    :param model: model API, already initialized appropriately
+    :param model: model API, already initialized appropriately, or a ModelPool to spread the simulations across
+        its model instances
     :param mannings: list of Manning's n to test.  Each n can be a dictionary, list, or number -- see README.
     :param river: river to test
     :param reach: reach to test
     :param nprofs: number of flow profiles
     :param range: list of river stations to use, if specified.  Otherwise, the whole reach
     :param retrieve: STAGE, VELOCITY or ALL (0, 1, -1 respectively).  What data to retrieve.
-    :return: list of the result data in order of the params used
+    :param cache: optional midlevel.cache.SimCache to look up and store stages (used if retrieving STAGE for
+        a range)
+    :param post: optional function (n, result data) -> processed result, applied to each result
+    :param pipeline: overlap each simulation with the cache lookups for upcoming ns and the cache writes and post
+        processing of the previous one (see runPipelined).  Ignored for a ModelPool.
+    :param columnar: return each result as a StationTable (stations x profiles array) rather than nested
+        dictionaries.  Either way, a range of several stations is retrieved with one call per simulation.
+    :return: list of the result data (processed by post, if given) in order of the params used
     """
-    out = []
     count = 1
-    for n in mannings:
+    useCache = cache is not None and retrieve == STAGE and range is not None
+
+    def fromCache(n):
+        # Cached result in the runSingle format, or None if any station is missing
+        result = {}
+        with timing.span("cache.get"):
+            for rs in range:
+                stages = cache.get(river, reach, rs, nprofs, n)
+                if stages is None:
+                    return None
+                result[rs] = {ix + 1: st for (ix, st) in enumerate(stages)} if nprofs > 1 else stages[0]
+        return StationTable.fromDict(result, nprofs) if columnar else result
+
+    def toCache(n, result):
+        with timing.span("cache.put"):
+            for rs in range:
+                if columnar:
+                    stages = result.row(rs).tolist()
+                else:
+                    stages = [result[rs][prof] for prof in sorted(result[rs])] if nprofs > 1 else [result[rs]]
+                cache.put(river, reach, rs, nprofs, n, stages)
+    lock = threading.Lock()
+
+    def finish(n, result, fresh):
+        # Store and post-process a result; fresh if it was just simulated
+        nonlocal count
+        if fresh and useCache:
+            toCache(n, result)
+        if fresh and log:
+            with lock:
+                print("Completed %d simulations" % count)
+                count += 1
+        if post is None:
+            return result
+        with timing.span("post"):
+            return post(n, result)
+
+    def run(model, n):
+        if useCache:
+            result = fromCache(n)
+            if result is not None:
+                return finish(n, result, False)
         if log:
             print("Running iteration")
-        model.params.modifyN(n, river, reach)
-        model.ops.compute(wait = True)
-        # Below is repetitive, but it would introduce a lot of extra complexity to make it work as a function, I think
-        if retrieve == STAGE:
-            if range is None:
-                out.append(model.data.stage(river, reach, None, nprofs))
-            else:
-                out.append({rs: model.data.stage(river, reach, rs, nprofs) for rs in range})
-        elif retrieve == VELOCITY:
-            if range is None:
-                out.append(model.data.velocity(river, reach, None, nprofs))
-            else:
-                out.append({rs: model.data.velocity(river, reach, rs, nprofs) for rs in range})
-        else:
-            if range is None:
-                out.append(model.data.allFlow(river, reach, None, nprofs))
-            else:
-                out.append({rs: model.data.allFlow(river, reach, rs, nprofs) for rs in range})
-        if log:
-            print("Completed %d simulations" % count)
-            count += 1
-    return out
+        return finish(n, runSingle(model, n, river, reach, nprofs, range, retrieve, columnar), True)
+
+    if isinstance(model, ModelPool):
+        return model.map(run, mannings)
+    if pipeline:
+        return runPipelined(model, mannings, river, reach, nprofs, range, retrieve, log,
+                            fromCache if useCache else None, finish, columnar=columnar)
+    return [run(model, n) for n in mannings]
+
+
+def runPipelined(model, mannings, river, reach, nprofs, range, retrieve, log, lookup, finish, depth = 2,
+                 columnar = False):
+    """
+    Run simulations in a three-stage pipeline: a background thread looks up upcoming ns (e.g. in the cache),
+    keeping up to depth of them prepared; the calling thread sets n, computes and retrieves the results; and a
+    second background thread finishes each result (cache writes, post processing) while the next one computes.
+    All model API calls stay on the calling thread, in the same order as runSingle, so the model sees the same
+    sequence of operations.  If the model can report compute progress (see compute), it is polled rather than
+    blocking, which lets the background threads run during the computation.  An n repeated in mannings is only
+    simulated once: since it is looked up ahead of time, before the first result is stored, later repeats are
+    taken from the first result.
+    :param lookup: function n -> stored result or None, or None to simulate every n
+    :param finish: function (n, result, fresh) -> final result, where fresh is whether it was just simulated
+    :return: list of final results in order of mannings
+    """
+    results = [None] * len(mannings)
+    prepared = queue.Queue(depth)
+    finished = queue.Queue(depth)
+    errors = []
+    simulated = {}  # {repr(n): result} for ns simulated here
+
+    def prepare():
+        try:
+            for (ix, n) in enumerate(mannings):
+                prepared.put((ix, n, lookup(n) if lookup is not None else None))
+        except Exception as e:
+            errors.append(e)
+        prepared.put(None)
+
+    def complete():
+        while True:
+            item = finished.get()
+            if item is None:
+                break
+            (ix, n, result, fresh) = item
+            if errors:
+                continue  # drain so the calling thread doesn't block
+            try:
+                results[ix] = finish(n, result, fresh)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=prepare, daemon=True), threading.Thread(target=complete, daemon=True)]
+    for thread in threads:
+        thread.start()
+    try:
+        while not errors:
+            item = prepared.get()
+            if item is None:
+                break
+            (ix, n, result) = item
+            if result is None:
+                result = simulated.get(repr(n))
+            if result is not None:
+                finished.put((ix, n, result, False))
+                continue
+            if log:
+                print("Running iteration")
+            with timing.span("modifyN"):
+                model.params.modifyN(n, river, reach)
+            with timing.span("compute"):
+                compute(model)
+            with timing.span("extract"):
+                result = extract(model, river, reach, nprofs, range, retrieve, columnar)
+            simulated[repr(n)] = result
+            finished.put((ix, n, result, True))
+    finally:
+        finished.put(None)
+        threads[1].join()
+        while threads[0].is_alive():  # unblock the lookup thread if stopping early
+            try:
+                prepared.get(timeout=0.1)
+            except queue.Empty:
+                pass
+    if errors:
+        raise errors[0]
+    return results
 
 
 def runMultiSim(model, mannings, rivers, reaches, nprofs, ranges = None, log = True):
     """
     Run one simulation of multiple roughness coefficients at different locations
-    and return the results.  Intended for use with automatic calibration.
-    :param model: model API, already initialized
+    and return the results.  Intended for use with automatic calibration.  Since n is set by reach,
+    each location should be on a different reach.
+    :param model: model API, already initialized, or a ModelPool to run on the next free instance
     :param mannings: list of Manning's n, corresponding to river/reach locations
     :param rivers: list of rivers
     :param reaches: list of reaches
     :param nprofs: number of flow profiles
     :param ranges: list of ranges of river stations to use, if specified. Otherwise, the whole reach
     :param log: log successful iteration or not
-    :return: dictionary of {river: {reach: [n, [stages]]}} or {river: {reach: {rs: [n, [stages]]}}}
+    :return: dictionary of {river: {reach: [n, [stages]]}} or {river: {reach: {rs: [n, [stages]]}}}.  Stations
+        on the same reach are retrieved together (see bulkData).
     """
+    if isinstance(model, ModelPool):
+        return model.submit(runMultiSim, mannings, rivers, reaches, nprofs, ranges, log).result()
     if log:
         print("Running multi-n iteration")
-    for (ix, n) in enumerate(mannings):
-        model.params.modifyN(n, rivers[ix], reaches[ix])
-    model.ops.compute(wait=True)
+    with timing.span("modifyN"):
+        for (ix, n) in enumerate(mannings):
+            model.params.modifyN(n, rivers[ix], reaches[ix])
+    with timing.span("compute"):
+        model.ops.compute(wait=True)
     out = {}
+    # Requested stations by reach, so that each reach is retrieved once
+    wanted = {}
     for (ix, river) in enumerate(rivers):
-        reach = reaches[ix]
-        n = mannings[ix]
-        rng = ranges[ix] if ranges is not None else None
-        if not river in out:
-            out[river] = {}
-        if rng is not None:
-            for rs in rng:
-                out[river][reach][rs] = [n, model.data.stage(river, reach, rs, nprofs)]
-        else:
-            out[river][reach] = [n, model.data.stage(river, reach, None, nprofs)]
+        if ranges is not None and ranges[ix] is not None:
+            stations = wanted.setdefault((river, reaches[ix]), [])
+            stations += [rs for rs in ranges[ix] if rs not in stations]
+    with timing.span("extract"):
+        tables = {key: extract(model, key[0], key[1], nprofs, stations) for (key, stations) in wanted.items()}
+        for (ix, river) in enumerate(rivers):
+            reach = reaches[ix]
+            n = mannings[ix]
+            rng = ranges[ix] if ranges is not None else None
+            if not river in out:
+                out[river] = {}
+            if rng is not None:
+                if not reach in out[river]:
+                    out[river][reach] = {}
+                for rs in rng:
+                    out[river][reach][rs] = [n, tables[(river, reach)][rs]]
+            else:
+                out[river][reach] = [n, model.data.stage(river, reach, None, nprofs)]
     return out
 
 
+def copyProject(projectPath, dest):
+    """
+    Copy the directory containing a HEC-RAS project so that another model instance can run it independently.
+    :param projectPath: path to the project (.prj) file
+    :param dest: directory to copy the project into (must not exist yet)
+    :return: path to the copied project file
+    """
+    shutil.copytree(os.path.dirname(os.path.abspath(projectPath)), dest)
+    return os.path.join(dest, os.path.basename(projectPath))
+
+
+class ModelPool(object):
+    """
+    A set of independent model instances, each served by its own thread, for running several simulations at once.
+    Each instance is created on its worker thread by factory(index), so COM-based backends are initialized in the
+    thread that uses them.  Each instance should use its own copy of the project (see copyProject).
+
+    A ModelPool can be passed as the model to runSims (and anything built on it), which will then spread the ns
+    across the instances and return the results in the original order.
+    """
+    def __init__(self, factory, workers, base=None):
+        """
+        :param factory: function taking the worker index and returning an initialized model API
+        :param workers: number of model instances
+        :param base: optional directory holding the instances' copies of the project, removed by close
+        """
+        self.workers = workers
+        self.base = base
+        self.tasks = queue.Queue()
+        self.threads = [threading.Thread(target=self.serve, args=(ix, factory), daemon=True)
+                        for ix in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def serve(self, ix, factory):
+        # COM must be initialized in each thread that uses it; pythoncom is only available with pywin32
+        try:
+            import pythoncom
+        except ImportError:
+            pythoncom = None
+        if pythoncom is not None:
+            pythoncom.CoInitialize()
+        try:
+            model = factory(ix)
+            error = None
+        except Exception as e:
+            model = None
+            error = e
+        try:
+            while True:
+                task = self.tasks.get()
+                if task is None:
+                    break
+                (func, args, future) = task
+                if error is not None:
+                    future.set_exception(error)
+                    continue
+                try:
+                    future.set_result(func(model, *args))
+                except Exception as e:
+                    future.set_exception(e)
+        finally:
+            model = None  # release the COM objects before uninitializing
+            if pythoncom is not None:
+                pythoncom.CoUninitialize()
+
+    def submit(self, func, *args):
+        """
+        Run func(model, *args) on the next free model instance.
+        :return: a concurrent.futures.Future for the result
+        """
+        future = Future()
+        future.set_running_or_notify_cancel()
+        self.tasks.put((func, args, future))
+        return future
+
+    def map(self, func, items):
+        """
+        Run func(model, item) for each item across the model instances.
+        :return: list of results in the order of items
+        """
+        futures = [self.submit(func, item) for item in items]
+        return [future.result() for future in futures]
+
+    def close(self):
+        # Stop the worker threads once outstanding tasks are done, then remove the project copies.
+        for _ in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.base is not None:
+            shutil.rmtree(self.base, ignore_errors=True)
@@ -18,9 +18,7 @@ This program is free software: you can redistribute it and/or modify
 """
 
 
-from raspy_cal.frontend.input import configSpecify, run
-from raspy_cal.frontend import gui
-from raspy_cal.settings import Settings
+import multiprocessing
 from sys import argv
 
 msg = """Raspy-Cal interactive command-line interface.
@@ -35,6 +33,11 @@ Note: in order to run somewhat more economically, you can use:
 python raspy_cal/main.py <project path> <stage file path> <output file path>.
 Alternatively, to use a config file, run: `python main.py <config file path>`
 or `raspy-cal.exe <config file path>`.
+To resume an interrupted automatic calibration from its checkpoint, add --resume after the config file path.
+To calibrate many gages without console input, run: `python main.py BATCH <directory or manifest of config files>`
+(options: --out <output directory>, --workers <number of simultaneous jobs>, --force to rerun complete jobs).
+To re-score simulations stored during a run (store setting) with other metrics, without HEC-RAS, run:
+`python main.py RESCORE <store> [--metrics r2,rmse] [--datum | --no-datum] [--out <output file path>]`.
 """
 
 """
@@ -55,11 +58,28 @@ locs = {
 basepath = "V:\\LosAngelesProjectsData\\HEC-RAS\\raspy_cal\\"  # for testing
 
 def run():
+    # Everything is imported as needed, so that help, batch and re-scoring start without loading the calibration
+    # modules, and the GUI (tkinter) is only loaded when it is used
+    # In a frozen executable, worker processes (batch jobs, background plots) start here: run the worker instead
+    multiprocessing.freeze_support()
+    if len(argv) == 2 and argv[1].lower() in ["h", "-h", "help", "--help"]:
+        print(msg)
+        return
+    if len(argv) >= 3 and argv[1] == "BATCH":
+        # Headless batch of config files: BATCH <directory or manifest> [--out dir] [--workers n] [--force]
+        from raspy_cal import batch  # not imported with the package, so that python -m raspy_cal.batch works cleanly
+        return batch.main(argv[2:])
+    if len(argv) >= 3 and argv[1] == "RESCORE":
+        # Re-score stored simulations: RESCORE <store> [--metrics a,b] [--datum | --no-datum] [--out path] ...
+        from raspy_cal import rescore
+        return rescore.main(argv[2:])
+    from raspy_cal.frontend.input import configSpecify, run as runSettings
+    from raspy_cal.settings import Settings
     settings = Settings()
     if len(argv) == 4:
         settings.specify(project=argv[1], stagef=argv[2], outf=argv[3])
         settings.interactive()
-        run(settings)
+        runSettings(settings)
     # elif len(argv) == 2:  # for testing
     #     if argv[1] == "LAR":  # Test with LA project
     #         gage = input("Gage (F37B, F45B, F300, F319): ")
@@ -97,18 +117,22 @@ def run():
     elif len(argv) == 2:
         if argv[1] == "CMD":
             settings.interactive()
-            run(settings)
-        elif argv[1].lower() in ["h", "-h", "help", "--help"]:
-            print(msg)
+            runSettings(settings)
         else:
             settings = configSpecify(argv[1], settings)
-            run(settings)
+            runSettings(settings)
+    elif len(argv) == 3 and argv[2] in ["--resume", "RESUME"]:
+        # Resume automatic calibration from the checkpoint file given in the config file
+        settings = configSpecify(argv[1], settings, resume=True)
+        runSettings(settings)
     else:
         print("Run python main.py <config file path> or raspy-cal.exe <config file path> to load a config file \
     in the command line version. \
     Run python main.py CMD or raspy-cal.exe CMD to use the command line version.")
+        from raspy_cal.frontend import gui
         gui.main(settings)
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     run()
\ No newline at end of file
@@ -0,0 +1,153 @@
+"""
+Persistent on-disk cache of simulated stages, so that a given n is only simulated once for a given project
+state, including across runs.
+
+Copyright (C) 2020 Daniel Philippus
+Full copyright notice located in main.py.
+"""
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+from array import array
+
+# Manning's n is rounded to this many decimal places in the cache key
+NDIGITS = 4
+
+# Geometry (.g01), plan (.p01) and steady flow (.f01) files
+projectFiles = re.compile(r"\.[gpf]\d\d$", re.IGNORECASE)
+
+
+def stripManning(text):
+    """
+    Remove Manning's n blocks from the text of a geometry file, since these are overwritten by every
+    simulation and so should not count towards the project state.
+    """
+    out = []
+    inMann = False
+    for line in text.split("\n"):
+        if line.startswith("#Mann="):
+            inMann = True
+            continue
+        if inMann and "=" not in line:
+            continue
+        inMann = False
+        out.append(line)
+    return "\n".join(out)
+
+
+def projectDigest(projectPath, extra=None):
+    """
+    Hash the state of a HEC-RAS project: the project file and the geometry, plan and flow files alongside it
+    (geometry files without Manning's n).
+    :param projectPath: path to the project (.prj) file
+    :param extra: anything else JSON-serializable to include in the hash, e.g. the flows that will be set
+    :return: hex digest
+    """
+    folder = os.path.dirname(os.path.abspath(projectPath))
+    stem = os.path.splitext(os.path.basename(projectPath))[0]
+    digest = hashlib.sha256()
+    paths = [projectPath] + sorted(os.path.join(folder, f) for f in os.listdir(folder)
+                                   if f.startswith(stem + ".") and projectFiles.search(f))
+    for path in paths:
+        with open(path, errors="replace") as f:
+            text = f.read()
+        if re.search(r"\.g\d\d$", path, re.IGNORECASE):
+            text = stripManning(text)
+        digest.update(os.path.basename(path).encode("utf-8"))
+        digest.update(text.encode("utf-8"))
+    if extra is not None:
+        digest.update(json.dumps(extra, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def roundN(n):
+    # Round n (number, list or dictionary - see README) for use in the key.
+    if isinstance(n, dict):
+        return {str(k): roundN(v) for (k, v) in n.items()}
+    elif isinstance(n, (list, tuple)):
+        return [roundN(v) for v in n]
+    else:
+        return round(float(n), NDIGITS)
+
+
+class SimCache(object):
+    """
+    SQLite-backed cache of simulated stage vectors keyed by project state, location, profile count and n.
+    Least recently used entries are evicted once the stored values exceed maxBytes.  Safe to share between
+    the threads of a ModelPool.
+    """
+    def __init__(self, path, project=None, maxBytes=100 * 2 ** 20, extra=None):
+        """
+        :param path: path to the SQLite database file (created if needed)
+        :param project: project path to bind to (see bind), or None to bind later
+        :param maxBytes: maximum total size of stored stage vectors
+        :param extra: see bind
+        """
+        self.path = path
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        self.digest = None
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS sims (key TEXT PRIMARY KEY, value BLOB, size INTEGER, used INTEGER)")
+        self.conn.commit()
+        (self.size, self.clock) = self.conn.execute("SELECT COALESCE(SUM(size), 0), COALESCE(MAX(used), 0) FROM sims").fetchone()
+        if project is not None:
+            self.bind(project, extra)
+
+    def bind(self, project, extra=None):
+        """
+        Set the project state for subsequent lookups.  Call after anything that modifies the project other than
+        Manning's n (e.g. setting steady flows).
+        :param project: path to the project (.prj) file
+        :param extra: anything else that affects results and is not in the project files, e.g. flows
+        """
+        self.digest = projectDigest(project, extra)
+
+    def key(self, river, reach, rs, nprofs, n):
+        return hashlib.sha256(json.dumps([self.digest, river, reach, rs, nprofs, roundN(n)]).encode("utf-8")).hexdigest()
+
+    def get(self, river, reach, rs, nprofs, n):
+        """
+        :return: list of simulated stages by profile, or None if not cached
+        """
+        key = self.key(river, reach, rs, nprofs, n)
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM sims WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.clock += 1
+            self.conn.execute("UPDATE sims SET used = ? WHERE key = ?", (self.clock, key))
+            self.conn.commit()
+        return array("d", row[0]).tolist()
+
+    def put(self, river, reach, rs, nprofs, n, stages):
+        """
+        Store a list of simulated stages by profile.
+        """
+        key = self.key(river, reach, rs, nprofs, n)
+        value = array("d", stages).tobytes()
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM sims WHERE key = ?", (key,)).fetchone()
+            self.size -= old[0] if old is not None else 0
+            self.clock += 1
+            self.conn.execute("INSERT OR REPLACE INTO sims VALUES (?, ?, ?, ?)", (key, value, len(value), self.clock))
+            self.size += len(value)
+            while self.size > self.maxBytes:
+                (oldKey, oldSize) = self.conn.execute("SELECT key, size FROM sims ORDER BY used LIMIT 1").fetchone()
+                self.conn.execute("DELETE FROM sims WHERE key = ?", (oldKey,))
+                self.size -= oldSize
+            self.conn.commit()
+
+    def stats(self):
+        return "Simulation cache: %d hits, %d misses, %.1f kB stored" % (self.hits, self.misses, self.size / 1024)
+
+    def close(self):
+        self.conn.close()
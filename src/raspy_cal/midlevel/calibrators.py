@@ -5,66 +5,143 @@ Copyright (C) 2020 Daniel Philippus.
 Full copyright notice located in main.py.
 """
 
-from raspy_cal.midlevel.params import paramSpec, genParams
+from raspy_cal.midlevel.params import paramSpec, genParams, iterParams, chunked
 from raspy_cal.midlevel.eval import evaluate, evaluator
-from raspy_cal.lowlevel import runSims
+from raspy_cal.lowlevel import runSims, runMultiSim
+from raspy_cal import timing
 
-def nstageIteration(model, river, reach, rs, stage, nct, rand, nmin, nmax, metrics, correctDatum):
+def nstageIteration(model, river, reach, rs, stage, nct, rand, nmin, nmax, metrics, correctDatum, cache=None,
+                    log=False, seed=None, chunk=None, record=None):
     """
     Run one test.
-    :param model: HEC-RAS model
+    :param model: HEC-RAS model, or a lowlevel.ModelPool to run the ns in parallel
     :param river: river name
     :param reach: reach name
     :param rs: river station
     :param stage: list of stages
     :param nct: number of ns to test
-    :param rand: whether to use random ns
+    :param rand: whether to use random ns, or the sampling method (see params.paramSpec)
     :param nmin: minimum n
     :param nmax: maximum n
     :param metrics: list of metrics to use
+    :param cache: optional SimCache of simulated stages
+    :param log: space or sample the ns evenly in log n
+    :param seed: random seed for the ns
+    :param chunk: if specified, simulate and evaluate this many ns at a time (see chunkedRunner)
+    :param record: optional function (n, sim) called for every simulation, e.g. SimulationStream.append
     :return: [(n, metrics, sim)]
     """
-    return multiRunner(model,
-                  nstageMultiRunspec(river, reach, rs, len(stage)),
-                  paramSpec("n", nmin, nmax, nct, rand),
-                  nstageMultiEvaluator(stage, metrics, correctDatum))
+    runspec = nstageMultiRunspec(river, reach, rs, len(stage), cache, record)
+    evaluator = nstageMultiEvaluator(stage, metrics, correctDatum)
+    pspec = paramSpec("n", nmin, nmax, nct, rand, log)
+    if chunk is not None:
+        # Keep the best third of all nct ns, as unchunked, rather than of each chunk
+        return chunkedRunner(model, runspec, iterParams([pspec], dicts=False, seed=seed),
+                             nstageMultiEvaluator(stage, metrics, correctDatum, nct // 3), chunk)
+    return multiRunner(model, runspec, pspec if seed is None else genParams([pspec], dicts=False, seed=seed),
+                       evaluator)
 
-def nstageSingleRun(model, river, reach, rs, stage, n, metrics, correctDatum):
-    return singleRunner(model, nstageSingleRunspec(river, reach, rs, len(stage)),
+def nstageRefine(model, river, reach, rs, stage, nct, rand, nmin, nmax, metrics, correctDatum, cache=None,
+                 factor=0.5, tol=0.002, budget=None, log=False, seed=None, report=None, record=None):
+    """
+    Run sweeps of nstageIteration unattended, shrinking the range of n after each sweep around the best n (one
+    metric) or the Pareto front (several metrics), until the range is narrower than tol, budget simulations have
+    been run, or a sweep has no new ns.  Results from all sweeps are kept, so no n is simulated twice (ns are
+    rounded to 3 decimal places, as in nstageIteration).  Arguments are as for nstageIteration, plus:
+    :param factor: shrink the range to this fraction of its width after each sweep (but no narrower than the
+        best/Pareto region and the sampled ns on either side of it)
+    :param tol: stop once the range is narrower than this
+    :param budget: maximum total number of simulations, or None for no limit
+    :param report: optional function (sweep number, nmin, nmax, results) called after each sweep, with the results
+        as returned by nstageIteration
+    :param record: optional function (n, sim) called for every simulation
+    :return: [(n, metrics, sim)] for all simulations so far, as from nstageIteration
+    """
+    runspec = nstageMultiRunspec(river, reach, rs, len(stage), cache, record)
+    evaluator = nstageMultiEvaluator(stage, metrics, correctDatum)
+    single = metrics is not None and len(metrics) == 1
+    sims = {}  # {n: simulated stage} for all sweeps
+    (lo, hi) = (nmin, nmax)
+    results = []
+    sweep = 0
+    while True:
+        sweep += 1
+        params = genParams([paramSpec("n", lo, hi, nct, rand, log)], dicts=False,
+                           seed=None if seed is None else seed + sweep)
+        ns = []
+        for n in params:
+            n = round(n, 3)
+            if n not in sims and n not in ns and n > 0:
+                ns.append(n)
+        if budget is not None:
+            ns = ns[:max(budget - len(sims), 0)]
+        if not ns:
+            break
+        for (n, sim) in runspec(model, ns):
+            sims[n] = sim
+        results = evaluator(list(sims.items()))
+        # Region to refine around: the best few (one metric) or the non-dominated ns
+        region = [r[0] for r in (evaluate(stage, list(sims.items()), correctDatum, metrics=metrics, n=3)
+                                 if single else results)]
+        # Bracket the region with the nearest sampled ns on either side (or the limits), since the optimum may lie
+        # anywhere between the region and its neighbours
+        below = [n for n in sims if n < min(region)]
+        above = [n for n in sims if n > max(region)]
+        bracket = (max(below) if below else nmin, min(above) if above else nmax)
+        width = max(factor * (hi - lo), bracket[1] - bracket[0])
+        center = (bracket[0] + bracket[1]) / 2
+        (lo, hi) = (max(center - width / 2, nmin), min(center + width / 2, nmax))
+        if report is not None:
+            report(sweep, lo, hi, results)
+        if hi - lo < tol or (budget is not None and len(sims) >= budget):
+            break
+    return results
+
+def nstageSingleRun(model, river, reach, rs, stage, n, metrics, correctDatum, cache=None):
+    return singleRunner(model, nstageSingleRunspec(river, reach, rs, len(stage), cache),
                         {"n": n}, nstageSingleEvaluator(stage, metrics, correctDatum))
 
-def nstageMultiRunspec(river, reach, rs, pcount):
+def nstageMultiRunspec(river, reach, rs, pcount, cache=None, record=None):
     """
     Generates runspec function for roughness coefficient and stage.
     :param pcount: number of flow profiles
-    :return: runspec function which returns [(n, simulated stage)]
+    :param cache: optional SimCache of simulated stages
+    :param record: optional function (n, simulated stage) called for each simulation
+    :return: runspec function, taking a paramSpec or a list of ns, which returns [(n, simulated stage)]
     """
+    def post(n, result):
+        sim = [result[rs][jx] for jx in range(1, pcount + 1)]
+        if record is not None:
+            record(n, sim)
+        return (n, sim)
+
     def runspec(model, pspec):
-        ns = [round(n, 3) for n in genParams([pspec], dicts=False)]
-        results = runSims(model, ns, river, reach, pcount, range=[rs])
-        return [(ns[ix], [results[ix][rs][jx] for jx in range(1, pcount + 1)]) for ix in range(len(ns))]
+        ns = [round(n, 3) for n in (genParams([pspec], dicts=False) if isinstance(pspec, dict) else pspec)]
+        return runSims(model, ns, river, reach, pcount, range=[rs], cache=cache, pipeline=True, post=post)
     return runspec
 
-def nstageMultiEvaluator(stage, metrics, correctDatum):
+def nstageMultiEvaluator(stage, metrics, correctDatum, keep=None):
     """
     Generates evaluator function for roughness coefficient and stage.
     :param stage: observed stage
     :param metrics: list of metrics to use
+    :param keep: number of results to keep for a single metric, or None for a third of those evaluated
     :return: evaluator function which returns [(n, metrics, sim)]
     """
     def evtr(result):
-        return evaluate(stage, result, correctDatum, metrics=metrics, n=len(result)//3)
+        return evaluate(stage, result, correctDatum, metrics=metrics, n=len(result)//3 if keep is None else keep)
     return evtr
 
-def nstageSingleRunspec(river, reach, rs, pcount):
+def nstageSingleRunspec(river, reach, rs, pcount, cache=None):
     """
     Generates runspec function for a single roughness coefficient and stage.
     :param pcount: number of flow profiles
+    :param cache: optional SimCache of simulated stages
     :return: runspec function which returns simulated stage
     """
     def runspec(model, pset):
         n = pset["n"]
-        result = runSims(model, [n], river, reach, pcount, range=[rs])
+        result = runSims(model, [n], river, reach, pcount, range=[rs], cache=cache)
         return [result[0][rs][ix] for ix in range(1, pcount+1)]
     return runspec
 
@@ -77,6 +154,36 @@ def nstageSingleEvaluator(stage, metrics, correctDatum):
     """
     return evaluator(stage, correctDatum, metrics)
 
+def multiStageRunspec(locations, pcount):
+    """
+    Generates runspec function for roughness coefficients at several locations, all simulated in one run.
+    :param locations: list of (river, reach, rs), each on a different reach
+    :param pcount: number of flow profiles
+    :return: runspec function taking pset {"n": [n for each location]} and returning [simulated stage for each
+        location]
+    """
+    rivers = [loc[0] for loc in locations]
+    reaches = [loc[1] for loc in locations]
+    ranges = [[loc[2]] for loc in locations]
+
+    def runspec(model, pset):
+        result = runMultiSim(model, list(pset["n"]), rivers, reaches, pcount, ranges=ranges, log=False)
+        return [[result[river][reach][rs][1][ix] for ix in range(1, pcount + 1)] for (river, reach, rs) in locations]
+    return runspec
+
+def multiStageEvaluator(stages, metrics, correctDatum):
+    """
+    Generates evaluator function for roughness coefficients at several locations.
+    :param stages: list of observed stages for each location
+    :param metrics: list of metrics to use
+    :return: evaluator function taking a list of simulated stages and returning a list of metrics dictionaries
+    """
+    evtrs = [evaluator(stage, correctDatum, metrics) for stage in stages]
+
+    def evtr(sims):
+        return [evtrs[ix](sim) for (ix, sim) in enumerate(sims)]
+    return evtr
+
 def multiRunner(model, runspec, pspec, evaluator):
     """
     Generic iteration function independent of the internal details of runspec, pspec, and evaluator.
@@ -88,8 +195,27 @@ def multiRunner(model, runspec, pspec, evaluator):
         [(result, metrics dictionary, ...)] (further results [...] optional, e.g. stage timeseries)
     :return: results from evaluator
     """
-    results = runspec(model, pspec)
-    return evaluator(results)
+    with timing.span("iteration"):
+        results = runspec(model, pspec)
+        return evaluator(results)
+
+def chunkedRunner(model, runspec, params, evaluator, chunk):
+    """
+    Like multiRunner, but for a stream of parameters (e.g. from params.iterParams), run and evaluate them chunk by
+    chunk so that memory use is bounded by the chunk size.  The results kept after each chunk are evaluated again
+    together with the next chunk; for evaluators that keep the non-dominated results or a fixed number of best
+    results, this gives the same selection as evaluating everything at once.
+    :param runspec: function accepting arguments model and a list of parameters, returning [(parameters, result)]
+    :param params: iterable of parameters
+    :param evaluator: as for multiRunner
+    :param chunk: number of parameters to run at a time
+    :return: results from evaluator
+    """
+    kept = []
+    for params in chunked(params, chunk):
+        results = runspec(model, params)
+        kept = evaluator([(res[0], res[2]) for res in kept] + results)
+    return kept
 
 def singleRunner(model, runspec, pset, evaluator):
     """
@@ -101,8 +227,9 @@ def singleRunner(model, runspec, pset, evaluator):
     :param evaluator: evaluator function that takes runspec results and returns a metrics dictionary
     :return: metrics from evaluator
     """
-    result = runspec(model, pset)
-    return evaluator(result)
+    with timing.span("evaluation"):
+        result = runspec(model, pset)
+        return evaluator(result)
 
 
 
@@ -0,0 +1,58 @@
+"""
+Checkpoints for long-running automatic calibration, so that a run can be resumed after a crash without
+repeating completed simulations.
+
+Copyright (C) 2020 Daniel Philippus
+Full copyright notice located in main.py.
+"""
+
+import os
+import pickle
+
+
+class Checkpoint(object):
+    """
+    Holds the state of a calibration run (a dictionary, updated in place by the calibrator) and periodically
+    writes it to a file.  With no path, it only holds the state.
+    """
+    def __init__(self, path=None, every=10):
+        """
+        :param path: checkpoint file path, or None not to write checkpoints
+        :param every: write a checkpoint after this many new evaluations
+        """
+        self.path = path if path != "" else None
+        self.every = every
+        self.state = {}
+        self.unsaved = 0
+
+    def load(self):
+        """
+        Load the state from the checkpoint file, if there is one.
+        :return: the loaded state, or None if there is no checkpoint
+        """
+        if self.path is None or not os.path.exists(self.path):
+            return None
+        with open(self.path, "rb") as f:
+            self.state = pickle.load(f)
+        return self.state
+
+    def update(self, **state):
+        self.state.update(state)
+
+    def evaluated(self):
+        # Record a new evaluation and save if due.
+        self.unsaved += 1
+        if self.unsaved >= self.every:
+            self.save()
+
+    def save(self):
+        """
+        Write the state, replacing the previous checkpoint only once it has been written completely.
+        """
+        if self.path is None:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(self.state, f)
+        os.replace(tmp, self.path)
+        self.unsaved = 0
@@ -5,6 +5,12 @@ Copyright (C) 2020 Daniel Philippus.
 Full copyright notice in main.py.
 """
 
+import csv
+import json
+import os
+import re
+import numpy as np
+from datetime import date, timedelta
 from urllib.request import urlopen
 
 
@@ -28,7 +34,63 @@ def usgsURL(gage, end=None, start=None, period=None):
     return base % (gage, period, start, end)
 
 
-def getUSGSData(gage, end=None, start=None, period=None, urlFunc=usgsURL, si=False):
+def parseRDB(lines, si=False, dates=False):
+    """
+    Parse USGS RDB data line by line, e.g. straight from the response of urlopen, without holding it all in memory.
+    Rows with missing or non-numeric (e.g. "Ice") flow or stage are skipped.
+    :param lines: iterable of lines (bytes or str)
+    :param si: if true, convert data from cfs/ft to cms/m
+    :param dates: if true, also yield the date/time string of each row, with the time zone code (e.g. PST or PDT)
+        if there is one, so that the hour repeated when daylight saving time ends is distinct
+    :return: generator of (flow, stage), or (datetime, flow, stage) if dates
+    """
+    # identify flow and stage
+    flown = "00060"
+    stagen = "00065"
+    volfactor = (12 / 39.37) ** 3 if si else 1
+    stagefactor = 12 / 39.37 if si else 1
+    header = None
+    formatLine = True
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        line = line.rstrip("\r\n")
+        if line == "" or line.startswith("#"):
+            continue
+        row = line.split("\t")
+        if header is None:  # First uncommented line is the header, followed by a format line
+            header = row
+            flowcol = 0
+            stagecol = 0
+            datecol = 0
+            tzcol = None
+            for (ix, item) in enumerate(header):
+                if item.endswith(flown):
+                    flowcol = ix
+                if item.endswith(stagen):
+                    stagecol = ix
+                if item == "datetime":
+                    datecol = ix
+                if item == "tz_cd":
+                    tzcol = ix
+            width = max(flowcol, stagecol, datecol, -1 if tzcol is None else tzcol)
+            continue
+        if formatLine:
+            formatLine = False
+            continue
+        if len(row) > width and len(row[flowcol]) > 0 and len(row[stagecol]) > 0:
+            try:
+                (flow, stage) = (float(row[flowcol]) * volfactor, float(row[stagecol]) * stagefactor)
+            except ValueError:
+                continue
+            if dates:
+                yield (row[datecol] if tzcol is None or row[tzcol] == "" else "%s %s" % (row[datecol], row[tzcol]),
+                       flow, stage)
+            else:
+                yield (flow, stage)
+
+
+def getUSGSData(gage, end=None, start=None, period=None, urlFunc=usgsURL, si=False, cache=None):
     """
     Retrieve USGS gage data for the given gage.
     :param gage: gage number
@@ -37,75 +99,214 @@ def getUSGSData(gage, end=None, start=None, period=None, urlFunc=usgsURL, si=Fal
     :param period: number of days to retrieve data for
     :param urlFunc: url generator function (usually should be left as default) (arguments gage, start, end, period)
     :param si: if true, convert data from cfs/ft to cms/m
+    :param cache: directory of previously retrieved gage data, or None not to cache (see cachedUSGSData)
     :return: [(flow, stage)]
     """
-    # identify flow and stage
-    flown = "00060"
-    stagen = "00065"
+    if cache is not None:
+        return [(flow, stage) for (_, flow, stage) in cachedUSGSData(gage, end, start, period, cache, urlFunc, si)]
     url = urlFunc(gage=gage, start=start, end=end, period=period)
     with urlopen(url) as res:
-        usgsBytes = res.read()
-    usgs = usgsBytes.decode("utf-8")
-    lines = usgs.split("\n")
-    dataIx = 0
-    while dataIx < len(lines):
-        if lines[dataIx][0] != "#":  # Find first data line (not commented)
-            break
-        dataIx += 1
-    rows = [l.split("\t") for l in lines[dataIx:]]
-    flowcol = 0
-    stagecol = 0
-    for (ix, item) in enumerate(rows[0]):
-        if item.endswith(flown):
-            flowcol = ix
-        if item.endswith(stagen):
-            stagecol = ix
+        return list(parseRDB(res, si))
+
+
+def missingIntervals(fetched, start, end):
+    """
+    Find the parts of the date range [start, end] that are not covered by the fetched intervals.
+    :param fetched: sorted list of non-overlapping (start, end) date pairs
+    :return: list of (start, end) date pairs
+    """
+    missing = []
+    for (a, b) in fetched:
+        if b < start or a > end:
+            continue
+        if a > start:
+            missing.append((start, a - timedelta(days=1)))
+        start = b + timedelta(days=1)
+    if start <= end:
+        missing.append((start, end))
+    return missing
+
+
+def mergeIntervals(intervals):
+    # Merge overlapping or adjacent (start, end) date pairs
+    merged = []
+    for (a, b) in sorted(intervals):
+        if merged and a <= merged[-1][1] + timedelta(days=1):
+            merged[-1] = (merged[-1][0], max(b, merged[-1][1]))
+        else:
+            merged.append((a, b))
+    return merged
+
+
+def cachedUSGSData(gage, end, start, period, cacheDir, urlFunc=usgsURL, si=False):
+    """
+    Retrieve USGS gage data through a local cache, downloading only the dates which haven't been retrieved before.
+    The cache holds <gage>.tsv (date/time and time zone, flow, stage in USGS units, in date order) and <gage>.json
+    (the date intervals retrieved).  Today's data is never marked as retrieved, since it is still being added to;
+    when it is retrieved again, the new rows replace the old ones.
+    :param gage: gage number
+    :param end: end date (yyyy-mm-dd) or None for today
+    :param start: start date or None to use period
+    :param period: number of days to retrieve data for, if start is not specified (default 7)
+    :param cacheDir: cache directory (created if needed)
+    :return: generator of (datetime, flow, stage) in date order
+    """
+    os.makedirs(cacheDir, exist_ok=True)
+    (datapath, metapath) = (os.path.join(cacheDir, "%s.tsv" % gage), os.path.join(cacheDir, "%s.json" % gage))
+    today = date.today()
+    end = today if end is None or end == "" else date.fromisoformat(end)
+    start = date.fromisoformat(start) if start is not None and start != "" else\
+        end - timedelta(days=int(period) if period is not None and period != "" else 7)
+    fetched = []
+    if os.path.exists(metapath):
+        with open(metapath) as f:
+            fetched = [(date.fromisoformat(a), date.fromisoformat(b)) for (a, b) in json.load(f)]
+    missing = missingIntervals(fetched, start, end)
+    if missing:
+        rows = readCache(datapath)
+        for (a, b) in missing:
+            with urlopen(urlFunc(gage=gage, start=a.isoformat(), end=b.isoformat(), period=None)) as res:
+                rows.update({dt: (flow, stage) for (dt, flow, stage) in parseRDB(res, dates=True)})
+        # Rewrite the file rather than appending, so that rows retrieved again replace the old ones
+        with open(datapath + ".tmp", "w") as f:
+            for dt in sorted(rows):
+                f.write("%s\t%r\t%r\n" % ((dt,) + rows[dt]))
+        os.replace(datapath + ".tmp", datapath)
+        fetched = mergeIntervals(fetched + [(a, min(b, today - timedelta(days=1))) for (a, b) in missing if a < today])
+        with open(metapath, "w") as f:
+            json.dump([(a.isoformat(), b.isoformat()) for (a, b) in fetched], f)
+    return cachedRows(datapath, start, end, si)
+
+
+def readCache(datapath):
+    # {date/time: (flow, stage)} in USGS units from a gage cache file, keeping the last of any repeated rows
+    rows = {}
+    if os.path.exists(datapath):
+        with open(datapath) as f:
+            for line in f:
+                (dt, flow, stage) = line.rstrip("\n").split("\t")
+                rows[dt] = (float(flow), float(stage))
+    return rows
+
+
+def cachedRows(datapath, start, end, si):
+    # Read rows between start and end from a gage cache file
     volfactor = (12 / 39.37) ** 3 if si else 1
     stagefactor = 12 / 39.37 if si else 1
-    return [
-        # skip first 2 rows which are headers, not data, and make sure each row is long enough
-        (float(row[flowcol]) * volfactor,
-         float(row[stagecol])) * stagefactor for row in rows[2:] if len(row) > stagecol and
-                                                                    len(row) > flowcol and
-                                                                    len(row[flowcol]) > 0 and
-                                                                    len(row[stagecol]) > 0
-    ]
+    (start, end) = (start.isoformat(), end.isoformat())
+    rows = readCache(datapath)
+    for dt in sorted(rows):
+        if start <= dt[:10] <= end:
+            (flow, stage) = rows[dt]
+            yield (dt, flow * volfactor, stage * stagefactor)
 
 
-def prepareUSGSData(usgsData, flowcount=100, log=True):
+def prepareUSGSData(usgsData, flowcount=100, log=True, stat="first", counts=False):
     """
     Prepare flow and stage for use.  Returns a roughly evenly distributed set of flows across the relevant
     range.
-    :param usgsData: usgs data as returned by getUSGSData - [(flow, stage)]
+    :param usgsData: usgs data as returned by getUSGSData - [(flow, stage)] - or an equivalent (rows x 2) array
     :param flowcount: how many flows to return
     :param log: whether to evenly distribute logarithmically (alternative: linearly)
-    :return: (flows, stages)
+    :param stat: how to pick the stage for each target flow.  "first" uses the first observation at or above each
+        target flow.  Otherwise, observations are binned between consecutive target flows and each bin is summarized
+        by its median flow and the "median", "mean", or a quantile (number between 0 and 1) of its stages.
+    :param counts: also return the number of observations in each bin (1 for "first")
+    :return: (flows, stages) or (flows, stages, counts)
     """
-    sortedData = sorted([u for u in usgsData if u[0] > 0], key=lambda d: d[0])  # sort by flow rate
+    data = np.asarray(usgsData if isinstance(usgsData, np.ndarray) else list(usgsData), dtype=float).reshape((-1, 2))
+    data = data[data[:, 0] > 0]
+    order = np.argsort(data[:, 0], kind="stable")  # sort by flow rate
+    (flows, stages) = (data[order, 0], data[order, 1])
     # Range: either largest / smallest or largest * smallest
-    rng = sortedData[-1][0] / sortedData[0][0] if log else sortedData[-1][0] - sortedData[0][0]
+    rng = float(flows[-1] / flows[0] if log else flows[-1] - flows[0])
     # flowcount - 1 steps
     step = rng ** (1 / (flowcount - 1)) if log else rng / (flowcount - 1)
-    flow = [sortedData[0][0]]
-    if flow[0] < 0.1:
-        flow[0] = 0.1
-    stage = [sortedData[0][1]]
-    first = sortedData[0][0]
 
     # To avoid overlong numbers, since the HEC-RAS flow files are fixed-width, PyRASFile rounds to 1 decimal place
-    first = first if first >= 0.1 else 0.1
-    vals = [first * step ** ix if log else first + step + ix for ix in range(1, flowcount)]
+    first = float(flows[0]) if flows[0] >= 0.1 else 0.1
+    vals = [first * step ** ix if log else first + step * ix for ix in range(1, flowcount)]
     vals = [round(val, 1) for val in vals]
-    vals = sorted(list(set(vals)))  # Only unique values, since rounding might introduce duplicates
-    ixv = 0
-    for (fl, st) in sortedData:
-        if fl >= vals[ixv] and fl > flow[-1]:  # Make sure it's also greater than previous - no point in duplicates
-            flow.append(fl)
-            stage.append(st)
-            ixv += 1
-        if ixv >= len(vals):
-            break
-    return (flow, stage)
+    vals = np.array(sorted(list(set(vals))))  # Only unique values, since rounding might introduce duplicates
+
+    if stat == "first":
+        # First observation at or above each target, and above the previous one - no point in duplicates
+        atLeast = np.searchsorted(flows, vals, side="left")
+        picked = [0]
+        last = first
+        for ix in atLeast:
+            ix = max(ix, np.searchsorted(flows, last, side="right"))
+            if ix >= len(flows):
+                break
+            picked.append(ix)
+            last = flows[ix]
+        flow = flows[picked]
+        flow[0] = first
+        (stage, count) = (stages[picked], np.ones(len(picked), dtype=int))
+    else:
+        # Bin k covers [vals[k-1], vals[k]), with bin 0 starting at the lowest flow
+        bins = np.searchsorted(vals, flows, side="right")
+        # Flows are sorted, so bins are contiguous and the flows within each are sorted: the median is positional
+        byFlow = flows
+        order = np.lexsort((stages, bins))  # stages sorted within each bin, for the stage statistics
+        (stages, bins) = (stages[order], bins[order])
+        starts = np.flatnonzero(np.concatenate([[True], bins[1:] != bins[:-1]]))
+        count = np.diff(np.concatenate([starts, [len(bins)]]))
+        flow = (byFlow[starts + (count - 1) // 2] + byFlow[starts + count // 2]) / 2
+        if stat == "mean":
+            stage = np.add.reduceat(stages, starts) / count
+        else:
+            q = 0.5 if stat == "median" else float(stat)
+            pos = starts + q * (count - 1)
+            (low, high) = (np.floor(pos).astype(int), np.ceil(pos).astype(int))
+            stage = stages[low] + (pos - low) * (stages[high] - stages[low])
+        flow = np.maximum(flow, 0.1)
+    if counts:
+        return (flow.tolist(), stage.tolist(), count.tolist())
+    return (flow.tolist(), stage.tolist())
+
+
+def normalizeHeader(name):
+    # Compare column headers case-insensitively, ignoring units in brackets, spaces, quotes and stray characters
+    return re.sub(r"[^a-z0-9]", "", re.sub(r"[(\[].*?[)\]]", "", name.lower()))
+
+
+def loadStageFile(path, columns=("Flow", "Stage"), mmap=False):
+    """
+    Load columns of a CSV file with column headers straight into float arrays.  Headers are matched ignoring case,
+    spaces and punctuation, and a byte order mark (as written by Excel) is ignored.  Values may be quoted.
+    :param path: path to the CSV file
+    :param columns: names of the columns to load
+    :param mmap: for very large files, keep a binary copy of the parsed columns next to the CSV (<path>.<columns>.npy)
+        and memory-map that instead of parsing the CSV again, as long as it is newer than the CSV
+    :return: tuple of arrays, one for each column
+    """
+    binpath = "%s.%s.npy" % (path, "-".join(normalizeHeader(c) for c in columns))
+    if mmap and os.path.exists(binpath) and os.path.getmtime(binpath) >= os.path.getmtime(path):
+        data = np.load(binpath, mmap_mode="r")
+        return tuple(data[:, ix] for ix in range(len(columns)))
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        header = [normalizeHeader(h) for h in next(csv.reader(f))]
+        usecols = []
+        for col in columns:
+            if normalizeHeader(col) not in header:
+                raise ValueError("Column %s not found in %s (columns: %s)" % (col, path, header))
+            usecols.append(header.index(normalizeHeader(col)))
+        data = np.loadtxt(f, delimiter=",", usecols=usecols, quotechar='"', ndmin=2, dtype=float)
+    if mmap:
+        try:
+            np.save(binpath, data)
+        except OSError:
+            pass  # e.g. read-only directory; just parse the CSV next time
+    return tuple(data[:, ix] for ix in range(len(columns)))
+
+
+def loadStageFiles(paths, columns=("Flow", "Stage"), mmap=False):
+    """
+    Load several stage files (see loadStageFile).
+    :return: list of tuples of arrays, in the order of paths
+    """
+    return [loadStageFile(path, columns, mmap) for path in paths]
 
 
 def singleStageFile(path):
@@ -114,10 +315,57 @@ def singleStageFile(path):
     flow profiles in HEC-RAS which the user has entered and that the file is a CSV with column headers
     Flow and Stage.
     """
-    lines = []
-    with open(path) as f:
-        lines = [line for line in f]
-    lines = [[i.strip() for i in line.split(",")] for line in lines]
-    stage = lines[0].index("Stage")
-    flow = lines[0].index("Flow")
-    return ([float(i[flow]) for i in lines[1:]], [float(i[stage]) for i in lines[1:]])
+    (flow, stage) = loadStageFile(path)
+    return (flow.tolist(), stage.tolist())
+
+
+if __name__ == "__main__":
+    # Check the gage cache against a local stand-in for the USGS service, which serves two rows per day for the
+    # requested dates, repeating 01:30 in PST and PDT on the day daylight saving time ends
+    import tempfile
+    import threading
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import parse_qs, urlparse
+
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            query = parse_qs(urlparse(self.path).query)
+            (a, b) = (date.fromisoformat(query["begin_date"][0]), date.fromisoformat(query["end_date"][0]))
+            requests.append((a, b))
+            lines = ["# stand-in", "agency_cd\tsite_no\tdatetime\ttz_cd\t1_00060\t1_00065",
+                     "5s\t15s\t20d\t6s\t14n\t14n"]
+            day = a
+            while day <= b:
+                times = [("01:30", "PDT"), ("01:30", "PST")] if day == date(2020, 11, 1) else [("00:00", "PST"),
+                                                                                              ("12:00", "PST")]
+                lines += ["USGS\t1\t%s %s\t%s\t%d\t1.5" % (day, t, tz, day.day) for (t, tz) in times]
+                day += timedelta(days=1)
+            body = "\n".join(lines).encode("utf-8")
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    local = lambda **kw: usgsURL(**kw).replace("https://nwis.waterdata.usgs.gov",
+                                               "http://127.0.0.1:%d" % server.server_port)
+    with tempfile.TemporaryDirectory() as cacheDir:
+        rows = list(cachedUSGSData("1", "2020-11-02", "2020-10-31", None, cacheDir, local))
+        assert len(rows) == 6 and "2020-11-01 01:30 PDT" in dict((r[0], r) for r in rows), rows
+        again = list(cachedUSGSData("1", "2020-11-02", "2020-10-30", None, cacheDir, local))
+        assert requests == [(date(2020, 10, 31), date(2020, 11, 2)), (date(2020, 10, 30), date(2020, 10, 30))]
+        assert again[2:] == rows and len(again) == 8
+        # Today is retrieved again each time, replacing rather than repeating its rows
+        today = date.today().isoformat()
+        for _ in range(2):
+            latest = list(cachedUSGSData("1", today, today, None, cacheDir, local))
+        assert len(latest) == 2 and len(readCache(os.path.join(cacheDir, "1.tsv"))) == 10
+        with open(os.path.join(cacheDir, "1.tsv")) as f:
+            assert len(f.readlines()) == 10
+    server.shutdown()
+    print("Gage cache check passed (%d requests)" % len(requests))
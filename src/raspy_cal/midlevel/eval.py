@@ -5,25 +5,37 @@ Copyright (C) 2020 Daniel Philippus
 Full copyright notice located in main.py.
 """
 
-import HydroErr as he
-import scipy.stats as sp
+from raspy_cal import timing
+
+import importlib
+import numpy as np
+from bisect import bisect_left, bisect_right
+
+def lazy(module, name):
+    # Function calling module.name, with module (e.g. HydroErr or scipy.stats) only imported when first called
+    def call(*args):
+        return getattr(importlib.import_module(module), name)(*args)
+    return call
 
 def pbias(sim, obs):
     length = len(sim) if len(sim) <= len(obs) else len(obs)
     return 100 * sum([sim[i] - obs[i] for i in range(length)]) / sum(obs[:length])
 
+ks2samp = lazy("scipy.stats", "ks_2samp")
+ttestRel = lazy("scipy.stats", "ttest_rel")
+
 # Just to have a list of potentially useful tests
 # Values are functions taking (simulated, observed) lists (this convention taken from HydroErr) and returning
 # the statistic
 tests = {
-    "r2": he.r_squared,
+    "r2": lazy("HydroErr", "r_squared"),
     "pbias": pbias,
-    "rmse": he.rmse,
-    "ks_pval": lambda sim, obs: sp.ks_2samp(sim, obs)[1],  # p-value for the null hypothesis (higher is better)
-    "ks_stat": lambda sim, obs: sp.ks_2samp(sim, obs)[0],  # ks statistic (smaller is better)
-    "paired": lambda sim, obs: sp.ttest_rel(sim, obs)[1],  # p-value (higher is better)
-    "mae": he.mae,
-    "nse": he.nse
+    "rmse": lazy("HydroErr", "rmse"),
+    "ks_pval": lambda sim, obs: ks2samp(sim, obs)[1],  # p-value for the null hypothesis (higher is better)
+    "ks_stat": lambda sim, obs: ks2samp(sim, obs)[0],  # ks statistic (smaller is better)
+    "paired": lambda sim, obs: ttestRel(sim, obs)[1],  # p-value (higher is better)
+    "mae": lazy("HydroErr", "mae"),
+    "nse": lazy("HydroErr", "nse")
 }
 
 # Functions to adjust the above test results so that smaller is better
@@ -47,6 +59,18 @@ def minimized(metrics):
         test: minimizers[test](metrics[test]) for test in metrics
     }
 
+def combined(metrics, obs):
+    """
+    Combine metrics into a single score (smaller is better): the sum of the minimized metrics, each divided by its
+    typical scale so that no metric dominates because of its units.  Stage errors (rmse, mae) are relative to the
+    spread of the observed stages and pbias is a percentage; the other metrics are already unitless.
+    :param metrics: dictionary of {test: result} from tests
+    :param obs: observed stages
+    """
+    spread = float(np.std(obs)) or 1.0
+    scales = {"rmse": spread, "mae": spread, "pbias": 100.0}
+    return sum(value / scales.get(test, 1.0) for (test, value) in minimized(metrics).items())
+
 def fullEval(sim, obs):
     """
     Return all comparison stats
@@ -55,6 +79,102 @@ def fullEval(sim, obs):
         test: tests[test](sim, obs) for test in tests
     }
 
+class BatchEvaluator(object):
+    """
+    Vectorized evaluation of many simulations at once against the same observations.  Produces the same values as
+    the tests dictionary, but computes each metric for a whole (sims x profiles) array in one pass, with observation
+    statistics precomputed and residuals shared between metrics.  The KS p-value is computed by scipy along the rows
+    in one call (per simulation with scipy versions that don't support axis).
+    """
+    def __init__(self, obs, correctDatum, useTests=None):
+        """
+        :param obs: observed values
+        :param correctDatum: whether to adjust the datum between obs and sim
+        :param useTests: list of strings (test names) or None for all
+        """
+        self.obs = np.asarray(obs, dtype=float)
+        self.correctDatum = correctDatum
+        self.keys = list(tests.keys()) if useTests is None else list(useTests)
+        self.obsSorted = np.sort(self.obs)
+        self.count = len(self.obs) // 20 + 1  # Bottom 5%, +1 in case len(obs) < 20
+        self.obsLow = self.obsSorted[:self.count].sum()
+        self.obsSum = self.obs.sum()
+        self.obsDev = self.obs - self.obs.mean()
+        self.obsSS = np.sum(self.obsDev ** 2)
+
+    def adjustDatum(self, sims):
+        if not self.correctDatum:
+            return sims
+        simLow = np.partition(sims, self.count - 1, axis=1)[:, :self.count].sum(axis=1)
+        return sims + ((self.obsLow - simLow) / self.count)[:, None]
+
+    def ksStat(self, sims):
+        # Two-sample KS statistic for each row: combine each row with obs, sort, and take the largest difference
+        # between the empirical CDFs at the last of each run of tied values.  Integer steps keep it exact.
+        (n1, n2) = (sims.shape[1], len(self.obs))
+        vals = np.concatenate([sims, np.broadcast_to(self.obsSorted, (len(sims), n2))], axis=1)
+        steps = np.concatenate([np.full(sims.shape, n2), np.full((len(sims), n2), -n1)], axis=1)
+        order = np.argsort(vals, axis=1, kind="stable")
+        vals = np.take_along_axis(vals, order, axis=1)
+        cdiff = np.cumsum(np.take_along_axis(steps, order, axis=1), axis=1)
+        last = np.ones(vals.shape, dtype=bool)
+        last[:, :-1] = vals[:, :-1] != vals[:, 1:]
+        return np.where(last, np.abs(cdiff), 0).max(axis=1) / (n1 * n2)
+
+    def evaluate(self, sims):
+        """
+        Evaluate all simulations.
+        :param sims: (sims x profiles) array or list of simulated lists
+        :return: {test: array of results, one per simulation}
+        """
+        sims = self.adjustDatum(np.asarray(sims, dtype=float).reshape((len(sims), -1)))
+        resid = sims - self.obs
+        sse = np.sum(resid ** 2, axis=1)
+        out = {}
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for key in self.keys:
+                if key == "r2":
+                    simDev = sims - sims.mean(axis=1)[:, None]
+                    out[key] = np.sum(self.obsDev * simDev, axis=1) ** 2 / (self.obsSS * np.sum(simDev ** 2, axis=1))
+                elif key == "pbias":
+                    out[key] = 100 * resid.sum(axis=1) / self.obsSum
+                elif key == "rmse":
+                    out[key] = np.sqrt(sse / sims.shape[1])
+                elif key == "mae":
+                    out[key] = np.abs(resid).mean(axis=1)
+                elif key == "nse":
+                    out[key] = 1 - sse / self.obsSS
+                elif key == "ks_stat":
+                    out[key] = self.ksStat(sims)
+                elif key == "ks_pval":
+                    import scipy.stats as sp
+                    try:
+                        out[key] = np.asarray(sp.ks_2samp(sims, self.obs[None, :], axis=1).pvalue)
+                    except TypeError:  # older scipy, without axis
+                        out[key] = np.array([sp.ks_2samp(sim, self.obs)[1] for sim in sims])
+                elif key == "paired":
+                    import scipy.stats as sp
+                    dof = sims.shape[1] - 1
+                    t = resid.mean(axis=1) / (resid.std(axis=1, ddof=1) / np.sqrt(sims.shape[1]))
+                    out[key] = 2 * sp.t.sf(np.abs(t), dof)
+                else:
+                    out[key] = np.array([tests[key](list(sim), list(self.obs)) for sim in sims])
+        return out
+
+    def rows(self, sims):
+        """
+        Evaluate all simulations.
+        :return: list of {test: result} dictionaries, one per simulation
+        """
+        if len(sims) == 0:
+            return []
+        with timing.span("evaluate"):
+            results = {key: values.tolist() for (key, values) in self.evaluate(sims).items()}
+        return [{key: results[key][ix] for key in self.keys} for ix in range(len(sims))]
+
+    def __call__(self, sim):
+        return self.rows([sim])[0]
+
 def evaluator(obs, correctDatum, useTests = None):
     """
     Return a function which will return either all (if tests is None) or selected comparison
@@ -62,20 +182,7 @@ def evaluator(obs, correctDatum, useTests = None):
     :param useTests: list of strings (test names) or None
     :param correctDatum: whether to adjust the datum between obs and sim
     """
-
-    def adjustDatum(sim):
-        if not correctDatum:
-            return sim
-        obs_s = sorted(obs)
-        sim_s = sorted(sim)
-        count = len(obs) // 20 + 1  # Bottom 5%, +1 in case len(obs) < 20
-        adj = (sum(obs_s[:count]) - sum(sim_s[:count])) / count  # Average difference
-        return [s + adj for s in sim]
-
-    if useTests is None:
-        return lambda sim: fullEval(adjustDatum(sim), obs)
-    else:
-        return lambda sim: {test: tests[test](adjustDatum(sim), obs) for test in useTests}
+    return BatchEvaluator(obs, correctDatum, useTests)
 
 def nonDominated(points):
     """
@@ -83,10 +190,43 @@ def nonDominated(points):
     For NSGA-II, this is part of the algorithm which will presumably be provided by a library.  However, it may
     also be useful to look at non-dominated solutions in semi-manual mode, in which case it is necessary to provide
     a non-domination function.
+    Points are sorted by the first metric, so that a point can only be dominated by points before it; with two metrics
+    this is a single O(n log n) sweep.  Gives the same result as nonDominatedNaive.
     :param points: a list of tuples of (value, metrics), metrics should be a list in the same order for all.
         Metrics must all be "lower is better"
     :return: the same format as points, but only those which are non-dominated
     """
+    if len(points) == 0:
+        return []
+    metrics = np.array([point[1] for point in points], dtype=float).reshape((len(points), -1))
+    keep = np.ones(len(points), dtype=bool)
+    # Points with NaN metrics can't dominate or be dominated (comparisons are false)
+    valid = np.flatnonzero(~np.isnan(metrics).any(axis=1))
+    order = valid[np.lexsort(metrics[valid].T[::-1])]
+    sortd = metrics[order]
+    # Index of the first point with the same first metric: only points before that can dominate
+    starts = np.searchsorted(sortd[:, 0], sortd[:, 0], side="left")
+    if metrics.shape[1] == 1:
+        keep[order] = starts == 0
+    elif metrics.shape[1] == 2:
+        prevMin = np.concatenate([[np.inf], np.fmin.accumulate(sortd[:, 1])])[starts]
+        keep[order] = ~(prevMin < sortd[:, 1])
+    else:
+        # Check blocks of points against the front so far and against each other.  Any dominated point is
+        # dominated by a non-dominated one, and only points before it can dominate it, so this finds them all.
+        front = np.empty((0, metrics.shape[1]))
+        for ix in range(0, len(order), 256):
+            block = sortd[ix:ix + 256]
+            against = np.concatenate([front, block])
+            dominated = np.any(np.all(against[None, :, :] < block[:, None, :], axis=2), axis=1)
+            keep[order[ix:ix + 256]] = ~dominated
+            front = np.concatenate([front, block[~dominated]])
+    return [point for (ix, point) in enumerate(points) if keep[ix]]
+
+def nonDominatedNaive(points):
+    """
+    Reference O(n^2) version of nonDominated, same arguments and results.
+    """
 
     nondom = []
     metrics = [point[1] for point in points]
@@ -103,6 +243,70 @@ def nonDominated(points):
             nondom.append(points[ix])
     return nondom
 
+class ParetoArchive(object):
+    """
+    Incrementally maintained set of non-dominated points, with the same point format and dominance rule as
+    nonDominated.  With two metrics, the front is kept sorted by the first metric (so the second is non-increasing),
+    and each addition is a binary search plus removal of the contiguous run of points it dominates.  With other
+    numbers of metrics, each addition is checked against the current front.
+    """
+    def __init__(self, points=None):
+        self.points = []  # front, sorted by first metric if there are two metrics
+        self.f1 = []  # first metrics of self.points
+        self.negf2 = []  # negated second metrics of self.points (non-decreasing)
+        self.unordered = []  # points with NaN metrics, which are always non-dominated
+        self.count = 0  # total points added
+        if points is not None:
+            self.extend(points)
+
+    def add(self, point):
+        """
+        Add a point (value, metrics, ...).
+        :return: whether the point is currently non-dominated
+        """
+        self.count += 1
+        metrics = [float(m) for m in point[1]]
+        if any(m != m for m in metrics):
+            self.unordered.append(point)
+            return True
+        if len(metrics) == 2:
+            (x1, x2) = metrics
+            ix = bisect_left(self.f1, x1)
+            if ix > 0 and -self.negf2[ix - 1] < x2:
+                return False
+            jx = bisect_right(self.f1, x1)
+            kx = bisect_left(self.negf2, -x2, jx)
+            del self.points[jx:kx], self.f1[jx:kx], self.negf2[jx:kx]
+            pos = bisect_right(self.negf2, -x2, ix, jx)
+            self.points.insert(pos, point)
+            self.f1.insert(pos, x1)
+            self.negf2.insert(pos, -x2)
+            return True
+        dominates = lambda a, b: all(a[zx] < b[zx] for zx in range(len(a)))
+        if any(dominates(pt[1], metrics) for pt in self.points):
+            return False
+        self.points = [pt for pt in self.points if not dominates(metrics, pt[1])] + [point]
+        return True
+
+    def extend(self, points):
+        """
+        Add a batch of points.  The batch is filtered with nonDominated first.
+        """
+        points = list(points)
+        front = nonDominated(points)
+        self.count += len(points) - len(front)
+        for point in front:
+            self.add(point)
+
+    def front(self):
+        """
+        :return: list of the non-dominated points
+        """
+        return self.points + self.unordered
+
+    def __len__(self):
+        return len(self.points) + len(self.unordered)
+
 def best(points):
     """
     Return the entry which is the best (has the lowest metric).
@@ -145,23 +349,23 @@ def evaluate(obs, sims, correctDatum, metrics = None, useBest = None, usePareto
     :return: list of (parameters, metrics, sim), sorted if useBest is specified, or just one (parameters, metrics)
         if n == 1
     """
-    evtr = evaluator(obs, correctDatum, metrics)
-    evalf = lambda sim: (sim[0], minimized(evtr(sim[1])), sim[1])
-    evaled = [evalf(sim) for sim in sims]
+    raw = BatchEvaluator(obs, correctDatum, metrics).rows([sim[1] for sim in sims])
+    # (parameters, minimized metrics, sim, metrics)
+    evaled = [(sim[0], minimized(raw[ix]), sim[1], raw[ix]) for (ix, sim) in enumerate(sims)]
     if (metrics is not None) and (len(metrics) == 1):
-        working = bestN([(pt[0], pt[1][metrics[0]], pt[2]) for pt in evaled], n)
-        return [(pt[0], evtr(pt[2]), pt[2]) for pt in working]
+        working = bestN([(pt[0], pt[1][metrics[0]], pt[2], pt[3]) for pt in evaled], n)
+        return [(pt[0], pt[3], pt[2]) for pt in working]
     else:
         keys = metrics if metrics is not None else list(tests.keys())  # So that the metrics will be in the same order
-        working = [(pt[0], [pt[1][key] for key in keys], pt[2]) for pt in evaled]
+        working = [(pt[0], [pt[1][key] for key in keys], pt[2], pt[3]) for pt in evaled]
         if usePareto:
-            working = nonDominated(working)
+            with timing.span("pareto"):
+                working = nonDominated(working)
         if useBest is not None:
             keyx = keys.index(useBest)
-            working = [(pt[0], pt[1][keyx], pt[2]) for pt in working]  # Only use the one metric
+            working = [(pt[0], pt[1][keyx], pt[2], pt[3]) for pt in working]  # Only use the one metric
             working = bestN(working, n)
-        return [(pt[0], evtr(pt[2]), pt[2]) for pt in working]
-
+        return [(pt[0], pt[3], pt[2]) for pt in working]
 
 if __name__ == "__main__":
     obs = [1,2,4,8,16]
@@ -0,0 +1,206 @@
+"""
+Analytic normal-depth pre-screening.  Reads the calibration cross-section from the HEC-RAS geometry file and
+uses Manning's equation at normal depth, Q = (k / n) * K(wse) * sqrt(slope), to approximate the simulated stage
+for any n in microseconds.  This narrows the range of n for the actual calibration, so that HEC-RAS runs are
+not spent on physically implausible values.  Conveyance K is summed over the left overbank, channel and right
+overbank (split at the bank stations), as in HEC-RAS, with the same n throughout (as set by modifyN with a
+single number).  Stages are depths above the lowest point of the cross-section, like data.stage.
+
+Copyright (C) 2020 Daniel Philippus
+Full copyright notice located in main.py.
+"""
+
+import os
+import re
+
+import numpy as np
+
+from raspy_cal.midlevel.eval import BatchEvaluator, minimized, nonDominated
+
+
+def fieldsOf(line, width=8):
+    # Fixed-width numeric fields of a geometry file data line
+    return [float(line[ix:ix + width]) for ix in range(0, len(line.rstrip("\n")), width)
+            if line[ix:ix + width].strip() != ""]
+
+
+def fileSetting(path, key):
+    # Value of a "key=value" line in a HEC-RAS project, plan or flow file, or None
+    with open(path, errors="replace") as f:
+        for line in f:
+            if line.startswith(key + "="):
+                return line.split("=", 1)[1].strip()
+    return None
+
+
+def geometryPath(projectPath):
+    """
+    Find the geometry file used by the project's current plan, or if that can't be determined, the first
+    geometry file of the project.
+    :param projectPath: path to the project (.prj) file
+    :return: path to the geometry (.g##) file
+    """
+    stem = os.path.splitext(projectPath)[0]
+    plan = fileSetting(projectPath, "Current Plan")
+    if plan is not None and os.path.exists(stem + "." + plan):
+        geom = fileSetting(stem + "." + plan, "Geom File")
+        if geom is not None and os.path.exists(stem + "." + geom):
+            return stem + "." + geom
+    folder = os.path.dirname(os.path.abspath(projectPath))
+    name = os.path.basename(stem)
+    geoms = sorted(f for f in os.listdir(folder) if f.startswith(name + ".") and re.search(r"\.g\d\d$", f, re.I))
+    if not geoms:
+        raise FileNotFoundError("No geometry file found for %s" % projectPath)
+    return os.path.join(folder, geoms[0])
+
+
+def sameStation(a, b):
+    # River stations are compared numerically if possible, since formatting varies (e.g. "23350." and "23350")
+    try:
+        return float(a.strip().rstrip("*")) == float(b.strip().rstrip("*"))
+    except ValueError:
+        return a.strip() == b.strip()
+
+
+def readCrossSection(geomPath, river, reach, rs):
+    """
+    Read a cross-section from a geometry file.
+    :return: (array of stations, array of elevations, (left bank station, right bank station))
+    """
+    with open(geomPath, errors="replace") as f:
+        lines = f.readlines()
+    (here, found) = (False, False)
+    (points, banks) = (None, None)
+    ix = 0
+    while ix < len(lines):
+        line = lines[ix]
+        if line.startswith("River Reach="):
+            (rv, rc) = (line.split("=", 1)[1].split(",") + [""])[:2]
+            here = rv.strip() == river.strip() and rc.strip() == reach.strip()
+            found = False
+        elif here and line.startswith("Type RM Length L Ch R ="):
+            fields = line.split("=", 1)[1].split(",")
+            if found:
+                break  # end of the cross-section
+            found = fields[0].strip() == "1" and sameStation(fields[1], rs)
+        elif found and line.startswith("#Sta/Elev="):
+            count = int(line.split("=", 1)[1].split()[0])
+            values = []
+            while len(values) < 2 * count:
+                ix += 1
+                values += fieldsOf(lines[ix])
+            points = np.array(values[:2 * count]).reshape((count, 2))
+        elif found and line.startswith("Bank Sta="):
+            banks = tuple(float(b) for b in line.split("=", 1)[1].split(",")[:2])
+        ix += 1
+    if points is None:
+        raise ValueError("Cross-section %s, %s, %s not found in %s" % (river, reach, rs, geomPath))
+    if banks is None:
+        banks = (points[0, 0], points[-1, 0])
+    return (points[:, 0], points[:, 1], banks)
+
+
+def wetted(stations, elevs, wse, walls=(True, True)):
+    """
+    Flow area and wetted perimeter below each water surface elevation.
+    :param wse: array of water surface elevations
+    :param walls: whether the water is bounded by vertical walls (as in HEC-RAS) beyond the (left, right) ends,
+        i.e. whether they are the ends of the whole cross-section rather than subsection boundaries
+    :return: (areas, perimeters), arrays like wse
+    """
+    wse = np.asarray(wse, dtype=float)[:, None]
+    (x0, x1) = (stations[:-1][None, :], stations[1:][None, :])
+    (d0, d1) = (wse - elevs[:-1][None, :], wse - elevs[1:][None, :])
+    dx = x1 - x0
+    # Wet fraction of each segment, from where the water surface crosses it
+    with np.errstate(divide="ignore", invalid="ignore"):
+        frac = np.where((d0 > 0) & (d1 > 0), 1.0,
+                        np.where((d0 > 0) | (d1 > 0), np.maximum(d0, d1) / np.abs(d0 - d1), 0.0))
+    frac = np.nan_to_num(frac)
+    area = np.where((d0 > 0) & (d1 > 0), (d0 + d1) / 2, np.maximum(np.maximum(d0, d1), 0) / 2) * dx * frac
+    perim = np.hypot(dx, d1 - d0) * frac
+    sides = np.maximum(wse[:, 0] - elevs[0], 0) * walls[0] + np.maximum(wse[:, 0] - elevs[-1], 0) * walls[1]
+    return (area.sum(axis=1), perim.sum(axis=1) + sides)
+
+
+class NormalDepth(object):
+    """
+    Normal-depth rating curve for a cross-section.  Conveyance is tabulated on a fine grid of water surface
+    elevations once, after which stages and ns are interpolated from the table.
+    """
+    def __init__(self, stations, elevs, banks, slope, si=False, levels=2000, maxDepth=None):
+        """
+        :param stations: cross-section stations
+        :param elevs: cross-section elevations
+        :param banks: (left bank station, right bank station)
+        :param slope: friction slope
+        :param si: SI units (k = 1) instead of US customary (k = 1.486)
+        :param levels: number of tabulated water surface elevations
+        :param maxDepth: deepest tabulated depth, default twice the height of the section
+        """
+        (stations, elevs) = (np.asarray(stations, dtype=float), np.asarray(elevs, dtype=float))
+        self.bottom = elevs.min()
+        maxDepth = 2 * (elevs.max() - self.bottom) if maxDepth is None else maxDepth
+        self.depths = np.linspace(0, maxDepth, levels + 1)[1:]
+        conveyance = np.zeros(levels)
+        # Subsections: left overbank, channel, right overbank
+        for (lo, hi) in [(stations[0], banks[0]), (banks[0], banks[1]), (banks[1], stations[-1])]:
+            inside = (stations >= lo) & (stations <= hi)
+            if inside.sum() < 2:
+                continue
+            (area, perim) = wetted(stations[inside], elevs[inside], self.bottom + self.depths,
+                                   (lo == stations[0], hi == stations[-1]))
+            with np.errstate(divide="ignore", invalid="ignore"):
+                conveyance += np.where(perim > 0, area ** (5 / 3) / perim ** (2 / 3), 0)
+        self.conveyance = np.maximum.accumulate(conveyance)  # guard against tiny numerical decreases
+        self.factor = (1.0 if si else 1.486) * np.sqrt(slope)
+
+    def stage(self, n, flows):
+        """
+        :param n: Manning's n (number or array, broadcast against flows)
+        :param flows: flows
+        :return: array of normal depths
+        """
+        needed = np.asarray(n, dtype=float) * np.asarray(flows, dtype=float) / self.factor
+        return np.interp(needed, self.conveyance, self.depths)
+
+    def invertN(self, flows, stages):
+        """
+        :return: array of the n that gives each observed stage (depth) at each flow
+        """
+        return self.factor * np.interp(stages, self.depths, self.conveyance) / np.asarray(flows, dtype=float)
+
+
+def loadNormalDepth(projectPath, river, reach, rs, slope, si=False):
+    """
+    :return: NormalDepth for the cross-section in the project's current geometry file
+    """
+    (stations, elevs, banks) = readCrossSection(geometryPath(projectPath), river, reach, rs)
+    return NormalDepth(stations, elevs, banks, slope, si)
+
+
+def prescreen(normal, flows, stages, metrics, correctDatum, nmin=0.001, nmax=1, grid=500, margin=1.5):
+    """
+    Evaluate a log-spaced grid of ns with the normal-depth approximation and propose a range for calibration.
+    :param normal: NormalDepth
+    :param flows: observed flows
+    :param stages: observed stages
+    :param metrics: list of metric names, or None for all
+    :param correctDatum: whether to adjust the datum between observed and simulated stages
+    :param nmin: smallest n to consider
+    :param nmax: largest n to consider
+    :param grid: number of ns to evaluate
+    :param margin: widen the range of the best ns by this factor in each direction, since normal depth is only an
+        approximation of the model
+    :return: (nmin, nmax, list of the best ns in the approximation)
+    """
+    ns = np.logspace(np.log10(nmin), np.log10(nmax), grid)
+    sims = normal.stage(ns[:, None], np.asarray(flows, dtype=float)[None, :])
+    evaluator = BatchEvaluator(stages, correctDatum, metrics)
+    rows = [minimized(row) for row in evaluator.rows(sims)]
+    points = [(float(n), [row[key] for key in evaluator.keys]) for (n, row) in zip(ns, rows)]
+    if len(evaluator.keys) == 1:
+        best = [min(points, key=lambda pt: pt[1][0])[0]]
+    else:
+        best = [pt[0] for pt in nonDominated(points)]
+    return (max(min(best) / margin, nmin), min(max(best) * margin, nmax), sorted(best))
@@ -6,9 +6,15 @@ Copyright (C) 2020 Daniel Philippus
 Full copyright notice located in main.py.
 """
 
+import itertools
+import math
 import random
+import warnings
 
-def paramSpec(name, min, max, n = 10, random = False):
+# Joint sampling designs (see iterParams): scipy.stats.qmc engine names
+designs = {"lhs": "LatinHypercube", "sobol": "Sobol", "halton": "Halton"}
+
+def paramSpec(name, min, max, n = 10, random = False, log = False):
     """
     Specifies a parameter suitable for use in genParams.  Just doing it this way because a class
     seemed excessive.
@@ -16,7 +22,9 @@ def paramSpec(name, min, max, n = 10, random = False):
     :param min: minimum value of parameter
     :param max: maximum value of parameter
     :param n: how many variants to generate
-    :param random: generate variants randomly instead of evenly spaced
+    :param random: how to generate variants: False (or "grid") for evenly spaced, True (or "random") for uniformly
+        random, or "lhs", "sobol" or "halton" to sample jointly with the other parameters (see iterParams)
+    :param log: space or sample the variants evenly in log10 of the parameter instead (min and max must be positive)
     :return: just a dictionary with the above information
     """
     return {
@@ -24,9 +32,22 @@ def paramSpec(name, min, max, n = 10, random = False):
         "min": min,
         "max": max,
         "n": n,
-        "random": random
+        "random": random,
+        "log": log
     }
 
+def method(ps):
+    # Normalized generation method of a paramSpec
+    m = ps["random"]
+    return "random" if m is True else "grid" if m is False or m is None else m
+
+def scale(ps, u):
+    # Map u in [0, 1] to the parameter's range
+    if ps.get("log", False):
+        (lmin, lmax) = (math.log10(ps["min"]), math.log10(ps["max"]))
+        return 10 ** (lmin + u * (lmax - lmin))
+    return ps["min"] + u * (ps["max"] - ps["min"])
+
 def mkCombs(lists):
     """
     Make all possible combinations of the elements in the lists, in order
@@ -38,38 +59,99 @@ def mkCombs(lists):
         out = [ox + [lx] for lx in l for ox in out]
     return out
 
-def genParams(paramSpecs, dicts = True):
+def iterCombs(lists):
+    """
+    Lazily generate all combinations of the elements in the lists, in the same order as mkCombs (the first list
+    varies fastest).
+    :return: iterator of combinations (lists)
+    """
+    for comb in itertools.product(*reversed(lists)):
+        yield list(reversed(comb))
+
+def iterDesign(paramSpecs, seed = None, chunk = 1024):
+    """
+    Lazily sample points jointly from a low-discrepancy (Sobol, Halton) or Latin hypercube design.  All of the
+    paramSpecs must use the same design; the number of points is the largest n.
+    :param seed: random seed (the designs are scrambled/randomized), or None for a random one
+    :param chunk: number of points to draw at a time
+    :return: iterator of lists of values
+    """
+    from scipy.stats import qmc
+    names = set(method(ps) for ps in paramSpecs)
+    if len(names) != 1:
+        raise ValueError("Joint sampling designs can't be mixed with other methods: %s" % sorted(names))
+    name = names.pop()
+    count = max(ps["n"] for ps in paramSpecs)
+    if name == "lhs":
+        # Latin hypercube strata depend on the total number of points, so the design is drawn at once
+        # (only count x parameters values)
+        blocks = [qmc.LatinHypercube(d=len(paramSpecs), seed=seed).random(count)]
+    else:
+        engine = getattr(qmc, designs[name])(d=len(paramSpecs), scramble=True, seed=seed)
+        blocks = (engine.random(min(chunk, count - start)) for start in range(0, count, chunk))
+    with warnings.catch_warnings():
+        # Sobol warns about counts that aren't powers of 2, which is fine for a truncated sequence
+        warnings.simplefilter("ignore", UserWarning)
+        for block in blocks:
+            for row in block:
+                yield [scale(ps, float(u)) for (ps, u) in zip(paramSpecs, row)]
+
+def iterParams(paramSpecs, dicts = True, seed = None):
+    """
+    Lazily generate combinations of parameters, in constant memory.  Parameters generated by grid or random
+    variants (see paramSpec) are combined in every combination, as in genParams.  Parameters using a joint design
+    ("lhs", "sobol", "halton") are instead sampled together as max(n) points, which covers the space with far
+    fewer points than the combinations of per-parameter variants.
+    :param paramSpecs: a list of dictionaries like those generated by paramSpec()
+    :param dicts: yield dictionaries with the parameters named, instead of lists
+    :param seed: random seed, or None to use the random module's state (and an unseeded design)
+    :return: iterator of dictionaries {name: value}, lists of values or, for a single parameter with dicts False,
+        values
+    """
+    if any(method(ps) in designs for ps in paramSpecs):
+        combs = iterDesign(paramSpecs, seed)
+    else:
+        rand = random if seed is None else random.Random(seed)
+        plists = []
+        for ps in paramSpecs:
+            if method(ps) == "random":
+                plists.append([scale(ps, rand.random()) if ps.get("log", False) else
+                               rand.uniform(ps["min"], ps["max"]) for _ in range(ps["n"])])
+            elif ps.get("log", False):
+                plists.append([scale(ps, i / (ps["n"] - 1)) for i in range(ps["n"])])
+            else:
+                plists.append(
+                    [i * (ps["max"] - ps["min"]) / (ps["n"] - 1) + ps["min"] for i in range(ps["n"])]
+                )
+        combs = iterCombs(plists)
+    for comb in combs:
+        if dicts:
+            yield {paramSpecs[i]["name"]: comb[i] for i in range(len(comb))}
+        elif len(comb) > 1:
+            yield comb
+        else:
+            yield comb[0]  # Allows for use with a single parameter
+
+def chunked(iterable, size):
+    """
+    Split an iterable (e.g. from iterParams) into lists of at most size items, lazily.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def genParams(paramSpecs, dicts = True, seed = None):
     """
     Generate combinations of parameters.
     :param paramSpecs: a list of dictionaries like those generated by paramSpec()
     :param dicts: return a list of dictionaries with the parameters named, instead of just a list of lists
+    :param seed: random seed (see iterParams)
     :return: a list of dictionaries {name: value} of parameter combinations, or a list of lists
     """
-    out = []
-    plists = []
-    for ps in paramSpecs:
-        if ps["random"]:
-            plists.append([
-                random.uniform(ps["min"], ps["max"]) for _ in range(ps["n"])
-            ])
-        else:
-            plists.append(
-                [i * (ps["max"] - ps["min"]) / (ps["n"] - 1) + ps["min"] for i in range(ps["n"])]
-            )
-    combs = mkCombs([range(ps["n"]) for ps in paramSpecs])
-    for cx in combs:
-        if dicts:
-            out.append({
-                paramSpecs[i]["name"]: plists[i][cx[i]] for i in range(len(cx))
-            })
-        else:
-            out.append([
-                plists[i][cx[i]] for i in range(len(cx))
-            ])
-    if dicts or len(out[0]) > 1:
-        return out
-    else:
-        return [i[0] for i in out] # Allows for use with a single parameter
+    return list(iterParams(paramSpecs, dicts, seed))
 
 if __name__ == "__main__":
     # For debugging
@@ -0,0 +1,50 @@
+"""
+Single-objective optimization of Manning's n: bounded Brent search in log n, optionally from several starting
+intervals.  With only one metric, this finds the optimum in far fewer simulations than a genetic algorithm.
+
+Copyright (C) 2020 Daniel Philippus
+Full copyright notice located in main.py.
+"""
+
+import math
+
+from scipy.optimize import minimize_scalar
+
+
+def brentOptimize(objective, nmin, nmax, budget, tol=1e-3, starts=1, log=True):
+    """
+    Minimize objective over n in [nmin, nmax].
+    :param objective: function taking n and returning the metric (lower is better)
+    :param nmin: minimum n
+    :param nmax: maximum n
+    :param budget: maximum number of evaluations, shared between starts
+    :param tol: tolerance in log10(n)
+    :param starts: number of equal subintervals of log n to search separately, for multimodal metrics
+    :param log: print progress
+    :return: (list of (n, metric) for all evaluations, best (n, metric))
+    """
+    evaluated = []
+
+    def f(logn):
+        n = 10 ** logn
+        value = objective(n)
+        # Failed evaluations (NaN) are treated as infinitely bad so the search moves away from them
+        evaluated.append((n, value))
+        return value if value == value else math.inf
+
+    (lmin, lmax) = (math.log10(nmin), math.log10(nmax))
+    width = (lmax - lmin) / starts
+    for ix in range(starts):
+        remaining = budget - len(evaluated)
+        if remaining <= 0:
+            break
+        maxiter = remaining // (starts - ix)
+        if maxiter < 1:
+            continue
+        res = minimize_scalar(f, bounds=(lmin + ix * width, lmin + (ix + 1) * width), method="bounded",
+                              options={"xatol": tol, "maxiter": maxiter})
+        if log:
+            print("Search %d of %d %s after %d evaluations" % (ix + 1, starts, "converged" if res.success else
+                                                               "stopped at the budget", len(evaluated)))
+    best = min(evaluated, key=lambda ev: ev[1] if ev[1] == ev[1] else math.inf)
+    return (evaluated, best)
@@ -0,0 +1,131 @@
+"""
+Asynchronous steady-state multi-objective evolutionary optimization of Manning's n.  Unlike generational NSGA-II,
+there is no barrier between generations: whenever an evaluation finishes, it joins the population (which is then
+trimmed by non-dominated rank and crowding distance) and a new offspring is dispatched straight away, so that
+every model instance stays busy even when simulation times vary.
+
+Copyright (C) 2020 Daniel Philippus
+Full copyright notice located in main.py.
+"""
+
+import math
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from raspy_cal.midlevel.eval import ParetoArchive
+
+
+def dominates(a, b):
+    # Standard Pareto dominance (no worse in every metric and better in at least one)
+    return all(x <= y for (x, y) in zip(a, b)) and any(x < y for (x, y) in zip(a, b))
+
+
+def rankCrowding(values):
+    """
+    Non-dominated sorting and crowding distance, as in NSGA-II.
+    :param values: list of metric lists (lower is better, NaN treated as infinite)
+    :return: (ranks, crowding distances), lists in the order of values
+    """
+    values = [[math.inf if v != v else v for v in vals] for vals in values]
+    ranks = [None] * len(values)
+    remaining = set(range(len(values)))
+    rank = 0
+    while remaining:
+        front = [ix for ix in remaining if not any(dominates(values[jx], values[ix]) for jx in remaining)]
+        for ix in front:
+            ranks[ix] = rank
+        remaining -= set(front)
+        rank += 1
+    crowding = [0.0] * len(values)
+    for r in set(ranks):
+        members = [ix for ix in range(len(values)) if ranks[ix] == r]
+        for m in range(len(values[0])):
+            members.sort(key=lambda ix: values[ix][m])
+            (low, high) = (values[members[0]][m], values[members[-1]][m])
+            crowding[members[0]] = crowding[members[-1]] = math.inf
+            if high > low and high < math.inf:
+                for k in range(1, len(members) - 1):
+                    crowding[members[k]] += (values[members[k + 1]][m] - values[members[k - 1]][m]) / (high - low)
+    return (ranks, crowding)
+
+
+def sbx(a, b, rng, eta=15.0):
+    # Simulated binary crossover of two values in [0, 1], returning one child
+    u = rng.random()
+    beta = (2 * u) ** (1 / (eta + 1)) if u <= 0.5 else (1 / (2 * (1 - u))) ** (1 / (eta + 1))
+    child = 0.5 * ((1 + beta) * a + (1 - beta) * b) if rng.random() < 0.5 else 0.5 * ((1 - beta) * a + (1 + beta) * b)
+    return min(max(child, 0.0), 1.0)
+
+
+def mutate(x, rng, eta=20.0):
+    # Polynomial mutation of a value in [0, 1]
+    u = rng.random()
+    delta = (2 * u) ** (1 / (eta + 1)) - 1 if u < 0.5 else 1 - (2 * (1 - u)) ** (1 / (eta + 1))
+    return min(max(x + delta, 0.0), 1.0)
+
+
+def steadyStateOptimize(objective, nmin, nmax, budget, popsize, workers=1, seed=None, log=True):
+    """
+    Minimize the metrics returned by objective over n in [nmin, nmax], searching in log n, with up to workers
+    evaluations running at once.  objective must be safe to call from several threads if workers > 1 (e.g.
+    running on a ModelPool with at least that many instances).
+    :param objective: function taking n and returning a list of metrics (lower is better)
+    :param budget: total number of evaluations
+    :param popsize: population size
+    :param workers: number of concurrent evaluations
+    :param seed: random seed, or None to draw one from the random module
+    :param log: print worker utilization at the end
+    :return: (list of (n, metrics) for all evaluations, list of (n, metrics) on the Pareto front,
+        worker utilization as a fraction)
+    """
+    rng = random.Random(random.randrange(2 ** 32) if seed is None else seed)
+    (lmin, lmax) = (math.log10(nmin), math.log10(nmax))
+    toN = lambda u: 10 ** (lmin + u * (lmax - lmin))
+    population = []  # [(u, metrics)]
+    evaluated = []
+    pending = {}
+    state = {"submitted": 0, "busy": 0.0, "ranks": [], "crowding": []}
+
+    def timedObjective(n):
+        start = time.perf_counter()
+        values = list(objective(n))
+        return (values, time.perf_counter() - start)
+
+    def tournament():
+        (a, b) = (rng.randrange(len(population)), rng.randrange(len(population)))
+        (ranks, crowding) = (state["ranks"], state["crowding"])
+        return population[a if (ranks[a], -crowding[a]) <= (ranks[b], -crowding[b]) else b][0]
+
+    def dispatch(executor):
+        if len(population) < 2 or state["submitted"] < popsize:
+            u = rng.random()  # initial population
+        else:
+            u = mutate(sbx(tournament(), tournament(), rng), rng)
+        pending[executor.submit(timedObjective, toN(u))] = u
+        state["submitted"] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while state["submitted"] < min(workers, budget):
+            dispatch(executor)
+        while pending:
+            (done, _) = wait(list(pending.keys()), return_when=FIRST_COMPLETED)
+            for future in done:
+                u = pending.pop(future)
+                (values, elapsed) = future.result()
+                state["busy"] += elapsed
+                evaluated.append((toN(u), values))
+                population.append((u, values))
+                (ranks, crowding) = rankCrowding([p[1] for p in population])
+                if len(population) > popsize:
+                    worst = max(range(len(population)), key=lambda ix: (ranks[ix], -crowding[ix]))
+                    del population[worst], ranks[worst], crowding[worst]
+                (state["ranks"], state["crowding"]) = (ranks, crowding)
+                if state["submitted"] < budget:
+                    dispatch(executor)
+    wall = time.perf_counter() - start
+    utilization = state["busy"] / (wall * workers) if wall > 0 else 1.0
+    if log:
+        print("Worker utilization: %.1f%% of %d workers over %.1f s" % (100 * utilization, workers, wall))
+    return (evaluated, ParetoArchive(evaluated).front(), utilization)
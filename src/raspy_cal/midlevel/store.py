@@ -0,0 +1,183 @@
+"""
+Array-backed store of simulation results, so that results can be re-scored (different metrics, datum correction
+or selection) after a run without running HEC-RAS again.
+
+A SimulationSet holds a (sims x params) array of the parameters (n, or one n per gage), a (sims x values) array
+of the simulated stages and metadata: the flows and observed stages needed for scoring, the locations and the
+settings of the run.  For several locations, each row of stages is the locations' stages one after the other.
+
+Sets are saved as a single compressed .npz file, or as a store directory written by SimulationStream while a
+run is going: meta.json and the raw float64 rows in params.f64 and sims.f64, appended as each simulation
+completes and read back as memory maps.
+
+Copyright (C) 2020 Daniel Philippus
+Full copyright notice located in main.py.
+"""
+
+import json
+import os
+import threading
+
+import numpy as np
+
+from raspy_cal.midlevel.eval import BatchEvaluator, combined, evaluate, nonDominated, tests
+
+META = "meta.json"
+PARAMS = "params.f64"
+SIMS = "sims.f64"
+
+
+def mkMeta(flows, observed, locations, paramNames=("n",), **extra):
+    """
+    :param flows: flow profiles
+    :param observed: list of observed stages for each location
+    :param locations: list of (river, reach, rs)
+    :param paramNames: name of each parameter column
+    :param extra: anything else JSON-serializable to record, e.g. correctDatum, metrics, si, project
+    :return: metadata dictionary for a SimulationSet
+    """
+    return dict(extra, flows=[float(q) for q in flows], observed=[[float(s) for s in obs] for obs in observed],
+                locations=[list(loc) for loc in locations], paramNames=list(paramNames))
+
+
+class SimulationSet(object):
+    def __init__(self, params, sims, meta):
+        """
+        :param params: (sims x params) array
+        :param sims: (sims x (locations * profiles)) array of simulated stages
+        :param meta: metadata (see mkMeta)
+        """
+        self.meta = meta
+        self.nprofs = len(meta["flows"])
+        self.params = np.asarray(params, dtype=float).reshape((-1, len(meta["paramNames"])))
+        self.sims = np.asarray(sims, dtype=float).reshape((-1, len(meta["locations"]) * self.nprofs))
+
+    def __len__(self):
+        return len(self.params)
+
+    def stages(self, location=0):
+        # (sims x profiles) array of simulated stages at the location (index into meta["locations"])
+        return self.sims[:, location * self.nprofs:(location + 1) * self.nprofs]
+
+    def unique(self):
+        # Indices of the first simulation of each distinct set of parameters (e.g. repeated by a resumed run)
+        return np.sort(np.unique(self.params, axis=0, return_index=True)[1])
+
+    @classmethod
+    def fromResults(cls, results, meta):
+        """
+        :param results: [(n, sim)] for one location or [(ns, [sim for each location])] for several
+        """
+        params = [res[0] for res in results]
+        sims = [np.concatenate([np.ravel(s) for s in res[1]]) if len(meta["locations"]) > 1 else res[1]
+                for res in results]
+        return cls(params, sims, meta)
+
+    def save(self, path):
+        # Save as a compressed .npz file
+        np.savez_compressed(path, params=self.params, sims=self.sims, meta=np.array(json.dumps(self.meta)))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a .npz file or a store directory (see SimulationStream); the arrays of a store directory are
+        memory-mapped rather than read into memory.
+        """
+        if os.path.isdir(path):
+            with open(os.path.join(path, META)) as f:
+                meta = json.load(f)
+            widths = (len(meta["paramNames"]), len(meta["locations"]) * len(meta["flows"]))
+            (params, sims) = [mapRows(os.path.join(path, name), width)
+                              for (name, width) in zip([PARAMS, SIMS], widths)]
+            count = min(len(params), len(sims))  # a row may be incomplete if a run was interrupted
+            return cls(params[:count], sims[:count], meta)
+        with np.load(path) as data:
+            return cls(data["params"], data["sims"], json.loads(str(data["meta"])))
+
+
+def mapRows(path, width):
+    # Memory-map the complete rows of a raw float64 file
+    count = os.path.getsize(path) // (8 * width) if os.path.exists(path) else 0
+    if count == 0:
+        return np.zeros((0, width))
+    return np.memmap(path, dtype=np.float64, mode="r", shape=(count, width))
+
+
+class SimulationStream(object):
+    """
+    Appends simulations to a store directory as they complete, so that the results of a run (even an
+    interrupted one) can be loaded with SimulationSet.load.  Safe to append to from several threads.
+    """
+    def __init__(self, path, meta, append=False):
+        """
+        :param path: store directory (created if needed)
+        :param meta: metadata (see mkMeta)
+        :param append: keep simulations already in the store (e.g. when resuming a run) rather than starting over;
+            the store must be for the same locations, flows and observations
+        """
+        self.path = path
+        self.meta = meta
+        os.makedirs(path, exist_ok=True)
+        metaPath = os.path.join(path, META)
+        if append and os.path.exists(metaPath):
+            with open(metaPath) as f:
+                old = json.load(f)
+            if any(old[key] != meta[key] for key in ["flows", "observed", "locations", "paramNames"]):
+                raise ValueError("Simulation store %s is for different locations or observations" % path)
+            # Drop any incomplete row from an interrupted run
+            old = SimulationSet.load(path)
+            for (name, rows) in [(PARAMS, old.params), (SIMS, old.sims)]:
+                with open(os.path.join(path, name), "r+b") as f:
+                    f.truncate(len(old) * rows.shape[1] * 8)
+            mode = "ab"
+        else:
+            mode = "wb"
+        with open(metaPath, "w") as f:
+            json.dump(meta, f, indent=1)
+        self.files = [open(os.path.join(path, name), mode) for name in [PARAMS, SIMS]]
+        self.lock = threading.Lock()
+
+    def append(self, params, sim):
+        """
+        :param params: n, or list of ns
+        :param sim: simulated stages, or list of simulated stages for each location
+        """
+        rows = [np.ravel(np.asarray(params, dtype=np.float64)),
+                np.concatenate([np.ravel(np.asarray(s, dtype=np.float64)) for s in sim])
+                if len(self.meta["locations"]) > 1 else np.asarray(sim, dtype=np.float64)]
+        with self.lock:
+            for (f, row) in zip(self.files, rows):
+                f.write(row.tobytes())
+                f.flush()
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+
+def rescore(simset, metrics=None, correctDatum=None, n=10):
+    """
+    Evaluate stored simulations, as the calibrators would have.
+    :param simset: SimulationSet
+    :param metrics: list of metric names, or None for those of the run (or all, if not recorded)
+    :param correctDatum: whether to adjust the datum, or None for the setting of the run
+    :param n: number of results to keep for a single metric at a single location
+    Simulations with the same parameters as an earlier one are skipped.
+    :return: for one location, [(n, metrics, sim)] as from eval.evaluate: the non-dominated results, or the best n
+        for a single metric; for several locations, [(ns, [metrics for each location], [sim for each location])]
+        for the results non-dominated in the combined score of each location, as from multi-gage calibration
+    """
+    metrics = simset.meta.get("metrics") if metrics is None else metrics
+    correctDatum = bool(simset.meta.get("correctDatum")) if correctDatum is None else correctDatum
+    observed = simset.meta["observed"]
+    unique = simset.unique()
+    params = simset.params[unique]
+    stages = [np.asarray(simset.stages(ix))[unique] for ix in range(len(observed))]
+    if len(observed) == 1:
+        return evaluate(observed[0], list(zip(params[:, 0].tolist(), stages[0].tolist())), correctDatum,
+                        metrics=metrics, n=n)
+    keys = metrics if metrics is not None else list(tests.keys())
+    rows = [BatchEvaluator(obs, correctDatum, keys).rows(stages[ix]) for (ix, obs) in enumerate(observed)]
+    points = [(ix, [combined(loc[ix], obs) for (loc, obs) in zip(rows, observed)]) for ix in range(len(params))]
+    return [(tuple(params[ix].tolist()), [loc[ix] for loc in rows], [st[ix].tolist() for st in stages])
+            for (ix, _) in nonDominated(points)]
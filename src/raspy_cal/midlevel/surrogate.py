@@ -0,0 +1,125 @@
+"""
+Surrogate-assisted optimization of Manning's n.  Each metric is a smooth function of n, so a Gaussian process
+fitted to the simulations so far can choose the next n to simulate, instead of spending a full genetic algorithm
+population on the model.  Multiple metrics are handled ParEGO-style: each step scalarizes the normalized metrics
+with random weights (augmented Chebyshev) and picks the n with the greatest expected improvement in that.
+
+Copyright (C) 2020 Daniel Philippus
+Full copyright notice located in main.py.
+"""
+
+import random
+
+import numpy as np
+from scipy.linalg import solve_triangular
+from scipy.stats import norm
+
+from raspy_cal.midlevel.eval import ParetoArchive
+
+# Length scales tried when fitting, as fractions of the search range (in log n)
+lengthScales = [0.02, 0.05, 0.1, 0.2, 0.35, 0.5, 1.0]
+
+
+def gpFit(x, y, nugget=1e-6):
+    """
+    Fit a zero-mean Gaussian process with a squared exponential kernel to standardized y, choosing the length scale
+    from lengthScales by marginal likelihood (signal variance profiled out).
+    :param x: array of inputs (scaled to [0, 1])
+    :param y: array of standardized outputs
+    :return: dictionary of the fitted model for gpPredict
+    """
+    best = None
+    for scale in lengthScales:
+        K = np.exp(-(x[:, None] - x[None, :]) ** 2 / (2 * scale ** 2)) + nugget * np.eye(len(x))
+        try:
+            L = np.linalg.cholesky(K)
+        except np.linalg.LinAlgError:
+            continue
+        alpha = solve_triangular(L.T, solve_triangular(L, y, lower=True), lower=False)
+        var = max(float(y @ alpha) / len(x), 1e-12)
+        lml = -len(x) / 2 * np.log(var) - np.sum(np.log(np.diag(L)))
+        if best is None or lml > best["lml"]:
+            best = {"x": x, "L": L, "alpha": alpha, "var": var, "scale": scale, "lml": lml}
+    return best
+
+
+def gpPredict(model, xs):
+    """
+    :return: (mean, standard deviation) arrays at xs
+    """
+    k = np.exp(-(xs[:, None] - model["x"][None, :]) ** 2 / (2 * model["scale"] ** 2))
+    mean = k @ model["alpha"]
+    v = solve_triangular(model["L"], k.T, lower=True)
+    sd = np.sqrt(np.maximum(model["var"] * (1 - np.sum(v ** 2, axis=0)), 0))
+    return (mean, sd)
+
+
+def expectedImprovement(mean, sd, best):
+    # Expected improvement (minimization) over best
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = (best - mean) / sd
+        ei = (best - mean) * norm.cdf(z) + sd * norm.pdf(z)
+    return np.where(sd > 0, ei, 0)
+
+
+def scalarize(values, weights, rho=0.05):
+    """
+    Normalize each metric to [0, 1] and combine with augmented Chebyshev scalarization.
+    :param values: (evaluations x metrics) array, lower is better
+    :return: array of scalarized values
+    """
+    values = np.array(values, dtype=float)
+    for col in range(values.shape[1]):
+        # Failed evaluations (NaN/inf) are treated as the worst seen
+        finite = np.isfinite(values[:, col])
+        worst = values[finite, col].max() if finite.any() else 1
+        values[~finite, col] = worst
+    low = values.min(axis=0)
+    span = values.max(axis=0) - low
+    scaled = (values - low) / np.where(span > 0, span, 1)
+    weighted = scaled * weights
+    return weighted.max(axis=1) + rho * weighted.sum(axis=1)
+
+
+def surrogateOptimize(objective, nmin, nmax, budget, initial=5, tol=1e-3, patience=3, candidates=2000,
+                      seed=None, log=True):
+    """
+    Minimize the metrics returned by objective over n in [nmin, nmax], searching in log n.
+    :param objective: function taking n and returning a list of metrics (lower is better)
+    :param nmin: minimum n
+    :param nmax: maximum n
+    :param budget: maximum number of evaluations
+    :param initial: number of initial evaluations (stratified random in log n)
+    :param tol: stop once the best expected improvement (in standard deviations of the scalarized metrics) is below
+        this for patience consecutive steps
+    :param patience: see tol
+    :param candidates: number of candidate ns to compare by expected improvement each step
+    :param seed: random seed, or None to draw one from the random module
+    :param log: print progress
+    :return: (list of (n, metrics) for all evaluations, list of (n, metrics) on the Pareto front)
+    """
+    rng = np.random.default_rng(random.randrange(2 ** 32) if seed is None else seed)
+    (lmin, lmax) = (np.log10(nmin), np.log10(nmax))
+    toN = lambda u: float(10 ** (lmin + u * (lmax - lmin)))
+    grid = np.linspace(0, 1, candidates)
+    us = list((np.arange(min(initial, budget)) + rng.random(min(initial, budget))) / min(initial, budget))
+    evaluated = [(toN(u), list(objective(toN(u)))) for u in us]
+    quiet = 0
+    while len(evaluated) < budget:
+        values = [ev[1] for ev in evaluated]
+        weights = rng.dirichlet(np.ones(len(values[0])))
+        y = scalarize(values, weights)
+        ystd = y.std() if y.std() > 0 else 1
+        y = (y - y.mean()) / ystd
+        model = gpFit(np.array(us), y)
+        (mean, sd) = gpPredict(model, grid)
+        ei = expectedImprovement(mean, sd, y.min())
+        ix = int(np.argmax(ei))
+        quiet = quiet + 1 if ei[ix] < tol else 0
+        if quiet >= patience:
+            if log:
+                print("Surrogate converged after %d evaluations" % len(evaluated))
+            break
+        us.append(float(grid[ix]))
+        evaluated.append((toN(grid[ix]), list(objective(toN(grid[ix])))))
+    return (evaluated, ParetoArchive(evaluated).front())
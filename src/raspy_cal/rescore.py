@@ -0,0 +1,75 @@
+"""
+Re-score stored simulations (see midlevel.store) with different metrics or datum correction, without running
+HEC-RAS.  Run with `python -m raspy_cal.rescore <store> [options]` or `raspy-cal RESCORE <store> [options]`
+(see main).  Writes the metrics table, data CSV and plot as a calibration run would.
+
+Copyright (C) 2020 Daniel Philippus
+Full copyright notice located in main.py.
+"""
+
+import argparse
+import os
+
+from raspy_cal.midlevel.eval import tests
+from raspy_cal.midlevel.store import SimulationSet, rescore
+from raspy_cal.frontend.display import nDisplay
+
+
+def rescoreStore(path, outf, metrics=None, correctDatum=None, n=10, plot=False, npz=None):
+    """
+    Re-score a stored set of simulations and write the results.
+    :param path: .npz file or store directory
+    :param outf: output CSV path; for several gages, one per gage with the gage name appended
+    :param metrics: list of metric names, or None for those of the original run
+    :param correctDatum: whether to adjust the datum, or None for the setting of the original run
+    :param n: number of results to keep for a single metric
+    :param plot: whether to show the plot (it is saved either way)
+    :param npz: optional path to also save the simulations to as a single .npz file
+    :return: results as from midlevel.store.rescore
+    """
+    simset = SimulationSet.load(path)
+    if npz is not None:
+        simset.save(npz)
+    print("Re-scoring %d simulations from %s" % (len(simset), path))
+    results = rescore(simset, metrics, correctDatum, n)
+    meta = simset.meta
+    correctDatum = bool(meta.get("correctDatum")) if correctDatum is None else correctDatum
+    si = bool(meta.get("si"))
+    (stem, ext) = os.path.splitext(outf)
+    if len(meta["locations"]) == 1:
+        nDisplay(results, meta["flows"], meta["observed"][0], stem + ".png", outf, plot, correctDatum, si)
+        return results
+    for (ix, name) in enumerate(meta["paramNames"]):
+        print("Gage %s:" % name)
+        gagePath = "%s-%s%s" % (stem, name, ext)
+        nDisplay([(res[0][ix], res[1][ix], res[2][ix]) for res in results], meta["flows"], meta["observed"][ix],
+                 os.path.splitext(gagePath)[0] + ".png", gagePath, plot, correctDatum, si)
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="python -m raspy_cal.rescore",
+                                     description="Re-score stored simulations without running HEC-RAS.")
+    parser.add_argument("store", help="simulation store directory or .npz file")
+    parser.add_argument("--out", default=None, help="output CSV path (default: <store>-rescored.csv)")
+    parser.add_argument("--metrics", default=None,
+                        help="comma-separated metrics (default: those of the run); options: %s" % ",".join(tests))
+    datum = parser.add_mutually_exclusive_group()
+    datum.add_argument("--datum", dest="datum", action="store_true", default=None, help="correct the datum")
+    datum.add_argument("--no-datum", dest="datum", action="store_false", help="don't correct the datum")
+    parser.add_argument("--best", type=int, default=10, help="results to keep for a single metric (default: 10)")
+    parser.add_argument("--plot", action="store_true", help="show the plot")
+    parser.add_argument("--npz", default=None, help="also save the simulations to this .npz file")
+    opts = parser.parse_args(args)
+    metrics = None if opts.metrics is None else [m.strip() for m in opts.metrics.split(",")]
+    unknown = [m for m in (metrics or []) if m not in tests]
+    if unknown:
+        parser.error("unknown metrics %s" % unknown)
+    outf = opts.out if opts.out is not None else\
+        os.path.splitext(os.path.normpath(opts.store))[0] + "-rescored.csv"
+    rescoreStore(opts.store, outf, metrics, opts.datum, opts.best, opts.plot, opts.npz)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -45,6 +45,31 @@ class Settings(object):
         self.si = None
         self.flow = None
         self.stage = None
+        self.workers = None
+        self.cache = None
+        self.cachesize = None
+        self.engine = None
+        self.tol = None
+        self.starts = None
+        self.gages = None
+        self.usgscache = None
+        self.usgsstat = None
+        self.checkpoint = None
+        self.checkpointevery = None
+        self.resume = None
+        self.timing = None
+        self.prescreen = None
+        self.nmin = None
+        self.nmax = None
+        self.sampling = None
+        self.logn = None
+        self.chunk = None
+        self.refine = None
+        self.refinefactor = None
+        self.refinetol = None
+        self.store = None
+        self.streamcsv = None
+        self.backgroundplot = None
 
     def specify(self,
                 project=None,
@@ -69,7 +94,32 @@ class Settings(object):
                 si=False,
                 version=None,
                 stage=None,
-                flow=None
+                flow=None,
+                workers=None,
+                cache=None,
+                cachesize=None,
+                engine=None,
+                tol=None,
+                starts=None,
+                gages=None,
+                usgscache=None,
+                usgsstat=None,
+                checkpoint=None,
+                checkpointevery=None,
+                resume=None,
+                timing=None,
+                prescreen=None,
+                nmin=None,
+                nmax=None,
+                sampling=None,
+                logn=None,
+                chunk=None,
+                refine=None,
+                refinefactor=None,
+                refinetol=None,
+                store=None,
+                streamcsv=None,
+                backgroundplot=None
                 ):
         # Set up initial settings with one call.
 
@@ -125,6 +175,62 @@ class Settings(object):
             self.si = si
         if version is not None:
             self.version = version
+        if workers is not None:
+            self.workers = workers
+        if cache is not None:
+            self.cache = cache
+        if cachesize is not None:
+            self.cachesize = cachesize
+        if engine is not None:
+            self.engine = engine
+        if tol is not None:
+            self.tol = tol
+        if starts is not None:
+            self.starts = starts
+        if gages is not None:
+            # List of {"name", "river", "reach", "rs", "stagef"} for multi-gage calibration
+            reaches = [(gage["river"], gage["reach"]) for gage in gages]
+            shared = sorted({reach for reach in reaches if reaches.count(reach) > 1})
+            if shared:
+                # n is set by reach, so gages on the same reach can't be calibrated separately
+                raise ValueError("Each gage must be on a different reach; shared: %s" % shared)
+            self.gages = gages
+        if usgscache is not None:
+            self.usgscache = usgscache
+        if usgsstat is not None:
+            self.usgsstat = usgsstat
+        if checkpoint is not None:
+            self.checkpoint = checkpoint
+        if checkpointevery is not None:
+            self.checkpointevery = checkpointevery
+        if resume is not None:
+            self.resume = resume
+        if timing is not None:
+            self.timing = timing
+        if prescreen is not None:
+            self.prescreen = prescreen
+        if nmin is not None:
+            self.nmin = nmin
+        if nmax is not None:
+            self.nmax = nmax
+        if sampling is not None:
+            self.sampling = sampling
+        if logn is not None:
+            self.logn = logn
+        if chunk is not None:
+            self.chunk = chunk
+        if refine is not None:
+            self.refine = refine
+        if refinefactor is not None:
+            self.refinefactor = refinefactor
+        if refinetol is not None:
+            self.refinetol = refinetol
+        if store is not None:
+            self.store = store
+        if streamcsv is not None:
+            self.streamcsv = streamcsv
+        if backgroundplot is not None:
+            self.backgroundplot = backgroundplot
 
     def interactive(self):
         # Get settings from user via interactive command line usage.
@@ -143,8 +249,10 @@ class Settings(object):
                 "Period or leave blank for 1 week or start date: ") if period\
                 is None else period
             return prepareUSGSData(
-                getUSGSData(usgs, enddate, startdate, period, si=si),
-                flowcount
+                getUSGSData(usgs, enddate, startdate, period, si=si,
+                            cache=self.usgscache),
+                flowcount,
+                stat="first" if self.usgsstat is None else self.usgsstat
             )
 
         self.version =\
@@ -153,17 +261,26 @@ class Settings(object):
         self.project = input(
             "Enter project path (including .prj file): ") if self.project is\
             None else self.project
-        self.usgs = input(
-            "USGS gage number or leave blank to use a stage file: ") if\
-            self.usgs is None else self.usgs
-        if self.usgs == "":
-            self.stagef = input(
-                "Enter path to stage file: ") if self.stagef is None else\
-                self.stagef
-        (self.flow, self.stage) = singleStageFile(self.stagef) if\
-            self.usgs == "" else getUSGS(
-            self.usgs, self.flowcount, self.enddate, self.startdate,
-            self.period)
+        if self.gages is not None:
+            # Multi-gage calibration: each gage has its own stage file, with the same flow profiles
+            for gage in self.gages:
+                (gage["flow"], gage["stage"]) = singleStageFile(gage["stagef"])
+                if list(gage["flow"]) != list(self.gages[0]["flow"]):
+                    raise ValueError("Gage %s has different flows from gage %s; all stage files must have the same "
+                                     "flow profiles" % (gage["name"], self.gages[0]["name"]))
+            (self.flow, self.stage) = (self.gages[0]["flow"], self.gages[0]["stage"])
+        else:
+            self.usgs = input(
+                "USGS gage number or leave blank to use a stage file: ") if\
+                self.usgs is None else self.usgs
+            if self.usgs == "":
+                self.stagef = input(
+                    "Enter path to stage file: ") if self.stagef is None else\
+                    self.stagef
+            (self.flow, self.stage) = singleStageFile(self.stagef) if\
+                self.usgs == "" else getUSGS(
+                self.usgs, self.flowcount, self.enddate, self.startdate,
+                self.period, self.si)
         self.outf = input(
             "Enter output file path or nothing to not have one: ") if\
             self.outf is None else self.outf
@@ -191,11 +308,12 @@ class Settings(object):
                         print("Warning: entered metric is not an option.")
             if self.metrics == []:
                 self.metrics = None
-        self.river = input(
-            "River name: ") if self.river is None else self.river
-        self.reach = input(
-            "Reach name: ") if self.reach is None else self.reach
-        self.rs = input("River station: ") if self.rs is None else self.rs
+        if self.gages is None:
+            self.river = input(
+                "River name: ") if self.river is None else self.river
+            self.reach = input(
+                "Reach name: ") if self.reach is None else self.reach
+            self.rs = input("River station: ") if self.rs is None else self.rs
         self.auto =\
             input("Enter Y to use automatic calibration\
  (default: interactive): ") in [
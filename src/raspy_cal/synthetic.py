@@ -0,0 +1,134 @@
+"""
+Pure-Python stand-in for the HEC-RAS model API, for testing and benchmarking without HEC-RAS.
+
+Implements the parts of the required API (see README.md) that raspy-cal uses, with an analytic
+normal-depth rating curve for a wide rectangular channel in place of an actual simulation:
+depth = (n * Q / (k * width * sqrt(slope))) ^ (3/5).  compute(wait=False) runs in the background and
+ops.computing() reports whether it is still running.
+
+model = Model(projectPath, version) works like default.Model.
+
+Copyright (C) 2020 Daniel Philippus
+Full copyright notice located in main.py.
+"""
+
+import threading
+import time
+
+
+class FlowData(object):
+    # Mimics the flow data entries returned by the raspy API.
+    def __init__(self, flow, maxDepth, velocity):
+        self.flow = flow
+        self.maxDepth = maxDepth
+        self.velocity = velocity
+        self.etc = {}
+
+
+class Ops(object):
+    def __init__(self, model):
+        self.model = model
+        self.running = None
+
+    def openProject(self, projectPath):
+        self.model.project = projectPath
+
+    def compute(self, steady=True, plan=None, wait=True):
+        n = dict(self.model.n)
+
+        def run():
+            if self.model.delay > 0:
+                time.sleep(self.model.delay)
+            self.model.computed = n
+        if wait:
+            run()
+        else:
+            self.running = threading.Thread(target=run, daemon=True)
+            self.running.start()
+
+    def computing(self):
+        return self.running is not None and self.running.is_alive()
+
+
+class Params(object):
+    def __init__(self, model):
+        self.model = model
+
+    def modifyN(self, manning, river, reach, geom=None):
+        self.model.n[(river, reach)] = manning
+
+    def setSteadyFlows(self, river, reach, rs, flows, slope, fileN, hecVer=None):
+        self.model.flows = list(flows)
+        self.model.slope = slope
+
+
+class Data(object):
+    def __init__(self, model):
+        self.model = model
+
+    def getSingleDatum(self, func, river, reach, rs, nprofs=1):
+        stations = self.model.stations if rs is None else [rs]
+        out = {}
+        for st in stations:
+            results = {prof: func(self.model.result(river, reach, st, prof)) for prof in range(1, nprofs + 1)}
+            out[st] = results if nprofs > 1 else results[1]
+        return out if rs is None else out[rs]
+
+    def allFlow(self, river=None, reach=None, rs=None, nprofs=1):
+        return self.getSingleDatum(lambda x: x, river, reach, rs, nprofs)
+
+    def velocity(self, river=None, reach=None, rs=None, nprofs=1):
+        return self.getSingleDatum(lambda x: x.velocity, river, reach, rs, nprofs)
+
+    def stage(self, river=None, reach=None, rs=None, nprofs=1):
+        return self.getSingleDatum(lambda x: x.maxDepth, river, reach, rs, nprofs)
+
+
+class SyntheticModel(object):
+    """
+    Stand-in model object.  Stations are assigned slightly different widths so that results differ
+    along the reach.
+    :param stations: river stations in the (single) reach; any river/reach name is accepted
+    :param flows: default flow profiles, until overwritten by setSteadyFlows
+    :param width: channel width at the first station
+    :param slope: default slope, until overwritten by setSteadyFlows
+    :param delay: artificial compute time in seconds
+    :param si: SI units (k = 1) instead of US customary (k = 1.486)
+    """
+    def __init__(self, stations=("100", "200", "300"), flows=None, width=50.0, slope=0.001,
+                 delay=0.0, si=False):
+        self.project = None
+        self.stations = list(stations)
+        self.flows = list(flows) if flows is not None else [10.0 * 2 ** ix for ix in range(10)]
+        self.width = width
+        self.slope = slope
+        self.delay = delay
+        self.k = 1.0 if si else 1.486
+        self.n = {}
+        self.computed = {}
+        self.ops = Ops(self)
+        self.params = Params(self)
+        self.data = Data(self)
+
+    def manning(self, river, reach, rs):
+        # Resolve n for the station from the forms supported by modifyN (number, list, or {rs: n}).
+        n = self.computed.get((river, reach), 0.035)
+        if isinstance(n, dict):
+            n = n.get(rs, 0.035)
+        elif isinstance(n, (list, tuple)):
+            n = n[self.stations.index(rs) % len(n)]
+        if isinstance(n, (list, tuple)):  # left/channel/right - use the channel value
+            n = n[len(n) // 2]
+        return n
+
+    def result(self, river, reach, rs, profile):
+        flow = self.flows[profile - 1]
+        width = self.width * (1 + 0.05 * self.stations.index(rs))
+        depth = (self.manning(river, reach, rs) * flow / (self.k * width * self.slope ** 0.5)) ** 0.6
+        return FlowData(flow, depth, flow / (width * depth))
+
+
+def Model(projectPath=None, version=None, **kwargs):
+    model = SyntheticModel(**kwargs)
+    model.ops.openProject(projectPath)
+    return model
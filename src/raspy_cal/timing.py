@@ -0,0 +1,112 @@
+"""
+Lightweight timing instrumentation for the calibration hot path.  Code wraps each phase in
+`with timing.span("name"):`; while timing is disabled (the default) span returns a shared do-nothing context
+manager, so instrumented code costs one function call and a flag check per phase.
+
+Once enabled, every span is recorded with its start time, duration and thread, and can be summarized as a table
+(count, total and percentiles per phase) or written out as JSON lines.
+
+Copyright (C) 2020 Daniel Philippus
+Full copyright notice located in main.py.
+"""
+
+import json
+import threading
+import time
+from contextlib import nullcontext
+
+enabled = False
+# Recorded spans: [(name, start, duration, thread name)]; start is relative to when timing was enabled
+records = []
+lock = threading.Lock()
+origin = time.perf_counter()
+noop = nullcontext()
+
+
+def enable(on=True):
+    """
+    Turn recording on (discarding anything previously recorded) or off.
+    """
+    global enabled, origin
+    with lock:
+        records.clear()
+        origin = time.perf_counter()
+        enabled = on
+
+
+class Span(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        with lock:
+            records.append((self.name, self.start - origin, end - self.start, threading.current_thread().name))
+        return False
+
+
+def span(name):
+    """
+    :return: context manager timing the phase called name, if timing is enabled
+    """
+    return Span(name) if enabled else noop
+
+
+def percentile(ordered, q):
+    # Linearly interpolated percentile q (0-100) of a sorted list
+    pos = (len(ordered) - 1) * q / 100
+    low = int(pos)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (pos - low)
+
+
+def stats():
+    """
+    :return: {phase: {"count", "total", "mean", "p50", "p90", "p99", "max"}} in seconds
+    """
+    with lock:
+        byName = {}
+        for (name, start, duration, thread) in records:
+            byName.setdefault(name, []).append(duration)
+    out = {}
+    for (name, durations) in byName.items():
+        durations.sort()
+        out[name] = {
+            "count": len(durations),
+            "total": sum(durations),
+            "mean": sum(durations) / len(durations),
+            "p50": percentile(durations, 50),
+            "p90": percentile(durations, 90),
+            "p99": percentile(durations, 99),
+            "max": durations[-1]
+        }
+    return out
+
+
+def summary():
+    """
+    :return: table of the recorded phases, slowest total first, with times in milliseconds
+    """
+    columns = ["count", "total", "mean", "p50", "p90", "p99", "max"]
+    phases = sorted(stats().items(), key=lambda item: -item[1]["total"])
+    width = max([len("phase (ms)")] + [len(name) for (name, _) in phases])
+    lines = [("%-" + str(width) + "s") % "phase (ms)" + "".join("%12s" % col for col in columns)]
+    for (name, st) in phases:
+        lines.append(("%-" + str(width) + "s") % name + "%12d" % st["count"] +
+                     "".join("%12.2f" % (st[col] * 1000) for col in columns[1:]))
+    return "\n".join(lines)
+
+
+def dump(path):
+    """
+    Write the recorded spans to path as JSON lines: {"name", "start", "duration", "thread"}, in seconds.
+    """
+    with lock:
+        rows = list(records)
+    with open(path, "w") as f:
+        for (name, start, duration, thread) in rows:
+            f.write(json.dumps({"name": name, "start": start, "duration": duration, "thread": thread}) + "\n")